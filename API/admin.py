@@ -0,0 +1,181 @@
+"""This module contains the admin resources of the API. They are served only if
+an admin token is configured in app.py, which must be sent in the
+X-Admin-Token header or the token parameter.
+
+GET /admin/memory reports the size in bytes of the in-memory structures of the
+worker that serves the request: the corpus arrays, the caches, the blobs and
+parameters of the Caffe nets and the means of their transformers, and the
+temporary upload directories left on disk. With trace=start, tracemalloc is
+started; each following request with trace=diff returns the allocations that
+grew most since the previous one. tracemalloc requires Python 3.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+
+import falcon
+import numpy as np
+
+import profiling
+import results
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# number of allocation differences reported by trace=diff
+TRACE_LIMIT = 20
+
+
+def authorize(req, token):
+    """Raises an HTTP error unless the request carries the admin token. The
+    admin resources are not found if no token is configured."""
+    if token is None:
+        raise falcon.HTTPNotFound()
+    given = req.get_header('X-Admin-Token') or req.params.get('token')
+    if not given or not profiling.same_token(given, token):
+        raise falcon.HTTPForbidden(title='Invalid admin token')
+
+
+def rss():
+    """Returns the resident and the shared memory of the process in bytes,
+    Linux only."""
+    with open('/proc/self/statm') as f:
+        values = f.read().split()
+    page = os.sysconf('SC_PAGE_SIZE')
+    return {'resident': int(values[1]) * page, 'shared': int(values[2]) * page}
+
+
+def deep_size(obj, seen=None):
+    """Returns the approximate size of an object and everything it contains,
+    NumPy arrays are counted by their data."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def net_sizes(net):
+    """Returns the bytes of the blobs, the activations of the last forward
+    pass, and of the parameters of a Caffe net."""
+    blobs = sum(blob.data.nbytes + blob.diff.nbytes for blob in net.blobs.values())
+    params = sum(p.data.nbytes + p.diff.nbytes for layer in net.params.values() for p in layer)
+    return {'blobs': blobs, 'params': params}
+
+
+def directory_size(path):
+    """Returns the total size of the files below a directory."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Memory(object):
+    """Falcon resource that reports the memory of the worker.
+
+    Parameters
+    ----------
+    collection : images.Collection
+        The collection with the corpus, the analysis cache and the nets.
+    image_storage : storage.CropStorage
+        The storage with the crop cache.
+    thumbnail_cache : thumbnails.ThumbnailCache
+        The thumbnail cache on disk.
+    token : str
+        The admin token, None disables the resource.
+    """
+
+    def __init__(self, collection, image_storage, thumbnail_cache, token):
+        self.collection = collection
+        self.image_storage = image_storage
+        self.thumbnail_cache = thumbnail_cache
+        self.token = token
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+    def report(self):
+        """Returns the sizes of the in-memory structures in bytes."""
+        db_handler = self.collection.db_handler
+        snapshot = db_handler.corpus
+        report = {'process': rss()}
+        if snapshot is not None:
+            report['corpus'] = dict((name, a.nbytes) for name, a in snapshot.arrays.items())
+            report['corpus']['total'] = snapshot.nbytes
+            # mapped snapshots are shared with the other workers
+            report['corpus']['shared'] = db_handler.index is not None
+        report['trigram_ids'] = deep_size(db_handler.trigram_ids)
+        with self.collection.cache.lock:
+            entries = list(self.collection.cache.entries.values())
+        report['analysis_cache'] = {'entries': len(entries), 'bytes': deep_size(entries)}
+        crops = getattr(self.image_storage, 'crops', None)
+        if crops is not None:
+            with self.image_storage.lock:
+                sizes = [len(data) for data, _ in crops.values()]
+            report['crop_cache'] = {'entries': len(sizes), 'bytes': sum(sizes)}
+        report['thumbnail_cache'] = {'disk_bytes': self.thumbnail_cache.total}
+
+        for name, net, trans in (('bar', self.collection.bar_net, self.collection.bar_trans),
+                                 ('pure', self.collection.pure_net, self.collection.pure_trans)):
+            report[name + '_classifier'] = net_sizes(net)
+            report[name + '_classifier']['transformer_mean'] = sum(
+                np.asarray(mean).nbytes for mean in trans.mean.values())
+
+        # upload directories that were not removed, see images.Collection.ingest
+        tmp = tempfile.gettempdir()
+        leftover = [os.path.join(tmp, name) for name in os.listdir(tmp) if name.startswith('imageplag-')]
+        report['upload_tmp'] = {'directories': len(leftover),
+                                'disk_bytes': sum(directory_size(path) for path in leftover)}
+        return report
+
+    def trace(self, action):
+        """Starts or stops tracemalloc, or returns the top differences to the
+        previous snapshot for action 'diff'."""
+        if tracemalloc is None:
+            return {'error': 'tracemalloc requires Python 3'}
+        with self.lock:
+            if action == 'start':
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                self.snapshot = tracemalloc.take_snapshot()
+                return {'tracing': True}
+            if action == 'stop':
+                tracemalloc.stop()
+                self.snapshot = None
+                return {'tracing': False}
+            if self.snapshot is None or not tracemalloc.is_tracing():
+                return {'error': 'tracemalloc is not started, use trace=start'}
+            snapshot = tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self.snapshot, 'lineno')[:TRACE_LIMIT]
+            self.snapshot = snapshot
+        return {'tracing': True,
+                'diff': [{'location': str(stat.traceback), 'size_diff': stat.size_diff,
+                          'size': stat.size, 'count_diff': stat.count_diff} for stat in stats]}
+
+    def on_get(self, req, resp):
+        authorize(req, self.token)
+        report = self.report()
+        action = req.params.get('trace')
+        if action is not None:
+            if action not in ('start', 'diff', 'stop'):
+                raise falcon.HTTPBadRequest(title='Invalid trace', description='start, diff or stop')
+            report['tracemalloc'] = self.trace(action)
+        resp.body = results.dumps(report)
+        resp.status = falcon.HTTP_200
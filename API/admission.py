@@ -0,0 +1,153 @@
+"""This module limits the requests that a worker processes at the same time.
+Uploads (POST /images) and analyses (GET /images with an id, POST /search)
+are separate classes, each with a limit of running requests and a bounded
+queue of waiting requests. A request that finds the queue of its class full, or that waits
+longer than the timeout, is answered with 503 and Retry-After. Waiting
+analyses are admitted before waiting uploads, so upload bursts do not starve
+the analyses.
+
+The number of running and queued requests of each class is reported as gauges
+at /metrics, e.g. admission_analysis_queued, along with counters of admitted,
+rejected and timed out requests and the total waiting time.
+"""
+
+import threading
+import time
+
+import falcon
+
+import metrics
+
+
+# request classes in the order of their priority
+CLASSES = ('analysis', 'ingest')
+
+# read size of wrapped file-like streams
+STREAM_BLOCK_SIZE = 8 * 1024
+
+
+def request_class(req):
+    """Returns the admission class of a request, or None if it is not
+    limited. Searches count as analyses."""
+    if req.path.rstrip('/') == '/search' and req.method == 'POST':
+        return 'analysis'
+    if req.path.rstrip('/') != '/images':
+        return None
+    if req.method == 'POST':
+        return 'ingest'
+    if req.method == 'GET' and 'id' in req.params:
+        return 'analysis'
+    return None
+
+
+class Releasing(object):
+    """Wraps a response stream and calls release when the server closes it,
+    so a streamed analysis holds its slot until it is sent."""
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        if hasattr(self.stream, 'read'):
+            return iter(lambda: self.stream.read(STREAM_BLOCK_SIZE), b'')
+        return iter(self.stream)
+
+    def close(self):
+        try:
+            if hasattr(self.stream, 'close'):
+                self.stream.close()
+        finally:
+            self.release()
+
+
+class Admission(object):
+    """Falcon middleware that admits the requests of each class.
+
+    Parameters
+    ----------
+    limits : dict
+        Maps each name in CLASSES to (running, queued), the maximum number of
+        requests that run and that wait.
+    timeout : float, optional
+        The maximum waiting time in seconds.
+    retry_after : int, optional
+        The Retry-After of rejected requests in seconds.
+    """
+
+    def __init__(self, limits, timeout=30.0, retry_after=5):
+        self.limits = limits
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.running = dict((name, 0) for name in CLASSES)
+        self.queued = dict((name, 0) for name in CLASSES)
+
+    def _gauges(self, name):
+        """Reports the state of a class. The caller must hold the condition."""
+        metrics.registry.set('admission_%s_running' % name, self.running[name])
+        metrics.registry.set('admission_%s_queued' % name, self.queued[name])
+
+    def _free(self, name):
+        """Returns True if a waiting request of a class may run. Requests of a
+        class wait while a class with higher priority has waiting requests."""
+        for other in CLASSES[:CLASSES.index(name)]:
+            if self.queued[other]:
+                return False
+        return self.running[name] < self.limits[name][0]
+
+    def _reject(self, name, reason):
+        metrics.registry.incr('admission_%s_%s' % (name, reason))
+        raise falcon.HTTPServiceUnavailable(title='Server busy',
+                                            description='Too many %s requests, retry later' % name,
+                                            retry_after=self.retry_after)
+
+    def acquire(self, name):
+        """Waits until a request of a class may run. Raises
+        falcon.HTTPServiceUnavailable if the queue is full or the waiting
+        time exceeds the timeout."""
+        start = time.time()
+        with self.condition:
+            if not self._free(name) or self.queued[name]:
+                if self.queued[name] >= self.limits[name][1]:
+                    self._reject(name, 'rejected')
+                self.queued[name] += 1
+                self._gauges(name)
+                try:
+                    while not self._free(name):
+                        remaining = start + self.timeout - time.time()
+                        if remaining <= 0:
+                            self._reject(name, 'timeouts')
+                        self.condition.wait(remaining)
+                finally:
+                    self.queued[name] -= 1
+                    # requests of lower priority may wait for this queue
+                    self.condition.notify_all()
+            self.running[name] += 1
+            self._gauges(name)
+        metrics.registry.incr('admission_%s_admitted' % name)
+        metrics.registry.incr('admission_%s_wait_seconds' % name, time.time() - start)
+
+    def release(self, name):
+        """Frees the slot of a finished request."""
+        with self.condition:
+            self.running[name] -= 1
+            self._gauges(name)
+            self.condition.notify_all()
+
+    def process_resource(self, req, resp, resource, params):
+        name = request_class(req)
+        if resource is None or name is None:
+            return
+        self.acquire(name)
+        req.context['admission'] = name
+
+    def process_response(self, req, resp, resource, req_succeeded=True):
+        name = req.context.get('admission')
+        if name is None:
+            return
+        del req.context['admission']
+        if resp.stream is not None:
+            resp.stream = Releasing(resp.stream, lambda: self.release(name))
+        else:
+            self.release(name)
@@ -1,5 +1,12 @@
 import falcon
+import admin
+import admission
 import images
+import metrics
+import profiling
+import search
+import storage
+import thumbnails
 
 
 # Settings
@@ -8,18 +15,105 @@ bar_classifier = 'DNN_bar_no_bar'
 pure_classifier = 'DNN_pure_no_pure'
 database_path = 'database.sqlite'
 use_gpu = False
+# 'file' stores one file per image in storage_path, 'pack' appends the images
+# to segment files of pack_segment_bytes in storage_path
+storage_backend = 'file'
+pack_segment_bytes = 1024 ** 3
+# store only the bounding rectangles of the subimages on their parent, the
+# subimages are cropped on demand, the last crop_cache_size crops are cached
+virtual_subimages = False
+crop_cache_size = 64
+# OCR only the detected text lines at an adaptive scale instead of the whole
+# subimage, changes the extracted text of new uploads
+ocr_regions = False
+# at upload, drop crops that lie in or mostly overlap a larger crop, and reuse
+# the features of crops with the same quick hashes as an earlier crop of the
+# upload instead of classifying them and recognizing their text again
+crop_dedup = False
+# version of the classifier models, bump it when they are replaced and run
+# backfill.py to classify the stored subimages again
+classifier_version = 1
+# commit window in seconds to group concurrent uploads into one transaction
+group_commit = 0.0
+# compare only texts whose 64 bit SimHashes differ in at most this many bits,
+# None compares all texts exactly
+text_prefilter = None
+# index the pHashes of flipped, rotated and cropped variants of each subimage
+index_variants = False
+# directory of corpus snapshots shared by the worker processes through mmap, the
+# corpus is then held in memory once, None keeps a private copy per worker
+shared_index = None
+# threads shared by all analyses to evaluate the subimages and modalities in
+# parallel, 0 evaluates them one after another, at most analysis_concurrency
+# evaluations of one request run at the same time
+analysis_threads = 0
+analysis_concurrency = 8
+# processes for the text evaluations, requires shared_index, 0 evaluates the
+# texts in the analysis threads
+text_processes = 0
+# number of cached analysis results, 0 disables the cache
+analysis_cache_size = 128
+# directory and maximum size in bytes of the thumbnail cache
+thumbnail_path = '/tmp/imageplag-thumbnails'
+thumbnail_cache_bytes = 256 * 1024 * 1024
+# running and waiting uploads and analyses per worker, in ASGI mode (asgi.py)
+# and with admission_control; requests beyond them are answered with 503 and
+# Retry-After of retry_after seconds, as are requests that wait longer than
+# admission_timeout seconds; waiting analyses are admitted before uploads
+ingest_workers = 2
+ingest_queue = 8
+analysis_workers = 4
+analysis_queue = 16
+# running and waiting image and thumbnail downloads per worker in ASGI mode
+download_workers = 8
+download_queue = 64
+admission_control = False
+admission_timeout = 30.0
+retry_after = 5
+# token for admin requests, None disables them; /admin/memory requires it in
+# the header X-Admin-Token or the parameter token; a request with the header
+# X-Profile or the parameter profile set to the token is profiled, the
+# profiles are written to profile_path
+admin_token = None
+profile_path = '/tmp/imageplag-profiles'
 
 
 # Startup
-api = application = falcon.API()
+middleware = [profiling.Profiler(admin_token, profile_path)]
+if admission_control:
+    middleware.append(admission.Admission({'ingest': (ingest_workers, ingest_queue),
+                                           'analysis': (analysis_workers, analysis_queue)},
+                                          admission_timeout, retry_after))
+api = application = falcon.API(middleware=middleware)
 
-image_collection = images.Collection(database_path, storage_path, bar_classifier, pure_classifier, use_gpu)
-print("storage_path: " + storage_path)
-image = images.Item(storage_path)
+if storage_backend == 'pack':
+    image_storage = storage.PackStorage(storage_path, pack_segment_bytes)
+else:
+    image_storage = storage.FileStorage(storage_path)
+
+image_collection = images.Collection(database_path, storage_path, bar_classifier, pure_classifier, use_gpu,
+                                     group_commit=group_commit, text_prefilter=text_prefilter,
+                                     index_variants=index_variants,
+                                     cache_size=analysis_cache_size, image_storage=image_storage,
+                                     virtual_subimages=virtual_subimages, ocr_regions=ocr_regions,
+                                     classifier_version=classifier_version, shared_index=shared_index,
+                                     analysis_threads=analysis_threads,
+                                     analysis_concurrency=analysis_concurrency,
+                                     text_processes=text_processes, crop_dedup=crop_dedup)
+print("storage_path: " + storage_path + " (" + storage_backend + ")")
+# virtual subimages of earlier uploads are served in both modes
+image_storage = storage.CropStorage(image_storage, image_collection.db_handler.get_crop, crop_cache_size)
+image = images.Item(image_storage)
+thumbnail = images.Thumbnail(image_storage, thumbnails.ThumbnailCache(thumbnail_path, thumbnail_cache_bytes))
+memory = admin.Memory(image_collection, image_storage, thumbnail.cache, admin_token)
 
 print("database_path: " + database_path)
 
 api.add_route('/images', image_collection)
 api.add_route('/images/{id}', image)
+api.add_route('/images/{id}/thumbnail', thumbnail)
+api.add_route('/search', search.Search(image_collection))
+api.add_route('/metrics', metrics.Metrics())
+api.add_route('/admin/memory', memory)
 
 print("server ready")
@@ -0,0 +1,382 @@
+"""ASGI serving mode of the API. Requires Python 3 and falcon 3. The settings
+and resources of app are reused, e.g.:
+
+    $ cd API
+    $ uvicorn asgi:app
+
+Uploads, analyses and image downloads run in bounded thread pools, the
+liveness check and metrics are served from the event loop. If a client
+disconnects, its request is cancelled before the next subimage is processed."""
+
+import asyncio
+import functools
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import falcon
+import falcon.asgi
+
+import app as wsgi
+import images
+import metrics
+import results
+import search
+import thumbnails
+
+
+# scope key of the receive channel, see DisconnectWatch
+RECEIVE = 'imageplag.receive'
+
+# bytes read from a file per chunk of a download
+BLOCK_SIZE = 64 * 1024
+
+
+class DisconnectWatch(object):
+    """ASGI middleware that makes the receive channel available to the
+    responders, so they can wait for the client to disconnect."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        scope[RECEIVE] = receive
+        await self.app(scope, receive, send)
+
+
+async def disconnected(req):
+    """Returns when the client of a request disconnects. Must only be awaited
+    after the request body was read."""
+    receive = req.scope.get(RECEIVE)
+    if receive is None:
+        await asyncio.Event().wait()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+class Executor(object):
+    """Thread pool that runs at most max_workers jobs and lets at most
+    max_queued further jobs wait. Further jobs are rejected with 503 and
+    Retry-After."""
+
+    def __init__(self, name, max_workers, max_queued, retry_after=5):
+        self.name = name
+        self.retry_after = retry_after
+        self.pool = ThreadPoolExecutor(max_workers)
+        self.limit = max_workers + max_queued
+        self.slots = None
+
+    def _admit(self):
+        """Raises falcon.HTTPServiceUnavailable if all slots are taken."""
+        # the semaphore must be created in the running event loop
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.limit)
+        if self.slots.locked():
+            metrics.registry.incr(self.name + '_rejected')
+            raise falcon.HTTPServiceUnavailable(title='Server busy',
+                                                description='Too many %s requests, retry later' % self.name,
+                                                retry_after=self.retry_after)
+
+    async def run(self, req, func, *args):
+        """Runs func(*args, cancelled=event) in the pool. If the client
+        disconnects first, the event is set and images.Cancelled is raised.
+
+        Parameters
+        ----------
+        req : falcon.asgi.Request
+            The request the job belongs to.
+        func : callable
+            The job, a method of images.Collection.
+        args
+            The arguments of the job.
+
+        Returns
+        -------
+        object
+            The return value of func.
+        """
+        self._admit()
+        cancelled = threading.Event()
+        await self.slots.acquire()
+        try:
+            work = asyncio.get_event_loop().run_in_executor(
+                self.pool, functools.partial(func, *args, cancelled=cancelled))
+        except BaseException:
+            self.slots.release()
+            raise
+        # the slot is held until the thread is done, even if the request is
+        # cancelled before
+        work.add_done_callback(lambda f: self.slots.release())
+        watch = asyncio.ensure_future(disconnected(req))
+        try:
+            done, _ = await asyncio.wait({work, watch}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        finally:
+            watch.cancel()
+        if work not in done:
+            cancelled.set()
+            # retrieve the Cancelled exception of the job once it stops
+            work.add_done_callback(lambda f: f.cancelled() or f.exception())
+            metrics.registry.incr(self.name + '_cancelled')
+            raise images.Cancelled()
+        return work.result()
+
+    async def stream(self, req, func, *args):
+        """Starts a job whose result is sent as it is produced, see Stream.
+
+        Parameters
+        ----------
+        req : falcon.asgi.Request
+            The request the job belongs to.
+        func : callable
+            The job, returns an iterable of the chunks of the response.
+        args
+            The arguments of the job.
+
+        Returns
+        -------
+        Stream
+            The response stream, which holds a slot until it is closed.
+        """
+        self._admit()
+        cancelled = threading.Event()
+        await self.slots.acquire()
+        try:
+            chunks = await asyncio.get_event_loop().run_in_executor(
+                self.pool, functools.partial(func, *args, cancelled=cancelled))
+        except BaseException:
+            self.slots.release()
+            raise
+        return Stream(self, req, iter(chunks), cancelled)
+
+
+class Stream(object):
+    """Response stream that produces the chunks of a job one at a time in the
+    pool of an Executor. It holds a slot of the executor until the server
+    closes it. If the client disconnects, the event of the job is set and the
+    stream ends.
+
+    Parameters
+    ----------
+    executor : Executor
+        The executor whose slot was acquired for the job.
+    req : falcon.asgi.Request
+        The request the job belongs to.
+    chunks : iterator
+        The chunks of the response.
+    cancelled : threading.Event
+        The event of the job.
+    """
+
+    def __init__(self, executor, req, chunks, cancelled):
+        self.executor = executor
+        self.req = req
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.watch = None
+        self.work = None
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.watch is None:
+            self.watch = asyncio.ensure_future(disconnected(self.req))
+        work = self.work = asyncio.get_event_loop().run_in_executor(self.executor.pool, next, self.chunks, None)
+        done, _ = await asyncio.wait({work, self.watch}, return_when=asyncio.FIRST_COMPLETED)
+        if work not in done:
+            self.cancelled.set()
+            work.add_done_callback(lambda f: f.cancelled() or f.exception())
+            metrics.registry.incr(self.executor.name + '_cancelled')
+            raise StopAsyncIteration
+        chunk = work.result()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.watch is not None:
+            self.watch.cancel()
+        # stops the job at its next subimage if it was not exhausted
+        self.cancelled.set()
+        # the slot is held until the thread is done with the current chunk
+        if self.work is not None and not self.work.done():
+            self.work.add_done_callback(lambda f: self.executor.slots.release())
+        else:
+            self.executor.slots.release()
+
+
+class Collection(object):
+    """ASGI version of images.Collection."""
+
+    def __init__(self, collection, ingest, analysis):
+        self.collection = collection
+        self.ingest = ingest
+        self.analysis = analysis
+
+    async def on_get(self, req, resp):
+        if "id" not in req.params:
+            resp.text = results.dumps({'Status': 'Alive'})
+            resp.status = falcon.HTTP_200
+            return
+
+        id = req.params['id']
+        params = dict(req.params)
+        stream = req.get_param_as_bool('stream') or \
+            (req.accept is not None and 'application/x-ndjson' in req.accept)
+        if stream:
+            # the subimages are evaluated one by one in the analysis pool
+            resp.content_type = 'application/x-ndjson'
+            resp.stream = await self.analysis.stream(req, self._lines, id, params)
+            return
+        try:
+            subimages = await self.analysis.run(req, self.collection.get_analysis, id, params)
+        except images.Cancelled:
+            resp.status = '499 Client Closed Request'
+            return
+        resp.text = results.dumps(results.analysis(id, subimages))
+
+    def _lines(self, id, params, cancelled=None):
+        """Returns the streamed analysis of a document as NDJSON lines."""
+        subimages = self.collection.get_analysis(id, params, stream=True, cancelled=cancelled)
+        return ((results.dumps(record) + '\n').encode('utf-8') for record in subimages)
+
+    async def on_post(self, req, resp):
+        filename = req.params['id']
+        store = (req.params['store'] == 'true')
+        body = await req.stream.read()
+        try:
+            result = await self.ingest.run(req, self.collection.ingest, filename, store, io.BytesIO(body))
+        except images.Cancelled:
+            resp.status = '499 Client Closed Request'
+            return
+
+        resp.text = results.dumps(result)
+        resp.status = falcon.HTTP_201
+        location = images.upload_location(result)
+        if location is not None:
+            resp.location = location
+
+
+class Search(object):
+    """ASGI version of search.Search, the queries are evaluated in the
+    analysis pool."""
+
+    def __init__(self, search, analysis):
+        self.search = search
+        self.analysis = analysis
+
+    async def on_post(self, req, resp):
+        queries = search.parse(await req.stream.read())
+        try:
+            records = await self.analysis.run(req, self.search.search, queries, dict(req.params))
+        except images.Cancelled:
+            resp.status = '499 Client Closed Request'
+            return
+        resp.text = results.dumps(results.search(records))
+        resp.status = falcon.HTTP_200
+
+
+def _prepare(req, resp, storage, name, cancelled=None):
+    """Runs images.prepare_file as a job of an Executor."""
+    return images.prepare_file(req, resp, storage, name)
+
+
+def _thumbnail(cache, storage, name, size, cancelled=None):
+    """Returns the name of a cached thumbnail as a job of an Executor, None if
+    the image does not exist."""
+    try:
+        return cache.get(storage, name, size)
+    except KeyError:
+        return None
+
+
+def _chunks(storage, name, start, length, cancelled=None):
+    """Yields a byte range of a file in chunks of BLOCK_SIZE."""
+    f = storage.open_range(name, start, length)
+    try:
+        while True:
+            chunk = f.read(BLOCK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        f.close()
+
+
+class Item(object):
+    """ASGI version of images.Item and images.Thumbnail. The headers, the
+    thumbnails and the file contents are prepared and read in the download
+    pool, virtual subimages are cropped there as well."""
+
+    def __init__(self, item, thumbnail, downloads):
+        self.item = item
+        self.thumbnail = thumbnail
+        self.downloads = downloads
+
+    async def on_get(self, req, resp, id):
+        await self._send(req, resp, self.item.storage, id)
+
+    async def on_get_thumbnail(self, req, resp, id):
+        size = req.get_param_as_int('size') or thumbnails.DEFAULT_SIZE
+        if not thumbnails.MIN_SIZE <= size <= thumbnails.MAX_SIZE:
+            raise falcon.HTTPBadRequest(title='Invalid size')
+        try:
+            thumb_name = await self.downloads.run(req, _thumbnail, self.thumbnail.cache, self.item.storage, id, size)
+        except images.Cancelled:
+            resp.status = '499 Client Closed Request'
+            return
+        if thumb_name is None:
+            raise falcon.HTTPNotFound()
+        await self._send(req, resp, self.thumbnail.cache.storage, thumb_name)
+
+    async def _send(self, req, resp, storage, name):
+        try:
+            content = await self.downloads.run(req, _prepare, req, resp, storage, name)
+        except images.Cancelled:
+            resp.status = '499 Client Closed Request'
+            return
+        if content is not None:
+            resp.content_length = content[1]
+            resp.stream = await self.downloads.stream(req, _chunks, storage, name, *content)
+
+
+class Metrics(object):
+    """ASGI version of metrics.Metrics."""
+
+    async def on_get(self, req, resp):
+        metrics.Metrics().on_get(req, resp)
+
+
+class Memory(object):
+    """ASGI version of admin.Memory, the report is built in the default
+    executor of the event loop."""
+
+    def __init__(self, memory):
+        self.memory = memory
+
+    async def on_get(self, req, resp):
+        await asyncio.get_event_loop().run_in_executor(None, self.memory.on_get, req, resp)
+
+
+api = falcon.asgi.App()
+analysis = Executor('analysis', wsgi.analysis_workers, wsgi.analysis_queue, wsgi.retry_after)
+api.add_route('/images', Collection(wsgi.image_collection,
+                                    Executor('ingest', wsgi.ingest_workers, wsgi.ingest_queue, wsgi.retry_after),
+                                    analysis))
+api.add_route('/search', Search(search.Search(wsgi.image_collection), analysis))
+item = Item(wsgi.image, wsgi.thumbnail,
+            Executor('download', wsgi.download_workers, wsgi.download_queue, wsgi.retry_after))
+api.add_route('/images/{id}', item)
+api.add_route('/images/{id}/thumbnail', item, suffix='thumbnail')
+api.add_route('/metrics', Metrics())
+api.add_route('/admin/memory', Memory(wsgi.memory))
+app = DisconnectWatch(api)
@@ -0,0 +1,207 @@
+"""Extracts the features of stored subimages again, if they were computed with
+an older algorithm version than the current one (see database.FEATURES and
+the VERSION of ratiohash, ocr and multihash). Run from the API folder, e.g.:
+
+    $ python backfill.py --database database.sqlite --storage <storage_path>
+
+The images are processed in a process pool and the features are written in
+batches. Only outdated rows are selected, an interrupted run continues where
+it stopped when it is started again. --rate and --nice limit the load next to
+a running API, which sees the new features after its next reload.
+"""
+
+import argparse
+import io
+import multiprocessing
+import os
+import sqlite3
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import classify
+import database
+import images
+import multihash
+import ocr
+import ratiohash
+import storage
+
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(args):
+    """Loads the classifiers and opens the storage in a worker process."""
+    if args.nice:
+        os.nice(args.nice)
+    if args.storage_backend == 'pack':
+        image_storage = storage.PackStorage(args.storage)
+    else:
+        image_storage = storage.FileStorage(args.storage)
+    db = sqlite3.connect(args.database)
+    db.text_factory = str
+
+    def lookup(id):
+        row = db.execute('SELECT parent, x, y, w, h FROM crops WHERE id=?', (id,)).fetchone()
+        return None if row is None else (row[0], tuple(row[1:]))
+
+    _worker['storage'] = storage.CropStorage(image_storage, lookup)
+    _worker['versions'] = images.feature_versions(args.classifier_version, args.ocr_regions)
+    _worker['ocr_regions'] = args.ocr_regions
+    if 'class' in args.features:
+        _worker['bar'] = images.load_classifier(args.bar_classifier)
+        _worker['pure'] = images.load_classifier(args.pure_classifier)
+
+
+def _extract(task):
+    """Extracts the outdated features of one subimage.
+
+    Parameters
+    ----------
+    task : tuple
+        (id, features, is_bar, is_pure, has_variants), the names of the
+        outdated features, the stored classification and whether the pHashes
+        of its variants are stored.
+
+    Returns
+    -------
+    dict
+        The update for database.DBHandler.update_features, or a dictionary
+        with the keys id and error.
+    """
+    id, features, is_bar, is_pure, has_variants = task
+    features = set(features)
+    try:
+        data = _worker['storage'].read(id)
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except (KeyError, IOError) as er:
+        return {'id': id, 'error': str(er)}
+    # decoded like a file read by cv2.imread at upload
+    gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    update = {'id': id}
+    if 'class' in features:
+        net, trans, labels = _worker['bar']
+        bar = images.bar_chart(classify.classify(net, trans, [img], labels_file=labels))
+        net, trans, labels = _worker['pure']
+        pure = images.pure_image(classify.classify(net, trans, [img], labels_file=labels))
+        # a changed classification decides which features exist
+        if bar != is_bar:
+            features.add('rhash')
+        if pure != is_pure:
+            features.add('text')
+        is_bar, is_pure = bar, pure
+        update['is_bar'], update['is_pure'] = int(bar), int(pure)
+    if 'rhash' in features:
+        update['rhash'] = ratiohash.get_hash(gray) if is_bar else 'NA'
+    if 'text' in features:
+        update['text'] = ocr.ocr(gray, regions=_worker['ocr_regions']) if not is_pure else ''
+    if 'mhash' in features:
+        hashes = multihash.extract([img], with_variants=has_variants)
+        for name in multihash.HASHES:
+            update[name] = hashes[name][0]
+        # the variants are indexed with the pHash they were computed with
+        if has_variants:
+            update['variants'] = dict((name, hashes['variants'][name][0]) for name in multihash.VARIANTS)
+    update['versions'] = dict((name, _worker['versions'][name]) for name in features)
+    return update
+
+
+def outdated(db_handler, versions, features, after, limit):
+    """Returns the next rows with outdated features, ordered by id.
+
+    Parameters
+    ----------
+    db_handler : database.DBHandler
+        The database.
+    versions : dict
+        The current version of each feature.
+    features : list
+        The features to check.
+    after : str
+        Only rows with a larger id are returned.
+    limit : int
+        The maximum number of rows.
+
+    Returns
+    -------
+    list
+        Tasks for _extract.
+    """
+    # features that do not exist for the classification are not outdated
+    exists = {'class': '1', 'rhash': 'is_bar=1', 'text': 'is_pure=0', 'mhash': '1'}
+    condition = ' OR '.join('(%s AND %s_version IS NOT ?)' % (exists[name], name) for name in features)
+    with db_handler.lock:
+        rows = db_handler.cursor.execute('''SELECT id, is_bar, is_pure,
+        EXISTS(SELECT 1 FROM variants WHERE variants.id = hashes.id), class_version,
+        rhash_version, text_version, mhash_version FROM hashes WHERE id > ? AND (%s)
+        ORDER BY id LIMIT ?''' % condition,
+                                         [after] + [versions[name] for name in features]
+                                         + [limit]).fetchall()
+    tasks = []
+    for row in rows:
+        id, is_bar, is_pure, has_variants = row[:4]
+        stored = dict(zip(database.FEATURES, row[4:]))
+        todo = [name for name in features if stored[name] != versions[name] and
+                (name != 'rhash' or is_bar) and (name != 'text' or not is_pure)]
+        tasks.append((id, todo, bool(is_bar), bool(is_pure), bool(has_variants)))
+    return tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='database.sqlite')
+    parser.add_argument('--storage', required=True, help='storage_path of the API')
+    parser.add_argument('--storage-backend', choices=['file', 'pack'], default='file')
+    parser.add_argument('--features', default=','.join(database.FEATURES),
+                        help='comma separated features to check, default: all')
+    parser.add_argument('--bar-classifier', default='DNN_bar_no_bar')
+    parser.add_argument('--pure-classifier', default='DNN_pure_no_pure')
+    parser.add_argument('--classifier-version', type=int, default=1)
+    parser.add_argument('--ocr-regions', action='store_true', help='see ocr_regions in app.py')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--batch', type=int, default=100, help='rows per transaction')
+    parser.add_argument('--rate', type=float, default=0.0, help='maximum rows per second, 0 is unlimited')
+    parser.add_argument('--nice', type=int, default=10, help='niceness added to the workers')
+    args = parser.parse_args()
+    args.features = [name for name in args.features.split(',') if name]
+    for name in args.features:
+        if name not in database.FEATURES:
+            parser.error('unknown feature: ' + name)
+
+    db_handler = database.DBHandler(args.database, load=False)
+    versions = images.feature_versions(args.classifier_version, args.ocr_regions)
+    pool = multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(args,))
+
+    after = ''
+    done = failed = 0
+    start = time.time()
+    try:
+        while True:
+            tasks = outdated(db_handler, versions, args.features, after, args.batch)
+            if not tasks:
+                break
+            after = tasks[-1][0]
+            batch_start = time.time()
+            updates = []
+            for update in pool.imap_unordered(_extract, tasks):
+                if 'error' in update:
+                    print('Skipped ' + update['id'] + ': ' + update['error'])
+                    failed += 1
+                else:
+                    updates.append(update)
+            done += db_handler.update_features(updates)
+            print('%d updated, %d skipped, %.1f rows/s' % (done, failed, done / (time.time() - start)))
+            if args.rate > 0:
+                time.sleep(max(0.0, len(tasks) / args.rate - (time.time() - batch_start)))
+    finally:
+        pool.terminate()
+
+
+if __name__ == '__main__':
+    main()
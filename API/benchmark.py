@@ -0,0 +1,321 @@
+"""Benchmarks for performance sensitive parts of the API. Run from the API
+folder, e.g.:
+
+    $ python benchmark.py response --subimages 50 --matches 1000
+    $ python benchmark.py ocr /path/to/subimages/*
+    $ python benchmark.py memory --rows 200000
+    $ python benchmark.py analysis --rows 200000 --subimages 30 --threads 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import corpus
+import database
+import evaluation
+import multihash
+import ocr
+import ratiohash
+import results
+
+
+def _match_df(n_matches):
+    """Returns a DataFrame as returned by the DBHandler eval functions."""
+    return pd.DataFrame({'id': ['doc%d-%d' % (i // 10, i % 10) for i in range(n_matches)],
+                         'parent': ['doc%d' % (i // 10) for i in range(n_matches)],
+                         'score': np.random.rand(n_matches)})
+
+
+def _concat_response(doc_id, subimages):
+    """The string concatenation used before the result model was introduced.
+    Kept as baseline."""
+    body = '{ ' + \
+           '"analyse": "True",' + \
+           '"store": "False",' + \
+           '"id": "' + str(doc_id) + '",' + \
+           '"subimages": ['
+    for name, df in subimages:
+        matches = '['
+        for index, row in df.iterrows():
+            matches += '{' \
+                       '"id": "' + str(row.id) + '",' + \
+                       '"parent": "' + str(row.parent) + '",' + \
+                       '"score": "' + str(row.score) + '"' + \
+                       '},'
+        if matches[-1] == ',':
+            matches = matches[:-1]
+        matches += ']'
+        body += '{'
+        body += '"id": "' + str(name) + '",'
+        body += '"parent": "' + str(doc_id) + '",'
+        body += '"is_pure": "False",'
+        body += '"is_bar": "True",'
+        body += '"matches_phash": ' + matches + ','
+        body += '"matches_rhash": ' + matches + ','
+        body += '"matches_text": ' + matches
+        body += '},'
+    return body[:-1] + ']}'
+
+
+def _model_response(doc_id, subimages):
+    """Builds the response with the result model."""
+    records = []
+    for name, df in subimages:
+        matches = results.match_list(df)
+        records.append(results.analysis_subimage(name, doc_id, False, True,
+                                                 matches, matches, matches))
+    return results.dumps(results.analysis(doc_id, records))
+
+
+def bench_response(n_subimages, n_matches, repeat):
+    """Prints the response build time of the concatenation baseline and of
+    the result model.
+
+    Parameters
+    ----------
+    n_subimages : int
+        Number of subimages in the analysed document.
+    n_matches : int
+        Number of matches per subimage and modality.
+    repeat : int
+        Number of timed runs, the best run is reported.
+    """
+    subimages = [('doc-%d' % i, _match_df(n_matches)) for i in range(n_subimages)]
+    for name, build in (('concat', _concat_response), ('model', _model_response)):
+        best = min(timeit.repeat(lambda: build('doc', subimages), number=1, repeat=repeat))
+        print('%-8s subimages=%d matches=%d: %.4f s' % (name, n_subimages, n_matches, best))
+
+
+def bench_ocr(paths, min_words):
+    """Prints the OCR time of the whole image and of the text regions for each
+    image, and the text distance between both results.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the images, e.g. stored subimages.
+    min_words : int
+        The min_words of ocr.distance. Texts with fewer trigrams have no
+        meaningful distance.
+    """
+    totals = {False: 0.0, True: 0.0}
+    distances = []
+    for path in paths:
+        texts = {}
+        for regions in (False, True):
+            start = timeit.default_timer()
+            texts[regions] = ocr.ocr(path, regions=regions)
+            totals[regions] += timeit.default_timer() - start
+        dist = ocr.distance(texts[False], texts[True], min_words=min_words)
+        distances.append(dist)
+        print('%s: words=%d/%d distance=%.3f' % (path, len(texts[False].split()),
+                                                 len(texts[True].split()), dist))
+
+    distances = np.array(distances)
+    comparable = distances[distances < 10000.0]
+    print('whole image: %.3f s, text regions: %.3f s' % (totals[False], totals[True]))
+    if len(comparable):
+        print('distance of %d comparable images: median=%.3f, <=1.0: %.1f%%'
+              % (len(comparable), np.median(comparable), 100.0 * np.mean(comparable <= 1.0)))
+
+
+def _synthetic_db(path, n_rows):
+    """Fills a database with random subimages, 3 per document, with a third
+    bar charts, a fifth of variants and texts of 8 to 40 words."""
+    words = ['%s%d' % (w, i) for w in ('value', 'chart', 'model', 'result', 'data') for i in range(400)]
+    rng = random.Random(0)
+
+    def h64():
+        return rng.getrandbits(63) - (1 << 62)
+
+    db_handler = database.DBHandler(path, load=False)
+    with db_handler.bulk():
+        for i in range(n_rows):
+            entry = {'id': 'document-%08d-%d' % (i // 3, i % 3), 'parent': 'document-%08d' % (i // 3),
+                     'phash': h64(), 'is_bar': int(i % 3 == 0), 'is_pure': 0,
+                     'text': ' '.join(rng.choice(words) for _ in range(rng.randint(8, 40)))}
+            entry['rhash'] = ''.join('%03x' % rng.randint(0, 4095) for _ in range(6)) \
+                if entry['is_bar'] else 'NA'
+            for name in multihash.HASHES[1:]:
+                entry[name] = h64()
+            if i % 5 == 0:
+                entry['variants'] = dict((name, h64()) for name in multihash.VARIANTS)
+            db_handler.add_entries([entry])
+
+
+def _pandas_load(path):
+    """The DataFrame loading used before the columnar corpus was introduced.
+    Kept as baseline."""
+    db = database.sqlite3.connect(path)
+    db.text_factory = str
+    df = pd.read_sql_query('''SELECT id, parent, phash, rhash, text,
+    trigram_ids, n_trigrams, simhash, is_bar, is_pure, dhash, ahash,
+    whash FROM hashes''', db)
+    vdf = pd.read_sql_query('''SELECT variants.id, hashes.parent,
+    variants.variant, variants.phash FROM variants JOIN hashes
+    ON variants.id = hashes.id''', db)
+    df['phash'] = df['phash'].astype(np.int64)
+    df['rhash'] = pd.Series([ratiohash.unpack(blob) for blob in df['rhash'].values],
+                            index=df.index, dtype=object)
+    df['trigram_ids'] = pd.Series([None if blob is None else np.frombuffer(blob, dtype='<u4')
+                                   for blob in df['trigram_ids'].values],
+                                  index=df.index, dtype=object)
+    df['n_trigrams'] = df['n_trigrams'].fillna(0).astype(np.int64)
+    df['simhash'] = df['simhash'].fillna(0).astype(np.int64)
+    df['has_mhash'] = df['dhash'].notnull() & df['ahash'].notnull() & df['whash'].notnull()
+    for name in multihash.HASHES[1:]:
+        df[name] = df[name].fillna(0).astype(np.int64)
+    vdf['phash'] = vdf['phash'].astype(np.int64)
+    db.close()
+    return df, vdf
+
+
+def _corpus_load(path):
+    """Loads the columnar corpus, as DBHandler.reload_db does."""
+    db = database.sqlite3.connect(path)
+    db.text_factory = str
+    loaded = corpus.Corpus.load(db.cursor())
+    db.close()
+    return loaded
+
+
+def _rss():
+    """Returns the resident set size of this process in bytes, Linux only."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _measure(load, path, queue):
+    """Puts the RSS growth of loading the database into the queue, run in a
+    fresh process for each loader."""
+    before = _rss()
+    loaded = load(path)
+    queue.put(_rss() - before)
+    del loaded
+
+
+def bench_memory(n_rows):
+    """Prints the memory of the in-memory corpus per million rows, of the
+    DataFrame baseline and of the columnar corpus.
+
+    Parameters
+    ----------
+    n_rows : int
+        Number of subimages of the synthetic database.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'database.sqlite')
+        _synthetic_db(path, n_rows)
+        sizes = {}
+        for name, load in (('pandas', _pandas_load), ('columnar', _corpus_load)):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_measure, args=(load, path, queue))
+            process.start()
+            sizes[name] = queue.get()
+            process.join()
+            print('%-8s rows=%d: %.1f MB RSS, %.1f MB per million rows'
+                  % (name, n_rows, sizes[name] / 1e6, sizes[name] / 1e6 * 1e6 / n_rows))
+        print('reduction: %.1fx' % (sizes['pandas'] / float(max(sizes['columnar'], 1))))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_analysis(n_rows, n_subimages, threads, repeat):
+    """Prints the evaluation time of a batch of subimages, sequentially and in
+    a thread pool, and the time of its slowest single evaluation.
+
+    Parameters
+    ----------
+    n_rows : int
+        Number of subimages of the synthetic database.
+    n_subimages : int
+        Number of analysed subimages, taken from the first documents of the
+        corpus. Each is compared with the subimages of all other documents.
+    threads : int
+        Size of the thread pool, also used as the per-request concurrency.
+    repeat : int
+        Number of timed runs, the best run is reported.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'database.sqlite')
+        _synthetic_db(path, n_rows)
+        loaded = _corpus_load(path)
+    finally:
+        shutil.rmtree(tmp_dir)
+    # the synthetic documents have 3 subimages, so the subimages are taken
+    # from the first documents, each compared with the rows of the others
+    queries = []
+    compared = {}
+    for i in range(min(n_subimages, len(loaded))):
+        row = loaded.record(i)
+        if row['parent'] not in compared:
+            compared[row['parent']] = loaded.rows_except(row['parent'])
+        queries.append((row, compared[row['parent']]))
+
+    def subimages():
+        for row, rows in queries:
+            jobs = [('phash', loaded.eval_phash, (row['phash'], rows), {}),
+                    ('text', loaded.eval_text, ((row['trigram_ids'], row['n_trigrams'], row['simhash']), rows), {}),
+                    ('mhash', loaded.eval_mhash, (dict((name, row[name]) for name in multihash.HASHES), rows), {})]
+            if row['is_bar']:
+                jobs.append(('rhash', loaded.eval_rhash, (row['rhash'], rows), {}))
+            yield row, jobs
+
+    slowest = 0.0
+    for _, jobs in subimages():
+        for _, func, args, kwargs in jobs:
+            start = timeit.default_timer()
+            func(*args, **kwargs)
+            slowest = max(slowest, timeit.default_timer() - start)
+    for name, evaluator in (('sequential', evaluation.Evaluator()),
+                            ('threads', evaluation.Evaluator(threads, threads))):
+        best = min(timeit.repeat(lambda: list(evaluator.run(subimages())), number=1, repeat=repeat))
+        print('%-10s rows=%d subimages=%d: %.3f s' % (name, n_rows, len(queries), best))
+    print('slowest single evaluation: %.3f s' % slowest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    response = subparsers.add_parser('response', help='response build time')
+    response.add_argument('--subimages', type=int, default=30)
+    response.add_argument('--matches', type=int, default=1000)
+    response.add_argument('--repeat', type=int, default=3)
+
+    ocr_parser = subparsers.add_parser('ocr', help='OCR time and text agreement of the text regions')
+    ocr_parser.add_argument('paths', nargs='+')
+    ocr_parser.add_argument('--min-words', type=int, default=10)
+
+    memory = subparsers.add_parser('memory', help='RSS of the in-memory corpus')
+    memory.add_argument('--rows', type=int, default=200000)
+
+    analysis = subparsers.add_parser('analysis', help='evaluation time of a document')
+    analysis.add_argument('--rows', type=int, default=200000)
+    analysis.add_argument('--subimages', type=int, default=30)
+    analysis.add_argument('--threads', type=int, default=multiprocessing.cpu_count())
+    analysis.add_argument('--repeat', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == 'response':
+        bench_response(args.subimages, args.matches, args.repeat)
+    elif args.command == 'ocr':
+        bench_ocr(args.paths, args.min_words)
+    elif args.command == 'memory':
+        bench_memory(args.rows)
+    elif args.command == 'analysis':
+        bench_analysis(args.rows, args.subimages, args.threads, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
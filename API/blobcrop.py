@@ -4,6 +4,14 @@ from PIL import Image
 import img_util
 
 
+# width of the white border added around an image before the blobs are found
+PADDING = 10
+# dedup_rects drops a rectangle if this share of its area lies in a larger one
+CONTAINMENT = 0.95
+# or if its intersection over union with a larger one is at least this
+OVERLAP = 0.8
+
+
 def floodfill(img, color=0):
     """Floodfills an image from the point (0, 0).
     
@@ -120,7 +128,7 @@ def subimage(img, rect):
     return img[y:y+h, x:x+w]
     
 
-def crop_to_blob(img, min_blob_size=0.1):
+def crop_to_blob(img, min_blob_size=0.1, with_rects=False):
     """Converts an image to a number of subimages. Each subimage contains one
     blob (spot of connected pixels).
     
@@ -131,11 +139,15 @@ def crop_to_blob(img, min_blob_size=0.1):
         subimages.
     min_blob_size :
         The minimum size of the subimages in ratio to the original image.
+    with_rects : bool, optional
+        If True, the bounding rectangles of the subimages are returned as
+        well, see crop.
         
     Returns
     -------
     list
-        A list of PIL Image objects that contain blobs.
+        A list of PIL Image objects that contain blobs. If with_rects is True,
+        a tuple of this list and the list of rectangles.
     """
     
     # read image as grayscale
@@ -143,7 +155,7 @@ def crop_to_blob(img, min_blob_size=0.1):
     # get shape of the image
     height, width = img.shape[:2]
     # ensure the image has a white border
-    img = pad(img)
+    img = pad(img, PADDING)
     # adaptive thresholding
     img_bw = cv2.adaptiveThreshold(img.copy(), 255,
                                    cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
@@ -178,9 +190,70 @@ def crop_to_blob(img, min_blob_size=0.1):
     #display(img_list)
     # convert image to PIL image
     img_list = [Image.fromarray(i) for i in img_list]
+    if with_rects:
+        # relative to the unpadded image
+        return img_list, [(x - PADDING, y - PADDING, w, h) for x, y, w, h in rects]
     return img_list
 
 
+def crop(img, rect):
+    """Crops a subimage found by crop_to_blob from the original image. The
+    result is identical to the subimage returned by crop_to_blob.
+
+    Parameters
+    ----------
+    img : {PIL Image Object, str}
+        The original image or path to it.
+    rect : tuple
+        The bounding rectangle (x, y, w, h) returned by crop_to_blob. It may
+        extend into the white border added around the image.
+
+    Returns
+    -------
+    PIL Image
+        The grayscale subimage.
+    """
+    img = pad(img_util.to_cv2(img), PADDING)
+    x, y, w, h = rect
+    return Image.fromarray(subimage(img, (x + PADDING, y + PADDING, w, h)))
+
+
+def dedup_rects(rects, containment=CONTAINMENT, overlap=OVERLAP):
+    """Selects the bounding rectangles of crop_to_blob that are neither
+    contained in nor highly overlapping with a larger one. Nested contours
+    otherwise yield the same content several times.
+
+    Parameters
+    ----------
+    rects : list
+        The bounding rectangles (x, y, w, h).
+    containment : float, optional
+        A rectangle is dropped if this share of its area lies in a larger
+        rectangle that is kept.
+    overlap : float, optional
+        A rectangle is dropped if its intersection over union with a larger
+        rectangle that is kept is at least this.
+
+    Returns
+    -------
+    list
+        The indices of the kept rectangles in ascending order.
+    """
+    kept = []
+    # larger rectangles first, so nested ones are compared to their container
+    for i in sorted(range(len(rects)), key=lambda i: -rects[i][2] * rects[i][3]):
+        x, y, w, h = rects[i]
+        area = float(w * h)
+        for j in kept:
+            kx, ky, kw, kh = rects[j]
+            inter = max(0, min(x + w, kx + kw) - max(x, kx)) * max(0, min(y + h, ky + kh) - max(y, ky))
+            if inter >= containment * area or inter >= overlap * (area + kw * kh - inter):
+                break
+        else:
+            kept.append(i)
+    return sorted(kept)
+
+
 def display(images): 
     """Debug function. Takes a list of cv2 images and displays them.
     
@@ -0,0 +1,114 @@
+"""This module contains the cache of analysis results. Entries are tagged with
+the corpus generation of the DBHandler they were computed at, and are only
+returned while the generation is unchanged."""
+
+import collections
+import threading
+import metrics
+
+
+class AnalysisCache(object):
+    """LRU cache of analysis results with single-flight computation. Concurrent
+    requests for the same key wait for the first computation instead of
+    starting their own."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+
+    def get(self, key, generation):
+        """Returns the cached result of a key, or None if there is no result
+        for the generation.
+
+        Parameters
+        ----------
+        key : tuple
+            The cache key, parent id and threshold parameters.
+        generation : int
+            The current corpus generation.
+
+        Returns
+        -------
+        list
+            The cached result, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                metrics.registry.incr('analysis_cache_misses')
+                return None
+            # move to the end, the most recently used position
+            del self.entries[key]
+            self.entries[key] = entry
+        metrics.registry.incr('analysis_cache_hits')
+        return entry[1]
+
+    def put(self, key, generation, result):
+        """Stores a result. The least recently used entries are evicted if the
+        cache is full.
+
+        Parameters
+        ----------
+        key : tuple
+            The cache key, parent id and threshold parameters.
+        generation : int
+            The corpus generation the result was computed at.
+        result : list
+            The result to store.
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (generation, result)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            metrics.registry.set('analysis_cache_size', len(self.entries))
+
+    def get_or_compute(self, key, generation, compute):
+        """Returns the cached result of a key, or computes and stores it.
+        Only one computation per key and generation runs at a time.
+
+        Parameters
+        ----------
+        key : tuple
+            The cache key, parent id and threshold parameters.
+        generation : int
+            The current corpus generation.
+        compute : callable
+            Computes the result, called without arguments.
+
+        Returns
+        -------
+        list
+            The result.
+        """
+        result = self.get(key, generation)
+        if result is not None:
+            return result
+
+        with self.lock:
+            flight = self.inflight.get((key, generation))
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event(), 'result': None}
+                self.inflight[(key, generation)] = flight
+
+        if not leader:
+            metrics.registry.incr('analysis_cache_coalesced')
+            flight['done'].wait()
+            if flight['result'] is not None:
+                return flight['result']
+            # the leader failed, compute without coalescing
+            return compute()
+
+        try:
+            flight['result'] = compute()
+            self.put(key, generation, flight['result'])
+            return flight['result']
+        finally:
+            with self.lock:
+                del self.inflight[(key, generation)]
+            flight['done'].set()
@@ -6,7 +6,7 @@ import os
 from google.protobuf import text_format
 import numpy as np
 from PIL import Image
-import scipy.misc
+import img_util
 
 os.environ['GLOG_minloglevel'] = '2'  # Suppress most caffe output
 import caffe  # noqa
@@ -99,7 +99,7 @@ def load_image(path, height, width, mode='RGB'):
     Parameters
     ----------
     path : str
-        Path to an image on disk.
+        Path to an image on disk, or PIL Image object.
     width : int
         Resize dimension.        
     height : int
@@ -114,12 +114,11 @@ def load_image(path, height, width, mode='RGB'):
         (channels x width x height)
     """
     
-    image = Image.open(path)
+    image = img_util.open_if(path)
     image = image.convert(mode)
-    image = np.array(image)
     # squash
-    image = scipy.misc.imresize(image, (height, width), 'bilinear')
-    return image
+    image = image.resize((width, height), Image.BILINEAR)
+    return np.array(image)
 
 
 def forward_pass(images, net, transformer, batch_size=None):
@@ -157,7 +156,7 @@ def forward_pass(images, net, transformer, batch_size=None):
     dims = transformer.inputs['data'][1:]
 
     scores = None
-    for chunk in [caffe_images[x:x + batch_size] for x in xrange(0, len(caffe_images), batch_size)]:
+    for chunk in [caffe_images[x:x + batch_size] for x in range(0, len(caffe_images), batch_size)]:
         new_shape = (len(chunk),) + tuple(dims)
         if net.blobs['data'].data.shape != new_shape:
             net.blobs['data'].reshape(*new_shape)
@@ -208,7 +207,7 @@ def classify(net, transformer, image_files, labels_file=None, batch_size=None):
     transformer : caffe.io.Transformer
         A caffe.io.Transformer.
     image_files : List
-        List of paths to images.
+        List of paths to images, or PIL Image objects.
     labels_file : str, optional
         Path to a .txt file.
     batch_size : int, optional
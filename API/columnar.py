@@ -0,0 +1,304 @@
+"""Exports the feature store to a columnar file and imports such files, to move
+the corpus between environments or into analytics tools. Files ending in
+.parquet are written as Parquet, all others as Arrow IPC files. Requires
+pyarrow. Run from the API folder, e.g.:
+
+    $ python columnar.py export --database database.sqlite features.parquet
+    $ python columnar.py export --database database.sqlite --since 120000 new.arrow
+    $ python columnar.py import --database other.sqlite features.parquet new.arrow
+
+Each row is one subimage. The 64 bit hashes are 8 byte big endian binary
+columns, their hex form is the one of the API responses; the ratio hash is
+the packed binary of ratiohash.pack. The trigram sets of the texts are stored
+as text with their SimHash, their ids are assigned by each database. The pHashes of the variants and the
+rectangles of virtual subimages are columns of their subimage.
+
+Every export records a marker, the largest rowid of the exported subimages,
+in the file metadata and prints it. With --since <marker>, only the
+subimages added afterwards are exported. Features that backfill.py replaced
+in earlier rows are not exported again.
+
+The import adds the subimages in one transaction, ids that exist already are
+skipped. The corpus is then loaded from the database like at startup; with
+--index, it is published to the shared index of the workers of the API, see
+corpus.SharedIndex. Other workers see the subimages after their next reload.
+"""
+
+import argparse
+import struct
+import time
+
+import database
+import multihash
+import ratiohash
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# rows per record batch and Parquet row group
+CHUNK_SIZE = 50000
+
+# metadata key of the export marker
+MARKER_KEY = b'imageplag.marker'
+
+CROP_COLUMNS = ('crop_source', 'crop_x', 'crop_y', 'crop_w', 'crop_h')
+
+
+def schema(marker=None):
+    """Returns the Arrow schema of the exported files.
+
+    Parameters
+    ----------
+    marker : int, optional
+        The export marker, stored in the metadata.
+
+    Returns
+    -------
+    pyarrow.Schema
+        The schema.
+    """
+    hash_type = pa.binary(8)
+    fields = [pa.field('rowid', pa.int64(), nullable=False),
+              pa.field('id', pa.string(), nullable=False),
+              pa.field('parent', pa.string(), nullable=False)]
+    fields += [pa.field(name, hash_type) for name in multihash.HASHES]
+    fields += [pa.field('rhash', pa.binary()),
+               pa.field('text', pa.string()),
+               pa.field('trigrams', pa.string()),
+               pa.field('simhash', pa.int64()),
+               pa.field('is_bar', pa.int8()),
+               pa.field('is_pure', pa.int8())]
+    fields += [pa.field(name + '_version', pa.int32()) for name in database.FEATURES]
+    fields += [pa.field('variant_' + name, hash_type) for name in multihash.VARIANTS]
+    fields += [pa.field('crop_source', pa.string())]
+    fields += [pa.field(name, pa.int32()) for name in CROP_COLUMNS[1:]]
+    metadata = None if marker is None else {MARKER_KEY: str(marker).encode('ascii')}
+    return pa.schema(fields, metadata=metadata)
+
+
+def _hash_bytes(value):
+    """Converts a stored signed 64 bit hash to 8 big endian bytes."""
+    return None if value is None else struct.pack('>q', value)
+
+
+def _hash_value(data):
+    """Converts 8 big endian bytes back to a signed 64 bit hash."""
+    return None if data is None else struct.unpack('>q', data)[0]
+
+
+def _text(value):
+    """Returns a stored string as unicode, SQLite returns UTF-8 bytes in
+    Python 2."""
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _stored(value):
+    """Returns a string as stored by the API, UTF-8 bytes in Python 2."""
+    return value if value is None or isinstance(value, str) else value.encode('utf-8')
+
+
+def _batch(cursor, after, until, limit):
+    """Reads the next subimages with after < rowid <= until and returns them
+    as record batch, or None if there are none."""
+    rows = cursor.execute('''SELECT rowid, id, parent, phash, dhash, ahash, whash,
+    rhash, text, trigrams, simhash, is_bar, is_pure, class_version, rhash_version,
+    text_version, mhash_version FROM hashes WHERE rowid > ? AND rowid <= ?
+    ORDER BY rowid LIMIT ?''', (after, until, limit)).fetchall()
+    if not rows:
+        return None
+    last = rows[-1][0]
+    variants = {}
+    for rowid, name, value in cursor.execute('''SELECT hashes.rowid, variants.variant,
+    variants.phash FROM variants JOIN hashes ON variants.id = hashes.id
+    WHERE hashes.rowid > ? AND hashes.rowid <= ?''', (after, last)):
+        variants[rowid, name] = value
+    crops = {}
+    for row in cursor.execute('''SELECT hashes.rowid, crops.parent, crops.x, crops.y,
+    crops.w, crops.h FROM crops JOIN hashes ON crops.id = hashes.id
+    WHERE hashes.rowid > ? AND hashes.rowid <= ?''', (after, last)):
+        crops[row[0]] = row[1:]
+
+    columns = list(zip(*rows))
+    rowids = columns[0]
+    arrays = [pa.array(rowids, pa.int64()),
+              pa.array([_text(v) for v in columns[1]], pa.string()),
+              pa.array([_text(v) for v in columns[2]], pa.string())]
+    arrays += [pa.array([_hash_bytes(v) for v in column], pa.binary(8)) for column in columns[3:7]]
+    arrays += [pa.array([None if v is None else bytes(v) for v in columns[7]], pa.binary()),
+               pa.array([_text(v) for v in columns[8]], pa.string()),
+               pa.array([_text(v) for v in columns[9]], pa.string()),
+               pa.array(columns[10], pa.int64()),
+               pa.array(columns[11], pa.int8()),
+               pa.array(columns[12], pa.int8())]
+    arrays += [pa.array(column, pa.int32()) for column in columns[13:17]]
+    arrays += [pa.array([_hash_bytes(variants.get((rowid, name))) for rowid in rowids], pa.binary(8))
+               for name in multihash.VARIANTS]
+    no_crop = (None,) * len(CROP_COLUMNS)
+    crop_columns = list(zip(*[crops.get(rowid, no_crop) for rowid in rowids]))
+    arrays += [pa.array([_text(v) for v in crop_columns[0]], pa.string())]
+    arrays += [pa.array(column, pa.int32()) for column in crop_columns[1:]]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema())
+
+
+def export(db_handler, path, since=0):
+    """Writes the subimages added after a marker to a columnar file.
+
+    Parameters
+    ----------
+    db_handler : database.DBHandler
+        The database.
+    path : str
+        The file, Parquet if it ends in .parquet, else Arrow IPC.
+    since : int, optional
+        The marker of an earlier export, 0 exports all subimages.
+
+    Returns
+    -------
+    tuple
+        (rows, marker), the number of exported subimages and the marker of
+        this export.
+    """
+    with db_handler.lock:
+        marker = db_handler.cursor.execute('SELECT MAX(rowid) FROM hashes').fetchone()[0] or 0
+    marker = max(marker, since)
+    file_schema = schema(marker)
+    if path.endswith('.parquet'):
+        writer = pq.ParquetWriter(path, file_schema)
+        write = lambda batch: writer.write_table(pa.Table.from_batches([batch], schema=file_schema))
+    else:
+        writer = pa.ipc.new_file(path, file_schema)
+        write = writer.write_batch
+    rows = 0
+    after = since
+    try:
+        while True:
+            # the lock is released between batches for the API
+            with db_handler.lock:
+                batch = _batch(db_handler.cursor, after, marker, CHUNK_SIZE)
+            if batch is None:
+                break
+            write(batch)
+            rows += batch.num_rows
+            after = batch.column(0)[batch.num_rows - 1].as_py()
+    finally:
+        writer.close()
+    return rows, marker
+
+
+def _batches(path):
+    """Yields the record batches of a columnar file."""
+    if path.endswith('.parquet'):
+        parquet = pq.ParquetFile(path)
+        for i in range(parquet.num_row_groups):
+            for batch in parquet.read_row_group(i).to_batches():
+                yield batch
+    else:
+        reader = pa.ipc.open_file(path)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def _entries(batch):
+    """Converts a record batch to entries of database.DBHandler.add_entries."""
+    columns = dict((name, batch.column(i).to_pylist()) for i, name in enumerate(batch.schema.names))
+    entries = []
+    for i in range(batch.num_rows):
+        grams = columns['trigrams'][i]
+        rhash = columns['rhash'][i]
+        entry = {'id': _stored(columns['id'][i]), 'parent': _stored(columns['parent'][i]),
+                 'rhash': 'NA' if rhash is None else ratiohash.unpack(rhash),
+                 'text': _stored(columns['text'][i]) or '',
+                 'trigrams': None if grams is None else set(_stored(grams).split()),
+                 'simhash': columns['simhash'][i],
+                 'is_bar': columns['is_bar'][i], 'is_pure': columns['is_pure'][i],
+                 'versions': dict((name, columns[name + '_version'][i]) for name in database.FEATURES)}
+        for name in multihash.HASHES:
+            entry[name] = _hash_value(columns[name][i])
+        variants = dict((name, _hash_value(columns['variant_' + name][i])) for name in multihash.VARIANTS
+                        if columns['variant_' + name][i] is not None)
+        if variants:
+            entry['variants'] = variants
+        if columns['crop_source'][i] is not None:
+            entry['source'] = _stored(columns['crop_source'][i])
+            entry['rect'] = tuple(columns[name][i] for name in CROP_COLUMNS[1:])
+        entries.append(entry)
+    return entries
+
+
+def import_files(db_handler, paths):
+    """Adds the subimages of columnar files to the database in one
+    transaction and reloads the corpus.
+
+    Parameters
+    ----------
+    db_handler : database.DBHandler
+        The database, with the shared index of the API if it is published.
+    paths : list
+        The exported files.
+
+    Returns
+    -------
+    tuple
+        (added, skipped), the numbers of new subimages and of subimages whose
+        id exists already.
+    """
+    added = skipped = 0
+    with db_handler.bulk():
+        for path in paths:
+            for batch in _batches(path):
+                responses = db_handler.add_entries(_entries(batch))
+                new = sum(1 for response in responses if response.startswith('Success'))
+                added += new
+                skipped += len(responses) - new
+    db_handler.reload_db()
+    return added, skipped
+
+
+def marker(path):
+    """Returns the export marker of a columnar file."""
+    if path.endswith('.parquet'):
+        file_schema = pq.ParquetFile(path).schema.to_arrow_schema()
+    else:
+        file_schema = pa.ipc.open_file(path).schema
+    return int(file_schema.metadata[MARKER_KEY])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser('export', help='write the subimages to a columnar file')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--database', default='database.sqlite')
+    export_parser.add_argument('--since', type=int, default=0, help='marker of an earlier export')
+
+    import_parser = subparsers.add_parser('import', help='add the subimages of columnar files')
+    import_parser.add_argument('paths', nargs='+')
+    import_parser.add_argument('--database', default='database.sqlite')
+    import_parser.add_argument('--index', help='shared_index of the API')
+
+    marker_parser = subparsers.add_parser('marker', help='print the marker of an exported file')
+    marker_parser.add_argument('path')
+
+    args = parser.parse_args()
+    if pa is None:
+        parser.error('pyarrow is required')
+    start = time.time()
+    if args.command == 'export':
+        db_handler = database.DBHandler(args.database, load=False)
+        rows, last = export(db_handler, args.path, args.since)
+        print('%d rows exported in %.1f s, marker: %d' % (rows, time.time() - start, last))
+    elif args.command == 'import':
+        db_handler = database.DBHandler(args.database, load=False, index_path=args.index)
+        added, skipped = import_files(db_handler, args.paths)
+        print('%d rows imported, %d existing skipped in %.1f s' % (added, skipped, time.time() - start))
+    elif args.command == 'marker':
+        print(marker(args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,575 @@
+"""This module contains the in-memory corpus of the analysis, a read-only
+snapshot of the hashes table in columns. Hashes and flags are NumPy arrays,
+the variable length rhash and trigram ids are stored in one flat array each
+with offsets, ids and parents in string tables. The OCR texts are not loaded,
+the texts are compared by their trigram ids, and the match records do not
+contain them.
+
+The rows to compare with are selected by arrays of row numbers, e.g. from
+Corpus.rows_except. The eval methods return the suspicious matches as a small
+pandas DataFrame, which results.match_list accepts.
+
+A corpus can be saved as a snapshot file and attached through mmap. The worker
+processes of one database share the snapshots of a SharedIndex directory, so
+the corpus is held in memory once.
+"""
+
+import bisect
+import fcntl
+import json
+import mmap
+import numbers
+import os
+import struct
+import threading
+import numpy as np
+import pandas as pd
+import img_util
+import multihash
+import ocr
+import ratiohash
+
+
+# rows fetched from SQLite at once while loading
+CHUNK_SIZE = 50000
+
+# first bytes of a snapshot file, followed by the header length as uint64
+MAGIC = b'IPCORPUS'
+# the arrays in a snapshot file start at multiples of ALIGNMENT bytes
+ALIGNMENT = 64
+
+
+class StringTable(object):
+    """Immutable list of strings, stored as one byte string with offsets
+    instead of one Python object per string."""
+
+    def __init__(self, data, offsets):
+        # uint8 array, string i is data[offsets[i]:offsets[i + 1]]
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        s = self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+        return s if str is bytes else s.decode('utf-8')
+
+    def take(self, rows):
+        """Returns the strings of the given rows as a list."""
+        return [self[i] for i in rows]
+
+    def find(self, s):
+        """Returns the index of a string in a sorted table, or None."""
+        i = bisect.bisect_left(self, s)
+        if i < len(self) and self[i] == s:
+            return i
+        return None
+
+
+class Corpus(object):
+    """Columns of all subimages and their transformed variants. The rows are
+    ordered by parent, the subimages of a parent are contiguous."""
+
+    def __init__(self, arrays, variant_names):
+        # all columns by name, they may be read-only views of a snapshot file
+        self.arrays = arrays
+        self.ids = StringTable(arrays['ids'], arrays['id_offsets'])
+        # sorted parent ids, the parent of row i is parents[parent_codes[i]]
+        self.parents = StringTable(arrays['parents'], arrays['parent_offsets'])
+        self.parent_codes = arrays['parent_codes']
+        self.parent_starts = arrays['parent_starts']
+        self.phash = arrays['phash']
+        # the additional multihash hashes by name, 0 where has_mhash is False
+        self.hashes = dict((name, arrays[name]) for name in multihash.HASHES[1:])
+        self.has_mhash = arrays['has_mhash']
+        self.is_bar = arrays['is_bar']
+        self.is_pure = arrays['is_pure']
+        # bar heights of all rows in one array, -1 is the length of a missing rhash
+        self.rhash = arrays['rhash']
+        self.rhash_lengths = arrays['rhash_lengths']
+        self.rhash_starts = arrays['rhash_starts']
+        # sorted trigram ids of all rows in one array
+        self.trigram_ids = arrays['trigram_ids']
+        self.trigram_offsets = arrays['trigram_offsets']
+        self.n_trigrams = arrays['n_trigrams']
+        self.trigram_size = int(arrays['trigram_size'][0])
+        self.simhash = arrays['simhash']
+        # transformed variants, by row of the subimage and code in variant_names
+        self.variant_rows = arrays['variant_rows']
+        self.variant_codes = arrays['variant_codes']
+        self.variant_phash = arrays['variant_phash']
+        self.variant_names = variant_names
+
+    def __len__(self):
+        return len(self.phash)
+
+    @classmethod
+    def load(cls, cursor):
+        """Loads the corpus from the database in chunks. Each chunk is
+        converted to arrays, no Python objects are kept per row.
+
+        Parameters
+        ----------
+        cursor : sqlite3.Cursor
+            Cursor of the database, the caller must hold its lock.
+
+        Returns
+        -------
+        Corpus
+            The loaded corpus.
+        """
+        names = ['rowid', 'phash', 'is_bar', 'is_pure', 'simhash'] + list(multihash.HASHES[1:])
+        columns = dict((name, []) for name in names)
+        ids, parents, parent_codes, has_mhash = [], [], [], []
+        rhash, rhash_lengths, trigram_ids, trigram_lengths = [], [], [], []
+        last_parent = None
+        # the parent index returns the rows grouped and sorted by parent
+        cursor.execute('''SELECT %s, id, parent, rhash, trigram_ids FROM hashes
+        ORDER BY parent, rowid''' % ', '.join(names))
+        while True:
+            chunk = cursor.fetchmany(CHUNK_SIZE)
+            if not chunk:
+                break
+            for i, name in enumerate(names):
+                columns[name].append(np.array([row[i] or 0 for row in chunk], dtype=np.int64))
+            has_mhash.append(np.array([None not in row[5:len(names)] for row in chunk], dtype=bool))
+            ids.append(_encode([row[len(names)] for row in chunk]))
+
+            codes = np.zeros(len(chunk), dtype=np.int32)
+            new_parents = []
+            for i, row in enumerate(chunk):
+                if row[len(names) + 1] != last_parent:
+                    last_parent = row[len(names) + 1]
+                    new_parents.append(last_parent)
+                codes[i] = len(parents) + len(new_parents) - 1
+            parent_codes.append(codes)
+            parents.append(_encode(new_parents))
+
+            bars = [ratiohash.unpack(row[len(names) + 2]) for row in chunk]
+            rhash.append(_concat([b for b in bars if b is not None], np.uint16))
+            rhash_lengths.append(np.array([-1 if b is None else len(b) for b in bars], dtype=np.int32))
+            blobs = [b'' if row[len(names) + 3] is None else bytes(row[len(names) + 3]) for row in chunk]
+            trigram_ids.append(np.frombuffer(b''.join(blobs), dtype='<u4').astype(np.uint32))
+            trigram_lengths.append(np.array([len(blob) // 4 for blob in blobs], dtype=np.int32))
+        columns = dict((name, _concat(columns[name], np.int64)) for name in names)
+
+        # the variants reference their subimage by rowid
+        order = np.argsort(columns['rowid'])
+        variants = cursor.execute('''SELECT hashes.rowid, variants.variant, variants.phash
+        FROM variants JOIN hashes ON variants.id = hashes.id''').fetchall()
+        variant_names = sorted(set(v[1] for v in variants))
+        variant_code = dict((name, code) for code, name in enumerate(variant_names))
+        variant_rows = order[np.searchsorted(columns['rowid'], np.array([v[0] for v in variants], dtype=np.int64),
+                                             sorter=order)].astype(np.int32)
+        arrays = dict((name, columns[name]) for name in names[1:])
+        arrays['ids'], arrays['id_offsets'] = _join(ids)
+        arrays['parents'], arrays['parent_offsets'] = _join(parents)
+        arrays['parent_codes'] = _concat(parent_codes, np.int32)
+        arrays['parent_starts'] = np.searchsorted(arrays['parent_codes'],
+                                                  np.arange(len(arrays['parent_offsets'])))
+        arrays['has_mhash'] = _concat(has_mhash, bool)
+        arrays['is_bar'] = arrays['is_bar'] == 1
+        arrays['is_pure'] = arrays['is_pure'] == 1
+        arrays['rhash'] = _concat(rhash, np.uint16)
+        arrays['rhash_lengths'] = _concat(rhash_lengths, np.int32)
+        arrays['rhash_starts'] = _starts(np.maximum(arrays['rhash_lengths'], 0))
+        arrays['trigram_ids'] = _concat(trigram_ids, np.uint32)
+        arrays['n_trigrams'] = _concat(trigram_lengths, np.int32)
+        arrays['trigram_offsets'] = np.append(_starts(arrays['n_trigrams']), len(arrays['trigram_ids']))
+        arrays['trigram_size'] = np.array([arrays['trigram_ids'].max() + 1 if len(arrays['trigram_ids']) else 0],
+                                          dtype=np.int64)
+        arrays['variant_rows'] = variant_rows
+        arrays['variant_codes'] = np.array([variant_code[v[1]] for v in variants], dtype=np.int8)
+        arrays['variant_phash'] = np.array([v[2] for v in variants], dtype=np.int64)
+        return cls(arrays, variant_names)
+
+    @property
+    def nbytes(self):
+        """The memory used by the columns in bytes."""
+        return sum(a.nbytes for a in self.arrays.values())
+
+    def rows_of(self, parent):
+        """Returns the rows of the subimages of a parent."""
+        code = self.parents.find(parent)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.arange(self.parent_starts[code], self.parent_starts[code + 1])
+
+    def rows_except(self, parent):
+        """Returns the rows of all subimages of other parents."""
+        code = self.parents.find(parent)
+        if code is None:
+            return np.arange(len(self))
+        return np.concatenate([np.arange(self.parent_starts[code]),
+                               np.arange(self.parent_starts[code + 1], len(self))])
+
+    def record(self, i):
+        """Returns the columns of a row as a dictionary, the keys are those of
+        the hashes table, rhash and trigram_ids are decoded."""
+        record = {'id': self.ids[i], 'parent': self.parents[self.parent_codes[i]],
+                  'phash': int(self.phash[i]), 'is_bar': int(self.is_bar[i]),
+                  'is_pure': int(self.is_pure[i]), 'has_mhash': bool(self.has_mhash[i]),
+                  'n_trigrams': int(self.n_trigrams[i]), 'simhash': int(self.simhash[i])}
+        for name in multihash.HASHES[1:]:
+            record[name] = int(self.hashes[name][i])
+        length = self.rhash_lengths[i]
+        record['rhash'] = None if length < 0 else \
+            self.rhash[self.rhash_starts[i]:self.rhash_starts[i] + length]
+        record['trigram_ids'] = self.trigram_ids[self.trigram_offsets[i]:self.trigram_offsets[i + 1]]
+        return record
+
+    def _matches(self, name, rows, dist, thresh, threshold=1.0, variants=None):
+        """Evaluates the distances of the rows and returns the suspicious
+        matches as DataFrame, or an empty DataFrame."""
+        # the largest gap of eval_distances needs two distances at least
+        if len(dist) < 2:
+            print(name + ': Too few subimages to compare!')
+            return pd.DataFrame()
+        order = np.argsort(dist)
+        dist = dist[order]
+        match = img_util.eval_distances(dist, threshold=threshold)
+
+        if match[1] < thresh:
+            print(name + ': No suspicious matches found!')
+            return pd.DataFrame()
+
+        top = rows[order[:match[0]]]
+        df = pd.DataFrame({'id': self.ids.take(top),
+                           'parent': self.parents.take(self.parent_codes[top])},
+                           columns=['id', 'parent'])
+        if variants is not None:
+            df['variant'] = variants[order[:match[0]]]
+        df['score'] = match[1]
+
+        print(name + ': Suspicious matches found!')
+
+        return df
+
+    def _rows(self, rows):
+        return np.arange(len(self)) if rows is None else np.asarray(rows)
+
+    def eval_phash(self, phash, rows=None, thresh=0.01):
+        """Evaluates a pHash against the stored pHashes.
+
+        Parameters
+        ----------
+        phash
+            The pHash as hex string or signed 64 bit integer.
+        rows : np.ndarray, optional
+            The rows to compare with, all rows by default.
+        thresh : float, optional
+            The minimum score of suspicious matches.
+
+        Returns
+        -------
+        pandas DataFrame
+            The suspicious matches with the columns id, parent and score.
+        """
+        rows = self._rows(rows)
+        if not isinstance(phash, numbers.Integral):
+            phash = img_util.hash_to_int(phash)
+        return self._matches('phash', rows, img_util.hamming(self.phash[rows], phash), thresh)
+
+    def eval_mhash(self, hashes, rows=None, thresh=0.01):
+        """Evaluates all hashes of multihash together. The distance of each row
+        is the mean hamming distance over all hashes. For rows without the
+        additional hashes, only the phash is used.
+
+        Parameters
+        ----------
+        hashes : dict
+            Maps each name in multihash.HASHES to a hash, as hex string or
+            signed 64 bit integer.
+        rows : np.ndarray, optional
+            The rows to compare with, all rows by default.
+        thresh : float, optional
+            The minimum score of suspicious matches.
+
+        Returns
+        -------
+        pandas DataFrame
+            The suspicious matches with the columns id, parent and score.
+        """
+        rows = self._rows(rows)
+        hashes = [h if isinstance(h, numbers.Integral) else img_util.hash_to_int(h)
+                  for h in (hashes[name] for name in multihash.HASHES)]
+        dist = img_util.hamming(self.phash[rows], hashes[0]).astype(float)
+        has_mhash = self.has_mhash[rows]
+        for name, h in zip(multihash.HASHES[1:], hashes[1:]):
+            dist += np.where(has_mhash, img_util.hamming(self.hashes[name][rows], h), 0)
+        dist /= np.where(has_mhash, len(hashes), 1)
+        return self._matches('mhash', rows, dist, thresh)
+
+    def eval_variants(self, phash, rows=None, thresh=0.01):
+        """Evaluates the phash against the stored phashes and the pHashes of
+        the transformed variants in one pass. For each subimage the closest
+        variant counts.
+
+        Parameters
+        ----------
+        phash
+            The pHash as hex string or signed 64 bit integer.
+        rows : np.ndarray, optional
+            The rows to compare with, all rows by default.
+        thresh : float, optional
+            The minimum score of suspicious matches.
+
+        Returns
+        -------
+        pandas DataFrame
+            The suspicious matches with the columns id, parent, variant and
+            score. The variant is 'original' for untransformed matches.
+        """
+        rows = self._rows(rows)
+        if not isinstance(phash, numbers.Integral):
+            phash = img_util.hash_to_int(phash)
+
+        # stack original and variant hashes, code -1 is the original
+        selected = np.zeros(len(self), dtype=bool)
+        selected[rows] = True
+        variants = np.flatnonzero(selected[self.variant_rows])
+        all_rows = np.concatenate([rows, self.variant_rows[variants]])
+        codes = np.concatenate([np.full(len(rows), -1, dtype=np.int64), self.variant_codes[variants]])
+        dist = img_util.hamming(np.concatenate([self.phash[rows], self.variant_phash[variants]]), phash)
+        # keep the closest variant of each subimage
+        order = np.argsort(dist)
+        _, first = np.unique(all_rows[order], return_index=True)
+        keep = order[np.sort(first)]
+        names = np.array(['original'] + list(self.variant_names), dtype=object)
+        return self._matches('variants', all_rows[keep], dist[keep], thresh,
+                             variants=names[codes[keep] + 1])
+
+    def eval_rhash(self, rhash, rows=None, thresh=0.01):
+        """Evaluates a ratio hash against the stored ratio hashes.
+
+        Parameters
+        ----------
+        rhash
+            The ratio hash as string or unpacked array.
+        rows : np.ndarray, optional
+            The rows to compare with, all rows by default.
+        thresh : float, optional
+            The minimum score of suspicious matches.
+
+        Returns
+        -------
+        pandas DataFrame
+            The suspicious matches with the columns id, parent and score.
+        """
+        rows = self._rows(rows)
+        if not isinstance(rhash, np.ndarray):
+            rhash = ratiohash.unpack(ratiohash.pack(rhash))
+        dist = ratiohash.packed_distances(rhash, self.rhash, self.rhash_starts[rows], self.rhash_lengths[rows])
+        return self._matches('rhash', rows, dist, thresh)
+
+    def eval_text(self, fingerprint, rows=None, thresh=0.01, prefilter=None):
+        """Evaluates the trigram set of a text against the stored ones.
+
+        Parameters
+        ----------
+        fingerprint : tuple
+            (ids, n, simhash), see database.DBHandler.text_fingerprint.
+        rows : np.ndarray, optional
+            The rows to compare with, all rows by default.
+        thresh : float, optional
+            The minimum score of suspicious matches.
+        prefilter : int, optional
+            If given, only texts within this SimHash distance are compared.
+
+        Returns
+        -------
+        pandas DataFrame
+            The suspicious matches with the columns id, parent and score.
+        """
+        rows = self._rows(rows)
+        ids, n, simhash = fingerprint
+        compared = np.arange(len(rows))
+        if prefilter is not None and ids is not None:
+            # texts with distant SimHashes are not compared
+            compared = np.flatnonzero(img_util.hamming(self.simhash[rows], simhash) <= prefilter)
+        dist = np.full(len(rows), 10000.0)
+        dist[compared] = ocr.trigram_distances(ids, n, self.trigram_ids, self.trigram_offsets,
+                                               rows[compared], size=self.trigram_size)
+        return self._matches('text', rows, dist, thresh, threshold=2.0)
+
+
+def save(corpus, path):
+    """Writes a corpus to a snapshot file, see attach.
+
+    Parameters
+    ----------
+    corpus : Corpus
+        The corpus.
+    path : str
+        Path of the snapshot file.
+    """
+    header = {'variant_names': list(corpus.variant_names), 'arrays': {}}
+    offsets = {}
+    offset = 0
+    for name in sorted(corpus.arrays):
+        a = corpus.arrays[name]
+        header['arrays'][name] = [a.dtype.str, len(a), offset]
+        offsets[name] = offset
+        offset += _aligned(a.nbytes)
+    header = json.dumps(header).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name in sorted(corpus.arrays):
+            f.seek(start + offsets[name])
+            np.ascontiguousarray(corpus.arrays[name]).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def attach(path):
+    """Returns the corpus of a snapshot file. The arrays are read-only views
+    of a shared mmap of the file, which stays valid when the file is removed.
+
+    Parameters
+    ----------
+    path : str
+        Path of the snapshot file.
+
+    Returns
+    -------
+    Corpus
+        The corpus.
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a corpus snapshot: ' + path)
+    length = struct.unpack('<Q', mm[len(MAGIC):len(MAGIC) + 8])[0]
+    header = json.loads(mm[len(MAGIC) + 8:len(MAGIC) + 8 + length].decode('utf-8'))
+    start = _aligned(len(MAGIC) + 8 + length)
+    arrays = {}
+    for name, (dtype, count, offset) in header['arrays'].items():
+        dtype = np.dtype(str(dtype))
+        if count == 0:
+            arrays[str(name)] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[str(name)] = np.frombuffer(mm, dtype=dtype, count=count, offset=start + offset)
+    return Corpus(arrays, [str(name) for name in header['variant_names']])
+
+
+class SharedIndex(object):
+    """Directory of corpus snapshots, shared by the processes of one database.
+    A writer publishes a new generation by writing a snapshot file and then
+    replacing the CURRENT file, both by rename. Readers attach the current
+    generation read-only and see new generations on their next refresh.
+    Writers of several processes are serialized by a lock file."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.lock = threading.Lock()
+        self.lock_path = os.path.join(path, 'lock')
+        self.current_path = os.path.join(path, 'CURRENT')
+        # the attached generation and the stat of CURRENT it was read from
+        self.generation = 0
+        self.corpus = None
+        self.stamp = None
+
+    def current(self):
+        """Returns the description of the current generation, a dictionary
+        with the keys generation, name and source, or None."""
+        try:
+            with open(self.current_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def publish(self, build, source):
+        """Builds and publishes a new generation, unless the current one was
+        built from the same source. Then attaches the current generation.
+
+        Parameters
+        ----------
+        build : callable
+            Returns the new Corpus.
+        source : str
+            Describes the state of the database the corpus is built from.
+
+        Returns
+        -------
+        tuple
+            (generation, corpus), as returned by refresh.
+        """
+        with open(self.lock_path, 'a') as lock_file:
+            # released when the file is closed
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            current = self.current()
+            if current is None or current['source'] != source:
+                generation = 1 if current is None else current['generation'] + 1
+                name = 'corpus-%010d.snapshot' % generation
+                save(build(), os.path.join(self.path, name + '.tmp'))
+                os.rename(os.path.join(self.path, name + '.tmp'), os.path.join(self.path, name))
+                with open(self.current_path + '.tmp', 'w') as f:
+                    json.dump({'generation': generation, 'name': name, 'source': source}, f)
+                os.rename(self.current_path + '.tmp', self.current_path)
+                # attached readers keep the mappings of removed files
+                for other in os.listdir(self.path):
+                    if other.startswith('corpus-') and other != name:
+                        os.remove(os.path.join(self.path, other))
+                print('Published corpus generation %d' % generation)
+        return self.refresh()
+
+    def refresh(self):
+        """Attaches the current generation if it changed since the last call.
+
+        Returns
+        -------
+        tuple
+            (generation, corpus), (0, None) if nothing was published yet.
+        """
+        with self.lock:
+            for _ in range(10):
+                try:
+                    st = os.stat(self.current_path)
+                except OSError:
+                    break
+                stamp = (st.st_ino, st.st_mtime, st.st_size)
+                if stamp == self.stamp:
+                    break
+                current = self.current()
+                try:
+                    corpus = attach(os.path.join(self.path, current['name']))
+                except (IOError, OSError, TypeError):
+                    # replaced by a newer generation in the meantime
+                    continue
+                self.generation, self.corpus, self.stamp = current['generation'], corpus, stamp
+            return self.generation, self.corpus
+
+
+def _aligned(n):
+    """Rounds n up to a multiple of ALIGNMENT."""
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _starts(lengths):
+    """Returns the start of each segment of the given lengths."""
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], dtype=np.int64, out=starts[1:])
+    return starts
+
+
+def _encode(strings):
+    """Returns the strings as one utf-8 byte string and their lengths."""
+    encoded = [s if isinstance(s, bytes) else s.encode('utf-8') for s in strings]
+    return b''.join(encoded), np.array([len(s) for s in encoded], dtype=np.int64)
+
+
+def _join(chunks):
+    """Joins (data, lengths) chunks of _encode to the arrays of a
+    StringTable."""
+    lengths = _concat([lengths for _, lengths in chunks], np.int64)
+    data = np.frombuffer(b''.join(data for data, _ in chunks), dtype=np.uint8)
+    return data, np.append(_starts(lengths), lengths.sum())
+
+
+def _concat(arrays, dtype):
+    """Concatenates arrays, an empty list gives an empty array."""
+    return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.zeros(0, dtype=dtype)
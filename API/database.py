@@ -1,148 +1,539 @@
 import ratiohash
 import sqlite3
-import os
-import pandas as pd
-import imagehash
+import contextlib
+import threading
+import time
+import numbers
+import numpy as np
+import corpus
 import img_util
+import multihash
 import ocr
 
 
+# Version of the database schema, stored as PRAGMA user_version
+SCHEMA_VERSION = 8
+
+# Extracted features with an algorithm version, stored in <feature>_version
+FEATURES = ('class', 'rhash', 'text', 'mhash')
+
+# Pragmas applied to every connection
+PRAGMAS = ['PRAGMA journal_mode=WAL',
+           'PRAGMA synchronous=NORMAL',
+           'PRAGMA temp_store=MEMORY',
+           'PRAGMA cache_size=-65536',
+           'PRAGMA mmap_size=268435456']
+
+
+def _schema_v1(cursor):
+    """The original schema, hashes are stored as hex strings."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS
+    hashes(id TEXT, parent TEXT, phash TEXT, rhash TEXT, text TEXT,
+    is_bar INTEGER, is_pure INTEGER, UNIQUE(id))''')
+
+
+def _schema_v2(cursor):
+    """Stores the phash as 64 bit integer, the rhash as packed uint16 values
+    and the trigrams of the text. Adds an index on parent."""
+    cursor.execute('''CREATE TABLE hashes_v2(id TEXT, parent TEXT,
+    phash INTEGER, rhash BLOB, text TEXT, trigrams TEXT, n_trigrams INTEGER,
+    is_bar INTEGER, is_pure INTEGER, UNIQUE(id))''')
+    rows = cursor.execute('''SELECT id, parent, phash, rhash, text, is_bar,
+    is_pure FROM hashes''').fetchall()
+    cursor.executemany('''INSERT INTO hashes_v2(id, parent, phash, rhash, text,
+    trigrams, n_trigrams, is_bar, is_pure) VALUES(?,?,?,?,?,?,?,?,?)''',
+                       [[id, parent, img_util.hash_to_int(phash),
+                         _blob(ratiohash.pack(rhash)), text]
+                        + _trigram_columns(ocr.trigrams(text)) + [is_bar, is_pure]
+                        for id, parent, phash, rhash, text, is_bar, is_pure in rows])
+    cursor.execute('DROP TABLE hashes')
+    cursor.execute('ALTER TABLE hashes_v2 RENAME TO hashes')
+    cursor.execute('CREATE INDEX hashes_parent ON hashes(parent)')
+
+
+def _schema_v3(cursor):
+    """Adds the additional perceptual hashes of multihash. Existing rows keep
+    NULL until they are recomputed."""
+    for name in multihash.HASHES[1:]:
+        cursor.execute('ALTER TABLE hashes ADD COLUMN %s INTEGER' % name)
+
+
+def _schema_v4(cursor):
+    """Adds the pHashes of transformed variants of the subimages."""
+    cursor.execute('''CREATE TABLE variants(id TEXT, variant TEXT,
+    phash INTEGER, UNIQUE(id, variant))''')
+
+
+def _schema_v5(cursor):
+    """Adds the bounding rectangles of virtual subimages on their parent."""
+    cursor.execute('''CREATE TABLE crops(id TEXT, parent TEXT,
+    x INTEGER, y INTEGER, w INTEGER, h INTEGER, UNIQUE(id))''')
+
+
+def _schema_v6(cursor):
+    """Interns the trigrams, and stores the trigram set of each text as
+    sorted ids with its SimHash."""
+    cursor.execute('CREATE TABLE trigram_ids(id INTEGER PRIMARY KEY, trigram TEXT, UNIQUE(trigram))')
+    cursor.execute('ALTER TABLE hashes ADD COLUMN trigram_ids BLOB')
+    cursor.execute('ALTER TABLE hashes ADD COLUMN simhash INTEGER')
+    ids = {}
+    rows = cursor.execute('SELECT id, trigrams FROM hashes WHERE trigrams IS NOT NULL').fetchall()
+    for id, grams in rows:
+        cursor.execute('UPDATE hashes SET trigram_ids=?, simhash=? WHERE id=?',
+                       _fingerprint_columns(cursor, ids, set(grams.split())) + [id])
+
+
+def _schema_v7(cursor):
+    """Adds the algorithm version of each feature. Existing rows were computed
+    with version 1, rows without multihash have mhash_version 0."""
+    for name in FEATURES:
+        cursor.execute('ALTER TABLE hashes ADD COLUMN %s_version INTEGER' % name)
+    cursor.execute('''UPDATE hashes SET class_version=1, rhash_version=1, text_version=1,
+    mhash_version=CASE WHEN dhash IS NULL THEN 0 ELSE 1 END''')
+
+
+def _schema_v8(cursor):
+    """Adds the results of the corpus-wide sweeps, see sweep.py."""
+    cursor.execute('''CREATE TABLE sweeps(id INTEGER PRIMARY KEY, source TEXT,
+    params TEXT, started REAL, finished REAL, parents INTEGER, done INTEGER)''')
+    cursor.execute('''CREATE TABLE sweep_pairs(sweep INTEGER, id TEXT, parent TEXT,
+    match TEXT, match_parent TEXT, modality TEXT, score REAL,
+    UNIQUE(sweep, id, match, modality))''')
+    cursor.execute('''CREATE TABLE sweep_clusters(sweep INTEGER, cluster INTEGER,
+    id TEXT, parent TEXT, UNIQUE(sweep, id))''')
+
+
+# Schema migrations, the n-th entry migrates from user_version n to n + 1
+MIGRATIONS = [_schema_v1, _schema_v2, _schema_v3, _schema_v4, _schema_v5, _schema_v6,
+              _schema_v7, _schema_v8]
+
+
+def _blob(value):
+    """Wraps a binary string for SQLite, passes None."""
+    if value is None:
+        return None
+    return sqlite3.Binary(value)
+
+
+def _hash_column(h):
+    """Returns the column value of an optional 64 bit hash."""
+    if h is None:
+        return None
+    if isinstance(h, numbers.Integral):
+        return int(h)
+    return img_util.hash_to_int(h)
+
+
+def _trigram_columns(grams):
+    """Returns the values of the trigrams and n_trigrams columns."""
+    if grams is None:
+        return [None, 0]
+    return [' '.join(sorted(grams)), len(grams)]
+
+
+def _intern(cursor, ids, grams):
+    """Returns the sorted ids of the n-grams, new n-grams are added to the
+    trigram_ids table and to ids, the dictionary of the known ids."""
+    for gram in grams:
+        if gram not in ids:
+            # another process may have added the n-gram in the meantime
+            cursor.execute('INSERT OR IGNORE INTO trigram_ids(trigram) VALUES(?)', (gram,))
+            if cursor.rowcount == 1:
+                ids[gram] = cursor.lastrowid
+            else:
+                ids[gram] = cursor.execute('SELECT id FROM trigram_ids WHERE trigram=?',
+                                           (gram,)).fetchone()[0]
+    return np.array(sorted(ids[gram] for gram in grams), dtype=np.uint32)
+
+
+def _fingerprint_columns(cursor, ids, grams, simhash=None):
+    """Returns the values of the trigram_ids and simhash columns. The SimHash
+    is computed unless it is given."""
+    if grams is None:
+        return [None, None]
+    if simhash is None:
+        simhash = ocr.simhash(grams)
+    return [_blob(_intern(cursor, ids, grams).astype('<u4').tobytes()), simhash]
+
+
 class DBHandler(object):
 
-    def __init__(self, database_path):
+    def __init__(self, database_path, group_commit=0.0, text_prefilter=None, load=True,
+                 index_path=None):
         self.database_path = database_path
+        # maximum SimHash distance of texts that are compared, None compares all
+        self.text_prefilter = text_prefilter
+        # commit window in seconds for concurrent writers, 0 commits each batch
+        self.group_commit = group_commit
+        self.group_lock = threading.Lock()
+        self.group_pending = []
+        self.group_leader = False
+        self.bulk_mode = False
+        # corpus generation, bumped whenever rows are added or reloaded
+        self._generation = 0
+        # snapshots of the corpus shared with other processes, see corpus.SharedIndex
+        self.index = None if index_path is None else corpus.SharedIndex(index_path)
 
         # connect to database, create if not exists
-        self.db = sqlite3.connect(self.database_path)
+        # the connection is shared between threads, guarded by lock
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.database_path, check_same_thread=False)
         self.db.text_factory = str
         self.cursor = self.db.cursor()
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS
-        hashes(id TEXT, parent TEXT, phash TEXT, rhash TEXT, text TEXT,
-        is_bar INTEGER, is_pure INTEGER, UNIQUE(id))''')
-
-        # load db into pandas
-        self.df = pd.read_sql_query("SELECT * from hashes", self.db)
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
+        self.migrate()
+        self.load_trigram_ids()
+
+        # load db into memory, tools that only write can skip it
+        self._corpus = None
+        if load:
+            self.reload_db()
+
+    @property
+    def generation(self):
+        """The corpus generation. With a shared index, it is the generation of
+        the attached snapshot, which is updated first."""
+        if self.index is not None:
+            return self.index.refresh()[0]
+        return self._generation
+
+    @property
+    def corpus(self):
+        """The current corpus.Corpus, None if it was not loaded."""
+        if self.index is not None:
+            return self.index.refresh()[1]
+        return self._corpus
+
+    def current(self):
+        """Returns (generation, corpus), the current corpus.Corpus with its
+        generation, read together."""
+        if self.index is not None:
+            return self.index.refresh()
+        with self.lock:
+            return self._generation, self._corpus
+
+    def migrate(self):
+        """Migrates the database to the current schema version. Each migration
+        runs in its own transaction."""
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        # sqlite3 does not open transactions for DDL statements, and commits
+        # before them in Python 2. The transactions are explicit in autocommit
+        # mode, so a failed migration leaves the previous version.
+        isolation_level, self.db.isolation_level = self.db.isolation_level, None
+        try:
+            for i in range(version, SCHEMA_VERSION):
+                print('Migrating database to schema version ' + str(i + 1))
+                self.cursor.execute('BEGIN')
+                try:
+                    MIGRATIONS[i](self.cursor)
+                    self.cursor.execute('PRAGMA user_version=%d' % (i + 1))
+                    self.cursor.execute('COMMIT')
+                except BaseException:
+                    self.cursor.execute('ROLLBACK')
+                    raise
+        finally:
+            self.db.isolation_level = isolation_level
+
+    def load_trigram_ids(self):
+        """Loads the interned trigram ids. Called after a rollback, which may
+        have discarded new ids."""
+        with self.lock:
+            self.trigram_ids = dict(self.cursor.execute('SELECT trigram, id FROM trigram_ids'))
 
     # the DBHandler will response for each action with an information string
     # the final result should always begin with: "Success" / "Duplicate" / "Error"
     # return should look like: "<response type>: <message>"
-    def add_entry(self, id, parent, phash, rhash, text, is_bar, is_pure):
-
-        # test, if id exists
-        for row in self.cursor.execute("SELECT * FROM hashes WHERE id=?", (id, )):
-            print("ID already exists!")
-            return "Duplicate: ID already exists!"
-
+    def add_entry(self, id, parent, phash, rhash, text, is_bar, is_pure, **hashes):
+        entry = dict(hashes, id=id, parent=parent, phash=phash, rhash=rhash,
+                     text=text, is_bar=is_bar, is_pure=is_pure)
+        return self.add_entries([entry])[0]
+
+    def add_entries(self, entries):
+        """Adds a batch of entries in a single transaction. Duplicates are
+        detected by the UNIQUE constraint on id.
+
+        Parameters
+        ----------
+        entries : list
+            Dictionaries with the keys id, parent, phash, rhash, text, is_bar
+            and is_pure, as passed to add_entry. The additional hashes of
+            multihash (dhash, ahash, whash) are optional, as is trigrams, the
+            trigram set of the text if it was computed already, with simhash,
+            its SimHash, variants, a
+            dictionary that maps the names of multihash.VARIANTS to pHashes,
+            rect, the bounding rectangle (x, y, w, h) of a virtual subimage
+            on its parent, or on source, the id of the page of the parent it
+            was cropped from, and versions, a dictionary that maps FEATURES to
+            the version they were extracted with.
+
+        Returns
+        -------
+        list
+            The response string of each entry, same as add_entry.
+        """
+        if self.group_commit > 0 and not self.bulk_mode:
+            return self._group_write(entries)
+        with self.lock:
+            return self._write(entries, commit=not self.bulk_mode)
+
+    @contextlib.contextmanager
+    def bulk(self):
+        """Context manager for bulk loading. All entries added inside the
+        context are committed in one transaction when the context exits."""
+        with self.lock:
+            self.bulk_mode = True
+            try:
+                yield self
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                self.load_trigram_ids()
+                raise
+            finally:
+                self.bulk_mode = False
+
+    def _write(self, entries, commit=True):
+        """Inserts the entries and returns the response of each entry. The
+        caller must hold the lock."""
+        responses = []
         try:
-            self.cursor.execute('''INSERT OR REPLACE INTO
-                            hashes(id, parent, phash, rhash, text, is_bar,
-                            is_pure)
-                            VALUES(?,?,?,?,?,?,?)''',
-                           [id,
-                            parent,
-                            phash,
-                            rhash,
-                            text,
-                            is_bar,
-                            is_pure])
-            self.db.commit()
-        except KeyboardInterrupt:
-            raise
+            for entry in entries:
+                grams = entry['trigrams'] if 'trigrams' in entry else ocr.trigrams(entry['text'])
+                self.cursor.execute('''INSERT OR IGNORE INTO
+                                hashes(id, parent, phash, rhash, text, trigrams,
+                                n_trigrams, is_bar, is_pure, dhash, ahash, whash,
+                                trigram_ids, simhash, class_version, rhash_version,
+                                text_version, mhash_version)
+                                VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                                    [entry['id'],
+                                     entry['parent'],
+                                     _hash_column(entry['phash']),
+                                     _blob(ratiohash.pack(entry['rhash'])),
+                                     entry['text']]
+                                    + _trigram_columns(grams)
+                                    + [entry['is_bar'],
+                                       entry['is_pure']]
+                                    + [_hash_column(entry.get(name))
+                                       for name in multihash.HASHES[1:]]
+                                    + _fingerprint_columns(self.cursor, self.trigram_ids, grams,
+                                                           entry.get('simhash'))
+                                    + [entry.get('versions', {}).get(name) for name in FEATURES])
+                if self.cursor.rowcount == 1:
+                    if entry.get('variants'):
+                        self.cursor.executemany('''INSERT OR IGNORE INTO
+                                        variants(id, variant, phash)
+                                        VALUES(?,?,?)''',
+                                                [(entry['id'], name, _hash_column(h))
+                                                 for name, h in entry['variants'].items()])
+                    if entry.get('rect'):
+                        self.cursor.execute('''INSERT OR IGNORE INTO
+                                        crops(id, parent, x, y, w, h)
+                                        VALUES(?,?,?,?,?,?)''',
+                                            [entry['id'], entry.get('source', entry['parent'])]
+                                            + list(entry['rect']))
+                    responses.append("Success: Image added to database.")
+                else:
+                    print("ID already exists!")
+                    responses.append("Duplicate: ID already exists!")
+            if commit:
+                self.db.commit()
+            if "Success: Image added to database." in responses:
+                self._generation += 1
         except sqlite3.Error as er:
-            print 'Error:', er.message
-            return "Error: " + er.message
+            # in bulk mode the transaction is rolled back by bulk
+            if not commit:
+                raise
+            self.db.rollback()
+            self.load_trigram_ids()
+            print('Error: ' + str(er))
+            return ["Error: " + str(er)] * len(entries)
+        except BaseException:
+            # e.g. an invalid entry, the rows before it must not be committed
+            # with the next write
+            if commit:
+                self.db.rollback()
+                self.load_trigram_ids()
+            raise
 
-        return "Success: Image added to database."
+        return responses
+
+    def _group_write(self, entries):
+        """Queues the entries for the next group commit. The first writer of a
+        group waits for the commit window, then writes the entries of all
+        writers that arrived in the meantime in one transaction. If the write
+        fails, every writer of the group raises its exception."""
+        batch = {'entries': entries, 'done': threading.Event(), 'error': None}
+        with self.group_lock:
+            self.group_pending.append(batch)
+            leader = not self.group_leader
+            self.group_leader = True
+
+        if leader:
+            time.sleep(self.group_commit)
+            with self.group_lock:
+                pending, self.group_pending = self.group_pending, []
+                self.group_leader = False
+            try:
+                with self.lock:
+                    responses = self._write([entry for b in pending for entry in b['entries']])
+            except BaseException as error:
+                for b in pending:
+                    b['error'] = error
+                    b['done'].set()
+                raise
+            for b in pending:
+                n = len(b['entries'])
+                b['responses'], responses = responses[:n], responses[n:]
+                b['done'].set()
+
+        batch['done'].wait()
+        if batch['error'] is not None:
+            raise batch['error']
+        return batch['responses']
+
+    def update_features(self, updates):
+        """Replaces the features of stored subimages in one transaction, e.g.
+        features that were extracted again with a new algorithm version.
+
+        Parameters
+        ----------
+        updates : list
+            Dictionaries with the key id and any of the keys is_bar, is_pure,
+            rhash, text, the hashes of multihash and variants, as in
+            add_entries. The key versions maps the updated FEATURES to their
+            version.
+
+        Returns
+        -------
+        int
+            The number of updated rows.
+        """
+        with self.lock:
+            try:
+                for update in updates:
+                    columns, values = [], []
+                    for name in ('is_bar', 'is_pure'):
+                        if name in update:
+                            columns.append(name)
+                            values.append(update[name])
+                    for name in multihash.HASHES:
+                        if name in update:
+                            columns.append(name)
+                            values.append(_hash_column(update[name]))
+                    if 'rhash' in update:
+                        columns.append('rhash')
+                        values.append(_blob(ratiohash.pack(update['rhash'])))
+                    if 'text' in update:
+                        grams = ocr.trigrams(update['text'])
+                        columns.extend(['text', 'trigrams', 'n_trigrams', 'trigram_ids', 'simhash'])
+                        values.extend([update['text']] + _trigram_columns(grams)
+                                      + _fingerprint_columns(self.cursor, self.trigram_ids, grams))
+                    for name, version in update.get('versions', {}).items():
+                        columns.append(name + '_version')
+                        values.append(version)
+                    if columns:
+                        self.cursor.execute('UPDATE hashes SET %s WHERE id=?'
+                                            % ', '.join(c + '=?' for c in columns),
+                                            values + [update['id']])
+                    if update.get('variants'):
+                        self.cursor.executemany('''INSERT OR REPLACE INTO
+                                        variants(id, variant, phash)
+                                        VALUES(?,?,?)''',
+                                                [(update['id'], name, _hash_column(h))
+                                                 for name, h in update['variants'].items()])
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                self.load_trigram_ids()
+                raise
+            self._generation += 1
+        return len(updates)
+
+    def get_crop(self, id):
+        """Returns the parent and the bounding rectangle of a virtual
+        subimage.
+
+        Parameters
+        ----------
+        id : str
+            The id of the subimage.
+
+        Returns
+        -------
+        tuple
+            (parent, (x, y, w, h)), or None if the subimage is not virtual.
+        """
+        with self.lock:
+            row = self.cursor.execute('SELECT parent, x, y, w, h FROM crops WHERE id=?', (id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], tuple(row[1:])
 
     def reload_db(self):
-        # reload db into pandas
-        self.df = pd.read_sql_query("SELECT * from hashes", self.db)
-
-    def eval_phash(self, phash, df=None, thresh=0.01):
-        if df is None:
-            df = self.df.copy(deep=False)
-
-        # drop unused columns
-        df = df.loc[:, ["id", "parent", "phash"]]
-
-        # add distance column to dataframe
-        df['dist'] = ""
-
-        phash = imagehash.hex_to_hash(phash)
-        for index, row in df.iterrows():
-            h2 = imagehash.hex_to_hash(row['phash'])
-            dist = h2 - phash
-            row.dist = dist
-        df = df.sort_values(['dist'])
-
-        match = img_util.eval_distances(df.dist)
-
-        if match[1] < thresh:
-            print('phash: No suspicious matches found!')
-            return pd.DataFrame()
-        else:
-            df = df.head(match[0])
-            df['score'] = match[1]
-            df = df.loc[:, ['id', 'parent', 'score']]
-
-        print('phash: Suspicious matches found!')
-
-        return df
-
-    def eval_rhash(self, rhash, df=None, thresh=0.01):
-        if df is None:
-            df = self.df.copy(deep=False)
-
-        # drop unused columns
-        df = df.loc[:, ["id", "parent", "rhash"]]
-
-        # add distance column to dataframe
-        df['dist'] = ""
-
-        for index, row in df.iterrows():
-            dist = ratiohash.distance(rhash, row['rhash'])
-            row.dist = dist
-        df = df.sort_values(['dist'])
-
-        match = img_util.eval_distances(df.dist)
-
-        if match[1] < thresh:
-            print('rhash: No suspicious matches found!')
-            return pd.DataFrame()
-        else:
-            df = df.head(match[0])
-            df['score'] = match[1]
-            df = df.loc[:, ['id', 'parent', 'score']]
-
-        print('rhash: Suspicious matches found!')
-
-        return df
-
-    def eval_text(self, text, df=None, thresh=0.01):
-        if df is None:
-            df = self.df.copy(deep=False)
-
-        # drop unused columns
-        df = df.loc[:, ["id", "parent", "text"]]
-
-        # add distance column to dataframe
-        df['dist'] = ""
-
-        for index, row in df.iterrows():
-            dist = ocr.distance(text, row['text'])
-            row.dist = dist
-        df = df.sort_values(['dist'])
-
-        match = img_util.eval_distances(df.dist, threshold=2.0)
-
-        if match[1] < thresh:
-            print('text: No suspicious matches found!')
-            return pd.DataFrame()
-        else:
-            df = df.head(match[0])
-            df['score'] = match[1]
-            df = df.loc[:, ['id', 'parent', 'score']]
-
-        print('text: Suspicious matches found!')
-
-        return df
+        # reload db into a columnar corpus, with the variant hashes
+        with self.lock:
+            # other processes may have added trigrams, e.g. backfill.py
+            self.load_trigram_ids()
+            if self.index is None:
+                self._corpus = corpus.Corpus.load(self.db.cursor())
+                self._generation += 1
+                return
+            source = self.source()
+        # only one process builds each generation, the others attach it
+        self.index.publish(self.build_corpus, source)
+
+    def build_corpus(self):
+        """Returns a new corpus.Corpus of the database."""
+        with self.lock:
+            return corpus.Corpus.load(self.db.cursor())
+
+    def source(self):
+        """Returns a description of the database content that changes with
+        every added row and every backfill update, see corpus.SharedIndex."""
+        with self.lock:
+            row = self.cursor.execute('''SELECT COUNT(*), MAX(rowid),
+            TOTAL(IFNULL(class_version, 0) + IFNULL(rhash_version, 0) +
+            IFNULL(text_version, 0) + IFNULL(mhash_version, 0)) FROM hashes''').fetchone()
+            variants = self.cursor.execute('SELECT COUNT(*) FROM variants').fetchone()[0]
+        return '%d:%d:%d:%d' % (row[0], row[1] or 0, row[2], variants)
+
+    def eval_phash(self, phash, thresh=0.01):
+        return self.corpus.eval_phash(phash, thresh=thresh)
+
+    def eval_mhash(self, hashes, thresh=0.01):
+        return self.corpus.eval_mhash(hashes, thresh=thresh)
+
+    def eval_variants(self, phash, thresh=0.01):
+        return self.corpus.eval_variants(phash, thresh=thresh)
+
+    def eval_rhash(self, rhash, thresh=0.01):
+        return self.corpus.eval_rhash(rhash, thresh=thresh)
+
+    def text_fingerprint(self, text):
+        """Returns the trigram set of a text as interned ids.
+
+        Parameters
+        ----------
+        text : str
+            The text, as returned by ocr.ocr.
+
+        Returns
+        -------
+        tuple
+            (ids, n, simhash), the sorted ids of the trigrams that occur in
+            the database, the number of all trigrams and their SimHash. ids
+            is None if the text has no trigrams.
+        """
+        grams = ocr.trigrams(text)
+        if grams is None:
+            return None, 0, 0
+        ids = self.trigram_ids
+        known = sorted(ids[gram] for gram in grams if gram in ids)
+        return np.array(known, dtype=np.uint32), len(grams), ocr.simhash(grams)
+
+    def eval_text(self, text, thresh=0.01, fingerprint=None):
+        # the trigram sets of the stored texts are precomputed as ids
+        if fingerprint is None:
+            fingerprint = self.text_fingerprint(text)
+        return self.corpus.eval_text(fingerprint, thresh=thresh, prefilter=self.text_prefilter)
@@ -0,0 +1,116 @@
+"""This module runs the evaluations of an analysis. The evaluations of the
+subimages of a document and of their modalities are independent of each other.
+They run one after another by default. With a thread pool, they run in
+parallel, since the NumPy kernels of the corpus release the GIL. The text
+evaluations can also run in a process pool, whose processes attach the shared
+index of the corpus, see corpus.SharedIndex.
+"""
+
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+import corpus
+
+
+# state of a text process, set by _init_text_worker
+_worker = {}
+
+
+def _init_text_worker(index_path):
+    """Opens the shared index in a text process."""
+    _worker['index'] = corpus.SharedIndex(index_path)
+
+
+def _eval_text(generation, parent, fingerprint, kwargs):
+    """Evaluates a text in a text process against the subimages of all other
+    parents, in the given generation of the shared index. Returns None if the
+    process attached another generation."""
+    attached, current = _worker['index'].refresh()
+    if attached != generation:
+        return None
+    return current.eval_text(fingerprint, current.rows_except(parent), **kwargs)
+
+
+class Evaluator(object):
+    """Runs the evaluations of analyses.
+
+    Parameters
+    ----------
+    threads : int, optional
+        Size of the thread pool shared by all requests, 0 runs the evaluations
+        sequentially in the thread of the request.
+    concurrency : int, optional
+        The maximum number of evaluations of one request that run at the same
+        time in the thread pool.
+    text_processes : int, optional
+        Size of the process pool for text evaluations, 0 evaluates texts in
+        the thread pool. Requires index_path.
+    index_path : str, optional
+        The directory of the shared index, see corpus.SharedIndex.
+    """
+
+    def __init__(self, threads=0, concurrency=8, text_processes=0, index_path=None):
+        self.concurrency = max(1, concurrency)
+        self.pool = ThreadPool(threads) if threads > 0 else None
+        self.text_pool = None
+        if text_processes > 0:
+            if index_path is None:
+                raise ValueError('text_processes requires a shared index')
+            self.text_pool = multiprocessing.Pool(text_processes, initializer=_init_text_worker,
+                                                  initargs=(index_path,))
+
+    def eval_text(self, snapshot, generation, parent, fingerprint, rows, **kwargs):
+        """Evaluates a text against the given rows of snapshot, the corpus of
+        the given generation. With the process pool, it is evaluated there
+        against all subimages of other parents than parent, unless the
+        process attached another generation of the shared index."""
+        if self.text_pool is not None:
+            found = self.text_pool.apply(_eval_text, (generation, parent, fingerprint, kwargs))
+            if found is not None:
+                return found
+        return snapshot.eval_text(fingerprint, rows, **kwargs)
+
+    def run(self, subimages):
+        """Runs the evaluations of the subimages of one request.
+
+        Parameters
+        ----------
+        subimages : iterable
+            (record, jobs) for each subimage. jobs is a list of
+            (name, func, args, kwargs), the evaluations of the subimage.
+
+        Returns
+        -------
+        generator
+            Yields (record, results) for each subimage in the given order, as
+            soon as its evaluations are done. results maps the name of each
+            job to the return value of func.
+        """
+        if self.pool is None:
+            for record, jobs in subimages:
+                yield record, dict((name, func(*args, **kwargs)) for name, func, args, kwargs in jobs)
+            return
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+
+        def call(func, args, kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                slots.release()
+
+        pending = []
+        for record, jobs in subimages:
+            submitted = []
+            for name, func, args, kwargs in jobs:
+                # wait for a slot of this request
+                slots.acquire()
+                submitted.append((name, self.pool.apply_async(call, (func, args, kwargs))))
+            pending.append((record, submitted))
+            # yield the finished subimages without waiting for the others
+            while pending and all(result.ready() for _, result in pending[0][1]):
+                record, submitted = pending.pop(0)
+                yield record, dict((name, result.get()) for name, result in submitted)
+        for record, submitted in pending:
+            yield record, dict((name, result.get()) for name, result in submitted)
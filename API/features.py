@@ -0,0 +1,109 @@
+"""Extracts the features of images the way the API does at upload, so clients
+can search the corpus without uploading the images, see search.py. Requires
+NumPy, SciPy, OpenCV, PIL and, for the texts, Tesseract, but neither Caffe nor
+falcon. Run from the API folder, e.g.:
+
+    $ python features.py --crop figure.png > queries.json
+    $ curl -X POST --data @queries.json 'localhost:5000/search'
+
+The API computes ratio hashes only of bar charts and texts only of images
+that are not pure, as decided by its classifiers. Without them, both are
+extracted from every image unless disabled with --no-rhash or --no-text.
+"""
+
+import argparse
+import json
+import os
+
+import blobcrop
+import img_util
+import multihash
+import ocr
+import ratiohash
+
+
+def versions(regions=False):
+    """Returns the versions of the extracted features, as sent in the
+    versions of a query."""
+    return {'mhash': multihash.VERSION, 'rhash': ratiohash.VERSION, 'text': ocr.version(regions)}
+
+
+def extract(img, id=None, rhash=True, text=True, regions=False):
+    """Extracts the features of one image as a search query.
+
+    Parameters
+    ----------
+    img
+        Path to the image or PIL Image object.
+    id : str, optional
+        The id of the query.
+    rhash : bool, optional
+        If True, the ratio hash is extracted.
+    text : bool, optional
+        If True, the text is recognized.
+    regions : bool, optional
+        If True, only the text regions are recognized, see ocr.ocr. Must
+        match the ocr_regions setting of the API.
+
+    Returns
+    -------
+    dict
+        The query with id, the hashes of multihash as hex strings, rhash,
+        text and versions.
+    """
+    hashes = multihash.extract([img])
+    query = dict((name, img_util.int_to_hash(hashes[name][0])) for name in multihash.HASHES)
+    if id is not None:
+        query['id'] = id
+    if rhash:
+        try:
+            query['rhash'] = ratiohash.get_hash(img) or 'NA'
+        except ValueError:
+            # no bars found
+            query['rhash'] = 'NA'
+    if text:
+        query['text'] = ocr.ocr(img, regions=regions)
+    query['versions'] = versions(regions)
+    return query
+
+
+def queries(paths, crop=False, **kwargs):
+    """Yields the queries of images one at a time.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the images.
+    crop : bool, optional
+        If True, the subimages found by blobcrop.crop_to_blob are queried
+        after each image, with the ids <name>-<number> as at upload.
+    kwargs
+        The options of extract.
+
+    Returns
+    -------
+    generator
+        Yields the query of each image and subimage.
+    """
+    for path in paths:
+        name = os.path.basename(path)
+        yield extract(path, id=name, **kwargs)
+        if crop:
+            for i, img in enumerate(blobcrop.crop_to_blob(path)):
+                yield extract(img, id='%s-%d' % (name, i + 1), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the features of images as search request body.')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--crop', action='store_true', help='query the subimages as well')
+    parser.add_argument('--no-rhash', dest='rhash', action='store_false')
+    parser.add_argument('--no-text', dest='text', action='store_false')
+    parser.add_argument('--regions', action='store_true', help='recognize only the text regions')
+    args = parser.parse_args()
+    print(json.dumps({'queries': list(queries(args.paths, crop=args.crop, rhash=args.rhash,
+                                              text=args.text, regions=args.regions))}))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,40 +1,148 @@
 import falcon
+import datetime
+import math
 import os
+import shutil
+import tempfile
+import threading
 import mimetypes
 import classify
 import blobcrop
-import imagehash
 import img_util
+import multihash
 import ratiohash
 import ocr
 import database
-import json
+import evaluation
+import results
+import cache
+import metrics
+import thumbnails
+import storage
+import pages
+
+
+class Cancelled(Exception):
+    """Raised when the client of a request disconnected before the request
+    was processed."""
+    pass
+
+
+# request parameters of an analysis, part of the cache key
+THRESHOLDS = ('phash_thresh', 'rhash_thresh', 'text_thresh', 'mhash_thresh')
+# feature extraction stages whose invocations are counted by the crop dedup
+DEDUP_STAGES = ('bar_classifier', 'pure_classifier', 'rhash', 'ocr')
+
+
+def thresholds(params):
+    """Returns the thresholds of the request parameters, the keyword
+    arguments of the eval function of each modality.
+
+    Raises
+    ------
+    falcon.HTTPBadRequest
+        If a threshold is not a finite number.
+    """
+    found = {}
+    for name in ('phash', 'rhash', 'text', 'mhash'):
+        found[name] = {}
+        if name + '_thresh' not in params:
+            continue
+        try:
+            value = float(params[name + '_thresh'])
+        except (TypeError, ValueError):
+            value = float('nan')
+        if math.isnan(value) or math.isinf(value):
+            raise falcon.HTTPBadRequest(title='Invalid threshold',
+                                        description='%s_thresh must be a number' % name)
+        found[name]['thresh'] = value
+    return found
+
+
+def upload_location(result):
+    """Returns the URL of an uploaded image, the Location of the upload
+    response. None if the image was not stored, e.g. if only the pages of a
+    document were stored."""
+    if result['store'] == 'True' and any(subimage['id'] == result['id'] for subimage in result['subimages']):
+        return '/images/' + result['id']
+    return None
+
+
+def load_classifier(path, use_gpu=False):
+    """Loads a classifier directory with snap.caffemodel, deploy.prototxt,
+    mean.binaryproto and labels.txt.
+
+    Returns
+    -------
+    tuple
+        (net, transformer, labels_file), the arguments of classify.classify.
+    """
+    net = classify.get_net(os.path.join(path, 'snap.caffemodel'),
+                           os.path.join(path, 'deploy.prototxt'),
+                           use_gpu=use_gpu)
+    trans = classify.get_transformer(os.path.join(path, 'deploy.prototxt'),
+                                     os.path.join(path, 'mean.binaryproto'))
+    return net, trans, os.path.join(path, 'labels.txt')
+
+
+def bar_chart(is_bar):
+    """Returns True if the result of the bar classifier is a bar chart."""
+    return float(is_bar[1][1]) > 99 and is_bar[1][0] == 'bar'
+
+
+def pure_image(is_pure):
+    """Returns True if the result of the pure classifier is a pure image,
+    which contains no text."""
+    return float(is_pure[1][1]) > 50 and is_pure[1][0] == 'pure'
+
+
+def feature_versions(classifier_version, ocr_regions):
+    """Returns the versions of the extracted features, stored with each
+    subimage, see database.FEATURES."""
+    return {'class': classifier_version, 'rhash': ratiohash.VERSION,
+            'text': ocr.version(ocr_regions), 'mhash': multihash.VERSION}
 
 
 class Collection(object):
-    def __init__(self, database_path, storage_path, bar_classifier, pure_classifier, use_gpu):
+    def __init__(self, database_path, storage_path, bar_classifier, pure_classifier, use_gpu,
+                 group_commit=0.0, text_prefilter=None, index_variants=False, cache_size=128,
+                 image_storage=None, virtual_subimages=False, ocr_regions=False, classifier_version=1,
+                 shared_index=None, analysis_threads=0, analysis_concurrency=8, text_processes=0,
+                 crop_dedup=False):
 
         self.storage_path = storage_path
-        self.db_handler = database.DBHandler(database_path)
+        # store the bounding rectangles of subimages instead of their copies
+        self.virtual_subimages = virtual_subimages
+        # recognize only the detected text regions, see ocr.text_regions
+        self.ocr_regions = ocr_regions
+        # drop nested crops and reuse the features of repeated ones
+        self.crop_dedup = crop_dedup
+        self.versions = feature_versions(classifier_version, ocr_regions)
+        self.storage = image_storage or storage.FileStorage(storage_path)
+        self.index_variants = index_variants
+        self.db_handler = database.DBHandler(database_path, group_commit=group_commit,
+                                             text_prefilter=text_prefilter, index_path=shared_index)
+        self.cache = cache.AnalysisCache(cache_size)
+        self.evaluator = evaluation.Evaluator(analysis_threads, analysis_concurrency, text_processes,
+                                              shared_index)
+
+        # fail at startup, not at the first upload, if Pillow, NumPy or SciPy
+        # are incompatible
+        print("Checking Hash Extraction..")
+        multihash.check()
+        print("  ..done!")
 
         # Load classifiers
         print("Loading Bar Chart Classifier..")
-        self.bar_net = classify.get_net(os.path.join(bar_classifier, 'snap.caffemodel'),
-                                        os.path.join(bar_classifier, 'deploy.prototxt'),
-                                        use_gpu=use_gpu)
-        self.bar_trans = classify.get_transformer(os.path.join(bar_classifier, 'deploy.prototxt'),
-                                                  os.path.join(bar_classifier, 'mean.binaryproto'))
-        self.bar_label = os.path.join(bar_classifier, 'labels.txt')
+        self.bar_net, self.bar_trans, self.bar_label = load_classifier(bar_classifier, use_gpu)
         print("  ..done!")
 
         print("Loading Pure Image Classifier..")
-        self.pure_net = classify.get_net(os.path.join(pure_classifier, 'snap.caffemodel'),
-                                         os.path.join(pure_classifier, 'deploy.prototxt'),
-                                         use_gpu=use_gpu)
-        self.pure_trans = classify.get_transformer(os.path.join(pure_classifier, 'deploy.prototxt'),
-                                                   os.path.join(pure_classifier, 'mean.binaryproto'))
-        self.pure_label = os.path.join(pure_classifier, 'labels.txt')
+        self.pure_net, self.pure_trans, self.pure_label = load_classifier(pure_classifier, use_gpu)
         print("  ..done!")
+        # a net keeps the input and output blobs of its forward pass, the
+        # uploads of concurrent threads are classified one at a time
+        self.classifier_lock = threading.Lock()
 
         # Load database
         print("Loading Database..")
@@ -43,104 +151,178 @@ class Collection(object):
 
     def on_get(self, req, resp):
         if "id" not in req.params:
-            resp.body = '{"Status": "Alive"}'
+            resp.body = results.dumps({'Status': 'Alive'})
             resp.status = falcon.HTTP_200
         else:
             print ('=' * 50)
             print('Received analyse request for id', req.params['id'])
-            sub_df = self.db_handler.df[self.db_handler.df['parent'] == req.params['id']]
-            cmp_df = self.db_handler.df[self.db_handler.df['parent'] != req.params['id']]
-
-            resp.body = '{ ' + \
-                        '"analyse": "True",' + \
-                        '"store": "False",' + \
-                        '"id": "' + str(req.params['id']) + '",' + \
-                        '"subimages": ['
-
-            for index, row in sub_df.iterrows():
-                name = row['id']
-                parent = row['parent']
-                phash = row['phash']
-                rhash = row['rhash']
-                text = row['text']
-                bool_bar = row['is_bar'] == 1
-                bool_pure = row['is_pure'] == 1
-
-                if "phash_thresh" in req.params:
-                    df = self.db_handler.eval_phash(phash, cmp_df, float(req.params["phash_thresh"]))
-                else:
-                    df = self.db_handler.eval_phash(phash, cmp_df)
-                matches_phash = '['
-                for index, row in df.iterrows():
-                    matches_phash += '{' \
-                                     '"id": "' + str(row.id) + '",' + \
-                                     '"parent": "' + str(row.parent) + '",' + \
-                                     '"score": "' + str(row.score) + '"' + \
-                                     '},'
-                if matches_phash[-1] == ',':
-                    matches_phash = matches_phash[:-1]
-                matches_phash += ']'
-
-                matches_rhash = '[]'
-                if bool_bar:
-                    if "rhash_thresh" in req.params:
-                        df = self.db_handler.eval_rhash(rhash, cmp_df, float(req.params["rhash_thresh"]))
-                    else:
-                        df = self.db_handler.eval_rhash(rhash, cmp_df)
-                    matches_rhash = '['
-                    for index, row in df.iterrows():
-                        matches_rhash += '{' \
-                                         '"id": "' + str(row.id) + '",' + \
-                                         '"parent": "' + str(row.parent) + '",' + \
-                                         '"score": "' + str(row.score) + '"' + \
-                                         '},'
-                    if matches_rhash[-1] == ',':
-                        matches_rhash = matches_rhash[:-1]
-                    matches_rhash += ']'
-
-                matches_text = '[]'
-                if not bool_pure:
-                    if "text_thresh" in req.params:
-                        df = self.db_handler.eval_text(text, cmp_df, float(req.params["text_thresh"]))
-                    else:
-                        df = self.db_handler.eval_text(text, cmp_df)
-                    matches_text = '['
-                    for index, row in df.iterrows():
-                        matches_text += '{' \
-                                        '"id": "' + str(row.id) + '",' + \
-                                        '"parent": "' + str(row.parent) + '",' + \
-                                        '"score": "' + str(row.score) + '"' + \
-                                        '},'
-                    if matches_text[-1] == ',':
-                        matches_text = matches_text[:-1]
-                    matches_text += ']'
-
-                resp.body += '{'
-                resp.body += '"id": "' + str(name) + '",'
-                resp.body += '"parent": "' + str(parent) + '",'
-                resp.body += '"is_pure": "' + str(bool_pure) + '",'
-                resp.body += '"is_bar": "' + str(bool_bar) + '",'
-                resp.body += '"matches_phash": ' + matches_phash + ','
-                resp.body += '"matches_rhash": ' + matches_rhash + ','
-                resp.body += '"matches_text": ' + matches_text
-                resp.body += '},'
-
-            resp.body = resp.body[:-1] + ']}'
+
+            # stream one record per subimage as soon as it is evaluated
+            stream = req.get_param_as_bool('stream') or \
+                (req.accept is not None and 'application/x-ndjson' in req.accept)
+            subimages = self.get_analysis(req.params['id'], req.params, stream=stream)
+            if stream:
+                resp.content_type = 'application/x-ndjson'
+                resp.stream = ((results.dumps(record) + '\n').encode('utf-8')
+                               for record in subimages)
+            else:
+                resp.body = results.dumps(results.analysis(req.params['id'], subimages))
+
+    def get_analysis(self, id, params, stream=False, cancelled=None):
+        """Returns the analysis result of a document. Results are cached until
+        the corpus changes.
+
+        Parameters
+        ----------
+        id : str
+            The id of the document to analyse.
+        params : dict
+            The request parameters, see analyse.
+        stream : bool, optional
+            If True, a generator is returned that evaluates the subimages one
+            by one, unless the result is cached.
+        cancelled : threading.Event, optional
+            Set if the client disconnected, see analyse.
+
+        Returns
+        -------
+        list
+            The analysis results of the subimages, or a generator of them if
+            stream is True.
+        """
+        # raises before a streamed response is started
+        thresholds(params)
+        key = (id,) + tuple(params.get(name) for name in THRESHOLDS)
+        # the result is cached for the generation it was computed from
+        current = self.db_handler.current()
+        generation = current[0]
+        if stream:
+            subimages = self.cache.get(key, generation)
+            if subimages is None:
+                subimages = self._cache_stream(key, generation, self.analyse(id, params, cancelled, current))
+            return subimages
+        return self.cache.get_or_compute(key, generation,
+                                         lambda: list(self.analyse(id, params, cancelled, current)))
+
+    def _cache_stream(self, key, generation, subimages):
+        """Passes the records of a streamed analysis through and caches them,
+        once the analysis is complete."""
+        records = []
+        for record in subimages:
+            records.append(record)
+            yield record
+        self.cache.put(key, generation, records)
+
+    def analyse(self, id, params, cancelled=None, current=None):
+        """Compares every subimage of a stored document with all subimages of
+        other documents.
+
+        Parameters
+        ----------
+        id : str
+            The id of the document to analyse.
+        params : dict
+            The request parameters. phash_thresh, rhash_thresh, text_thresh
+            and mhash_thresh are used as thresholds, if present.
+        cancelled : threading.Event, optional
+            If set, Cancelled is raised before the next subimage is evaluated.
+        current : tuple, optional
+            (generation, corpus) to analyse against, see
+            database.DBHandler.current. The current corpus by default.
+
+        Returns
+        -------
+        generator
+            Yields the analysis result of each subimage, as soon as it is
+            evaluated.
+        """
+        for row, found in self.evaluator.run(self._jobs(id, params, cancelled, current)):
+            matches = dict((name, results.match_list(df)) for name, df in found.items())
+            yield results.analysis_subimage(row['id'], row['parent'], row['is_pure'] == 1, row['is_bar'] == 1,
+                                            matches['phash'], matches.get('rhash', []),
+                                            matches.get('text', []),
+                                            matches_mhash=matches.get('mhash', []),
+                                            matches_variant=matches.get('variant'))
+
+    def _jobs(self, id, params, cancelled=None, current=None):
+        """Yields (record, jobs) for each subimage of a document, the
+        evaluations as expected by evaluation.Evaluator.run."""
+        # one snapshot for the whole analysis, a reload does not change it
+        generation, snapshot = current or self.db_handler.current()
+        prefilter = self.db_handler.text_prefilter
+        cmp_rows = snapshot.rows_except(id)
+        limits = thresholds(params)
+
+        for i in snapshot.rows_of(id):
+            if cancelled is not None and cancelled.is_set():
+                raise Cancelled(id)
+            row = snapshot.record(i)
+            fingerprint = (row['trigram_ids'], row['n_trigrams'], row['simhash'])
+
+            jobs = [('phash', snapshot.eval_phash, (row['phash'], cmp_rows), limits['phash'])]
+            if row['is_bar'] == 1:
+                jobs.append(('rhash', snapshot.eval_rhash, (row['rhash'], cmp_rows), limits['rhash']))
+            if row['is_pure'] != 1:
+                jobs.append(('text', self.evaluator.eval_text, (snapshot, generation, id, fingerprint, cmp_rows),
+                             dict(limits['text'], prefilter=prefilter)))
+            if row['has_mhash']:
+                hashes = dict((name, row[name]) for name in multihash.HASHES)
+                jobs.append(('mhash', snapshot.eval_mhash, (hashes, cmp_rows), limits['mhash']))
+            # one pass over the stored and the transformed variant hashes
+            if len(snapshot.variant_rows):
+                jobs.append(('variant', snapshot.eval_variants, (row['phash'], cmp_rows), limits['phash']))
+            yield row, jobs
 
     def on_post(self, req, resp):
         # ext = mimetypes.guess_extension(req.content_type)
         # filename = '{uuid}{ext}'.format(uuid=uuid.uuid4(), ext=ext)
         filename = req.params['id']
+        store = (req.params['store'] == 'true')
+
+        result = self.ingest(filename, store, req.stream)
+        resp.body = results.dumps(result)
+
+        resp.status = falcon.HTTP_201
+        location = upload_location(result)
+        if location is not None:
+            resp.location = location
+
+    def ingest(self, filename, store, stream, cancelled=None):
+        """Stores an uploaded image, crops it into subimages and extracts the
+        features of all of them. The pages of PDFs and multi-page TIFFs are
+        processed one at a time, each like an uploaded image with the id
+        <filename>-p<number>.
+
+        Parameters
+        ----------
+        filename : str
+            The id of the uploaded document.
+        store : bool
+            If True, the features are added to the database.
+        stream
+            File-like object with the raw image or document.
+        cancelled : threading.Event, optional
+            If set, Cancelled is raised before the next subimage is processed.
+
+        Returns
+        -------
+        dict
+            The upload result, see results.ingest.
+        """
         # Analyse here is not recommended - if image is submitted twice, the first copy will distort the results.
         analyse = False  # (req.params['analyse'] == 'true')
-        store = (req.params['store'] == 'true')
 
         print ('=' * 50)
         print('Retrieving image: "' + filename + '"')
-        base_path = self.storage_path
-        if not store:
-            base_path = '/tmp'
-
+        # the images are processed as files in a working directory, and moved
+        # to the storage afterwards if they are stored
+        base_path = tempfile.mkdtemp(prefix='imageplag-')
+        try:
+            return self._ingest(filename, store, stream, base_path, analyse, cancelled)
+        finally:
+            shutil.rmtree(base_path, ignore_errors=True)
+
+    def _ingest(self, filename, store, stream, base_path, analyse, cancelled):
         image_path = os.path.join(base_path, filename)
 
         print('Analyse: ' + str(analyse))
@@ -148,133 +330,339 @@ class Collection(object):
 
         with open(image_path, 'wb') as image_file:
             while True:
-                chunk = req.stream.read(4096)
+                chunk = stream.read(4096)
                 if not chunk:
                     break
 
                 image_file.write(chunk)
 
-        images = [image_path]
-
-        img_list = blobcrop.crop_to_blob(image_path)
-        for i, img in enumerate(img_list):
-            sub_img_path = filename + '-' + str(i + 1)
-            sub_img_path = os.path.join(base_path, sub_img_path)
-            img.save(sub_img_path, format='JPEG')
-            images.append(sub_img_path)
-
-        resp.body = '{ ' + \
-                    '"analyse": "' + str(analyse) + '",' + \
-                    '"store": "' + str(store) + '",' + \
-                    '"id": "' + str(filename) + '",' + \
-                    '"subimages": ['
+        # the pages of a multi-page document are decoded and processed one at
+        # a time, they and their subimages are grouped under the upload
+        doc_kind = pages.kind(image_path)
+        if doc_kind == 'pdf' or (doc_kind == 'tiff' and pages.page_count(image_path) > 1):
+            sources = (('%s-p%d' % (filename, number), page_path)
+                       for number, page_path in pages.pages(image_path, base_path))
+        else:
+            sources = [(filename, image_path)]
+
+        # with crop_dedup, the features of the images of the upload by their
+        # quick hashes and the saved work
+        seen = None
+        dedup = None
+        if self.crop_dedup:
+            seen = {}
+            dedup = {'dropped': 0, 'reused': 0, 'saved': dict((stage, 0) for stage in DEDUP_STAGES)}
+
+        entries = []
+        classifications = []
+        locations = []
+        for source_id, source_path in sources:
+            images, page_entries, page_classifications = self._extract(source_id, source_path, filename,
+                                                                       base_path, cancelled, seen, dedup)
+            if store:
+                for img, entry in zip(images, page_entries):
+                    if 'rect' not in entry:
+                        self.storage.put_file(entry['id'], img)
+                # virtual subimages are located by a media fragment of the page
+                locations.extend(self.storage.location(entry['id']) if 'rect' not in entry else
+                                 self.storage.location(source_id) + '#xywh=%d,%d,%d,%d' % entry['rect']
+                                 for entry in page_entries)
+            else:
+                locations.extend([None] * len(page_entries))
+            entries.extend(page_entries)
+            classifications.extend(page_classifications)
+            if source_path != image_path:
+                # the images of a page are files unless they are virtual, the
+                # file storage moved them if they were stored
+                for img, entry in zip(images, page_entries):
+                    if 'rect' not in entry and os.path.exists(img):
+                        os.remove(img)
+
+        # store all subimages of the upload in one transaction
+        db_responses = [None] * len(entries)
+        if store:
+            db_responses = self.db_handler.add_entries(entries)
+
+        subimages = []
+        for location, entry, (is_bar, is_pure), res in zip(locations, entries, classifications, db_responses):
+            matches = None
+            if analyse:
+                matches = {'matches_phash': results.match_list(
+                    self.db_handler.eval_phash(entry['phash']), with_parent=False)}
 
-        for img in images:
-            print ('-' * 50)
-            print(img)
+                matches['matches_rhash'] = []
+                if entry['is_bar']:
+                    matches['matches_rhash'] = results.match_list(
+                        self.db_handler.eval_rhash(entry['rhash']), with_parent=False)
 
-            is_bar = classify.classify(self.bar_net, self.bar_trans, [img], labels_file=self.bar_label)
-            print(is_bar[1][0], is_bar[1][1])
-            print(is_bar[2][0], is_bar[2][1])
+                matches['matches_text'] = []
+                if not entry['is_pure']:
+                    matches['matches_text'] = results.match_list(
+                        self.db_handler.eval_text(entry['text']), with_parent=False)
 
-            is_pure = classify.classify(self.pure_net, self.pure_trans, [img], labels_file=self.pure_label)
-            print(is_pure[1][0], is_pure[1][1])
-            print(is_pure[2][0], is_pure[2][1])
+                matches['matches_mhash'] = results.match_list(
+                    self.db_handler.eval_mhash(entry), with_parent=False)
 
-            phash = str(imagehash.phash(img_util.open_if(img)))
+            subimages.append(results.ingest_subimage(
+                entry['id'], location, is_bar, is_pure, entry['phash'], entry['rhash'], entry['text'],
+                db_response=res, matches=matches,
+                hashes=dict((name, entry[name]) for name in multihash.HASHES[1:])))
 
-            rhash = 'NA'
-            bool_bar = 0
-            if float(is_bar[1][1]) > 99 and is_bar[1][0] == 'bar':
-                rhash = ratiohash.get_hash(img)
-                bool_bar = 1
+        self.db_handler.reload_db()
 
-            text = ''
-            bool_pure = 1
-            if not (float(is_pure[1][1]) > 50 and is_pure[1][0] == 'pure'):
-                text = ocr.ocr(img)
-                bool_pure = 0
+        if dedup is not None:
+            print('Dedup: %d crops dropped, %d features reused, saved %s'
+                  % (dedup['dropped'], dedup['reused'], dedup['saved']))
+            metrics.registry.incr('crop_dedup_dropped', dedup['dropped'])
+            metrics.registry.incr('crop_dedup_reused', dedup['reused'])
+            for stage, n in dedup['saved'].items():
+                metrics.registry.incr('crop_dedup_saved_' + stage, n)
+
+        return results.ingest(filename, analyse, store, subimages, dedup=dedup)
+
+    def _extract(self, source_id, source_path, parent, base_path, cancelled, seen=None, dedup=None):
+        """Crops an image, an upload or a page of one, into subimages and
+        extracts the features of all of them.
+
+        Parameters
+        ----------
+        source_id : str
+            The id of the image.
+        source_path : str
+            Path to the image.
+        parent : str
+            The id of the uploaded document.
+        base_path : str
+            The working directory of the upload.
+        cancelled : threading.Event
+            If set, Cancelled is raised before the next subimage is processed.
+        seen : dict, optional
+            Maps the pHash and dHash of the images processed so far in the
+            upload to their features, which are reused for images with the
+            same hashes. If given, nested crops are dropped as well.
+        dedup : dict, optional
+            The numbers of dropped crops, of reused features and of the saved
+            invocations of each of DEDUP_STAGES, updated in place.
+
+        Returns
+        -------
+        tuple
+            (images, entries, classifications). images are the paths of the
+            image and its subimages, or the subimages in memory if they are
+            virtual. entries are the database entries and classifications
+            the (is_bar, is_pure) classifier outputs.
+        """
+        images = [source_path]
+        ids = [source_id]
+        rects = [None]
+
+        img_list, crop_rects = blobcrop.crop_to_blob(source_path, with_rects=True)
+        if seen is not None:
+            kept = blobcrop.dedup_rects(crop_rects)
+            dropped = len(crop_rects) - len(kept)
+            dedup['dropped'] += dropped
+            # a dropped crop is at least classified twice
+            dedup['saved']['bar_classifier'] += dropped
+            dedup['saved']['pure_classifier'] += dropped
+            img_list = [img_list[i] for i in kept]
+            crop_rects = [crop_rects[i] for i in kept]
+        for i, (img, rect) in enumerate(zip(img_list, crop_rects)):
+            ids.append(source_id + '-' + str(i + 1))
+            if self.virtual_subimages:
+                # the features are extracted from the crop in memory, it is
+                # cropped from the parent again when it is requested
+                images.append(img)
+                rects.append(rect)
+            else:
+                sub_img_path = os.path.join(base_path, ids[-1])
+                img.save(sub_img_path, format='JPEG')
+                images.append(sub_img_path)
+                rects.append(None)
+
+        # decode and hash all images in one batch
+        hashes = multihash.extract(images, with_variants=self.index_variants)
+
+        entries = []
+        classifications = []
+        for i, img in enumerate(images):
+            if cancelled is not None and cancelled.is_set():
+                raise Cancelled(parent)
+            print ('-' * 50)
+            print(ids[i])
+
+            key = (hashes['phash'][i], hashes['dhash'][i])
+            if seen is not None and key in seen:
+                # a repeated element, e.g. a logo or a legend
+                first, is_bar, is_pure, rhash, text = seen[key]
+                print('Features reused from ' + first)
+                dedup['reused'] += 1
+                dedup['saved']['bar_classifier'] += 1
+                dedup['saved']['pure_classifier'] += 1
+                dedup['saved']['rhash'] += int(bar_chart(is_bar))
+                dedup['saved']['ocr'] += int(not pure_image(is_pure))
+            else:
+                with self.classifier_lock:
+                    is_bar = classify.classify(self.bar_net, self.bar_trans, [img], labels_file=self.bar_label)
+                    is_pure = classify.classify(self.pure_net, self.pure_trans, [img],
+                                                labels_file=self.pure_label)
+                print(is_bar[1][0], is_bar[1][1])
+                print(is_bar[2][0], is_bar[2][1])
+                print(is_pure[1][0], is_pure[1][1])
+                print(is_pure[2][0], is_pure[2][1])
+
+                rhash = ratiohash.get_hash(img) if bar_chart(is_bar) else 'NA'
+                text = ocr.ocr(img, regions=self.ocr_regions) if not pure_image(is_pure) else ''
+                if seen is not None:
+                    seen[key] = (ids[i], is_bar, is_pure, rhash, text)
+
+            phash = img_util.int_to_hash(hashes['phash'][i])
+            bool_bar = int(bar_chart(is_bar))
+            bool_pure = int(pure_image(is_pure))
+
+            entries.append({'id': ids[i], 'parent': parent, 'phash': phash,
+                            'rhash': rhash, 'text': text, 'trigrams': ocr.trigrams(text),
+                            'is_bar': bool_bar, 'is_pure': bool_pure,
+                            'dhash': img_util.int_to_hash(hashes['dhash'][i]),
+                            'ahash': img_util.int_to_hash(hashes['ahash'][i]),
+                            'whash': img_util.int_to_hash(hashes['whash'][i]),
+                            'versions': self.versions})
+            if rects[i] is not None:
+                entries[-1]['rect'] = rects[i]
+                entries[-1]['source'] = source_id
+            if self.index_variants:
+                entries[-1]['variants'] = dict((name, hashes['variants'][name][i])
+                                               for name in multihash.VARIANTS)
+            classifications.append((is_bar, is_pure))
+
+        return images, entries, classifications
 
-            id = os.path.split(img)[-1]
-            res = ''
-            if store:
-                res = self.db_handler.add_entry(id, filename, phash, rhash, text, bool_bar, bool_pure)
 
-            matches_phash = '[]'
-            matches_rhash = '[]'
-            matches_text = '[]'
-            if analyse:
-                df = self.db_handler.eval_phash(phash)
-                matches_phash = '['
-                for index, row in df.iterrows():
-                    matches_phash += '{' \
-                                     '"id": "' + str(row.id) + '",' + \
-                                     '"score": "' + str(row.score) + '"' + \
-                                     '},'
-                if matches_phash[-1] == ',':
-                    matches_phash = matches_phash[:-1]
-                matches_phash += ']'
-
-                matches_rhash = '[]'
-                if bool_bar:
-                    df = self.db_handler.eval_rhash(rhash)
-                    matches_rhash = '['
-                    for index, row in df.iterrows():
-                        matches_rhash += '{' \
-                                         '"id": "' + str(row.id) + '",' + \
-                                         '"score": "' + str(row.score) + '"' + \
-                                         '},'
-                    if matches_rhash[-1] == ',':
-                        matches_rhash = matches_rhash[:-1]
-                    matches_rhash += ']'
-
-                matches_text = '[]'
-                if not bool_pure:
-                    df = self.db_handler.eval_text(text)
-                    matches_text = '['
-                    for index, row in df.iterrows():
-                        matches_text += '{' \
-                                        '"id": "' + str(row.id) + '",' + \
-                                        '"score": "' + str(row.score) + '"' + \
-                                        '},'
-                    if matches_text[-1] == ',':
-                        matches_text = matches_text[:-1]
-                    matches_text += ']'
-
-            resp.body += '{'
-            if analyse:
-                resp.body += '"matches_phash": ' + matches_phash + ','
-                resp.body += '"matches_rhash": ' + matches_rhash + ','
-                resp.body += '"matches_text": ' + matches_text + ','
-            if store:
-                resp.body += '"db_response": "' + res + '",'
-            resp.body += '"id": "' + id + '",' + \
-                         '"location": "' + img + '",' + \
-                         '"' + str(is_bar[1][0]) + '": "' + str(is_bar[1][1]) + '",' + \
-                         '"' + str(is_bar[2][0]) + '": "' + str(is_bar[2][1]) + '",' + \
-                         '"' + str(is_pure[1][0]) + '": "' + str(is_pure[1][1]) + '",' + \
-                         '"' + str(is_pure[2][0]) + '": "' + str(is_pure[2][1]) + '",' + \
-                         '"phash": "' + phash + '",' + \
-                         '"rhash": "' + rhash + '",' + \
-                         '"text": ' + json.dumps(text) + '' + \
-                         '},'
-
-        resp.body = resp.body[:-1] + ']}'
+class Item(object):
+    def __init__(self, image_storage):
+        self.storage = image_storage
 
-        resp.status = falcon.HTTP_201
-        resp.location = '/images/' + filename
+    def on_get(self, req, resp, id):
+        send_file(req, resp, self.storage, id)
 
-        self.db_handler.reload_db()
 
+class Thumbnail(object):
+    """Serves downscaled copies of the stored images. The thumbnails are kept
+    in a size-bounded cache on disk."""
 
-class Item(object):
-    def __init__(self, storage_path):
-        self.storage_path = storage_path
+    def __init__(self, image_storage, cache):
+        self.storage = image_storage
+        self.cache = cache
 
     def on_get(self, req, resp, id):
-        # (content_type is a workaround) TODO we need a separate format column in the db
-        # mimetypes.guess_type(id)[0] doesn't work since id can be 'AC00534H' without an extension
-        resp.content_type = 'image/jpeg'
-        image_path = os.path.join(self.storage_path, id)
-        resp.stream = open(image_path, 'rb')
-        resp.stream_len = os.path.getsize(image_path)
+        size = req.get_param_as_int('size') or thumbnails.DEFAULT_SIZE
+        if not thumbnails.MIN_SIZE <= size <= thumbnails.MAX_SIZE:
+            raise falcon.HTTPBadRequest(title='Invalid size',
+                                        description='size must be between %d and %d'
+                                        % (thumbnails.MIN_SIZE, thumbnails.MAX_SIZE))
+        try:
+            thumb_name = self.cache.get(self.storage, id, size)
+        except KeyError:
+            raise falcon.HTTPNotFound()
+        send_file(req, resp, self.cache.storage, thumb_name)
+
+
+# magic numbers of the image formats that can be uploaded
+MAGIC = [(b'\xff\xd8\xff', 'image/jpeg'),
+         (b'\x89PNG', 'image/png'),
+         (b'GIF8', 'image/gif'),
+         (b'II*\x00', 'image/tiff'),
+         (b'MM\x00*', 'image/tiff'),
+         (b'BM', 'image/bmp')]
+
+
+def content_type(header):
+    """Guesses the content type of an image from its first bytes. The stored
+    files have no extension, so mimetypes can not be used.
+
+    Parameters
+    ----------
+    header : bytes
+        The first bytes of the file.
+
+    Returns
+    -------
+    str
+        The content type, image/jpeg if the format is unknown.
+    """
+    for magic, mime in MAGIC:
+        if header.startswith(magic):
+            return mime
+    return 'image/jpeg'
+
+
+def prepare_file(req, resp, storage, name):
+    """Sets the headers of a file response. Handles conditional requests with
+    ETag and Last-Modified, and single byte ranges.
+
+    Parameters
+    ----------
+    req : falcon.Request
+        The request.
+    resp : falcon.Response
+        The response, status and headers are set.
+    storage : storage.FileStorage or storage.PackStorage
+        The storage of the file.
+    name : str
+        The name of the file in the storage.
+
+    Returns
+    -------
+    tuple
+        (start, length) of the content to send, or None if there is no
+        content (304 or 416).
+    """
+    try:
+        size, mtime = storage.stat(name)
+    except KeyError:
+        raise falcon.HTTPNotFound()
+
+    etag = '"%x-%x"' % (int(mtime * 1000000), size)
+    last_modified = datetime.datetime.utcfromtimestamp(int(mtime))
+    resp.etag = etag
+    resp.last_modified = last_modified
+    resp.cache_control = ['public', 'max-age=86400']
+    resp.set_header('Accept-Ranges', 'bytes')
+
+    # conditional request, If-None-Match takes precedence
+    if_none_match = req.get_header('If-None-Match')
+    if_modified_since = req.get_header_as_datetime('If-Modified-Since')
+    if (if_none_match is not None and etag in [t.strip() for t in if_none_match.split(',')]) or \
+            (if_none_match is None and if_modified_since is not None and last_modified <= if_modified_since):
+        resp.status = falcon.HTTP_304
+        return None
+
+    resp.content_type = content_type(storage.read(name, 0, 8))
+
+    start, length = 0, size
+    byte_range = req.range
+    if byte_range is not None:
+        first, last = byte_range
+        if first < 0:
+            first = max(size + first, 0)
+        if last < 0 or last >= size:
+            last = size - 1
+        if first >= size or first > last:
+            resp.status = falcon.HTTP_416
+            resp.set_header('Content-Range', 'bytes */%d' % size)
+            return None
+        start, length = first, last - first + 1
+        resp.status = falcon.HTTP_206
+        resp.content_range = (first, last, size)
+
+    return start, length
+
+
+def send_file(req, resp, storage, name):
+    """Sends a file as response body, see prepare_file. Files of a
+    FileStorage are passed to the WSGI server, which can send them with
+    sendfile."""
+    content = prepare_file(req, resp, storage, name)
+    if content is not None:
+        start, length = content
+        resp.stream = storage.open_range(name, start, length)
+        resp.stream_len = length
@@ -12,13 +12,15 @@ def to_cv2(img):
     Parameters
     ----------
     img
-        Path to image, or PIL Image object.
+        Path to image, PIL Image object or grayscale cv2 image.
     
     Returns
     -------
     cv2 image
         The coverted and loaded image.
     """
+    if isinstance(img, np.ndarray):
+        return img
     if isinstance(img, Image.Image):
         cv2_img = np.array(img)
         if len(cv2_img.shape) == 3 or len(cv2_img.shape) == 4:
@@ -98,6 +100,67 @@ def absdiff10k(i, j):
         return abs(i - j) / float(i)
 
 
+# number of set bits of every byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hash_to_int(h):
+    """Converts a 64 bit image hash to a signed 64 bit integer, the format in
+    which hashes are stored in SQLite.
+
+    Parameters
+    ----------
+    h
+        Hash as hex string, or imagehash.ImageHash object.
+
+    Returns
+    -------
+    int
+        The hash as signed 64 bit integer.
+    """
+    value = int(str(h), 16)
+    if value >= 2 ** 63:
+        value -= 2 ** 64
+    return value
+
+
+def int_to_hash(value):
+    """Converts a signed 64 bit integer back to the hex string of the hash.
+
+    Parameters
+    ----------
+    value : int
+        The hash as signed 64 bit integer.
+
+    Returns
+    -------
+    str
+        The hash as hex string, same as str(imagehash.ImageHash).
+    """
+    return format(int(value) % 2 ** 64, '016x')
+
+
+def hamming(hashes, h):
+    """Calculates the hamming distances between one 64 bit hash and an array
+    of hashes.
+
+    Parameters
+    ----------
+    hashes : np.ndarray
+        The hashes as signed 64 bit integers.
+    h : int
+        The hash as signed 64 bit integer.
+
+    Returns
+    -------
+    np.ndarray
+        The number of differing bits for each hash in hashes.
+    """
+    hashes = np.ascontiguousarray(hashes, dtype=np.int64)
+    diff = np.bitwise_xor(hashes, np.int64(h))
+    return _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
 def eval_distances(data, threshold=1.0, cutoff=10):
     """Evaluates the largest relative gap in a distribution to get suspicious
     outliers.
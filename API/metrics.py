@@ -0,0 +1,72 @@
+"""This module collects counters and gauges of the running API and serves them
+as JSON at /metrics."""
+
+import threading
+import results
+
+
+class Registry(object):
+    """Thread-safe store of named counters and gauges."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def incr(self, name, n=1):
+        """Increments a counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter.
+        n : int, optional
+            The value to add.
+        """
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + n
+
+    def set(self, name, value):
+        """Sets a gauge to a value.
+
+        Parameters
+        ----------
+        name : str
+            Name of the gauge.
+        value : float
+            The current value.
+        """
+        with self.lock:
+            self.values[name] = value
+
+    def get(self, name, default=0):
+        """Returns the value of a counter or gauge."""
+        with self.lock:
+            return self.values.get(name, default)
+
+    def snapshot(self):
+        """Returns a copy of all values."""
+        with self.lock:
+            return dict(self.values)
+
+
+# the registry shared by all modules of the API
+registry = Registry()
+
+
+def ratio(hits, misses):
+    """Returns hits / (hits + misses), or 0.0 if there were no requests."""
+    total = hits + misses
+    if total == 0:
+        return 0.0
+    return hits / float(total)
+
+
+class Metrics(object):
+    """Falcon resource that reports the values of the registry. Derived values,
+    such as the analysis cache hit rate, are added on each request."""
+
+    def on_get(self, req, resp):
+        values = registry.snapshot()
+        values['analysis_cache_hit_rate'] = ratio(values.get('analysis_cache_hits', 0),
+                                                  values.get('analysis_cache_misses', 0))
+        resp.body = results.dumps(values)
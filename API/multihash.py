@@ -0,0 +1,276 @@
+"""This module computes several perceptual hashes of images at once. Each image
+is decoded and resized to a grayscale buffer only once, all hashes are derived
+from that buffer. The transforms run vectorized on batches of images.
+
+The pHash is identical to imagehash.phash. The dHash, aHash and wavelet hash
+follow imagehash.dhash, imagehash.average_hash and imagehash.whash, but are
+computed from the shared buffer instead of the full image."""
+
+from PIL import Image
+import numpy as np
+import scipy.fftpack
+import img_util
+
+
+# Names of the computed hashes, each stored in its own column
+HASHES = ('phash', 'dhash', 'ahash', 'whash')
+
+# Version of the hashes, stored with each row. Bump it when a hash of an image
+# changes, backfill.py recomputes the stored hashes
+VERSION = 1
+
+# Edge length of the shared grayscale buffer, as used by imagehash.phash
+BUFFER_SIZE = 32
+
+# Edge length of the hashes, 8 x 8 = 64 bit
+HASH_SIZE = 8
+
+# Transformed variants of which the pHash can be indexed, flips and rotations
+# are applied to the shared buffer, centre crops keep the given fraction
+VARIANTS = ('flip_lr', 'flip_tb', 'rot90', 'rot180', 'rot270', 'crop90', 'crop80')
+CROPS = {'crop90': 0.9, 'crop80': 0.8}
+
+
+def _area_matrix(src, dst):
+    """Returns a (dst x src) matrix that resamples a line of src pixels to dst
+    pixels by area averaging.
+
+    Parameters
+    ----------
+    src : int
+        Number of source pixels.
+    dst : int
+        Number of target pixels.
+
+    Returns
+    -------
+    np.ndarray
+        The resampling weights, each row sums up to 1.
+    """
+    weights = np.zeros((dst, src))
+    scale = float(src) / dst
+    for i in range(dst):
+        start, end = i * scale, (i + 1) * scale
+        for j in range(int(start), int(np.ceil(end))):
+            weights[i, j] = min(end, j + 1) - max(start, j)
+    return weights / scale
+
+
+def _pack(bits):
+    """Packs boolean hashes to signed 64 bit integers.
+
+    Parameters
+    ----------
+    bits : np.ndarray
+        (n x 8 x 8) boolean array, the first bit is the most significant.
+
+    Returns
+    -------
+    np.ndarray
+        The hashes as signed 64 bit integers, same as img_util.hash_to_int.
+    """
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return np.ascontiguousarray(packed).view('>i8').ravel().astype(np.int64)
+
+
+def load(img, crop=1.0):
+    """Decodes an image to the shared grayscale buffer.
+
+    Parameters
+    ----------
+    img
+        Path to an image, or PIL Image object.
+    crop : float, optional
+        Fraction of width and height of the centre crop to use.
+
+    Returns
+    -------
+    np.ndarray
+        (32 x 32) grayscale buffer.
+    """
+    img = img_util.open_if(img).convert('L')
+    if crop < 1.0:
+        width, height = img.size
+        dx, dy = int(width * (1 - crop) / 2), int(height * (1 - crop) / 2)
+        img = img.crop((dx, dy, width - dx, height - dy))
+    # Image.ANTIALIAS is an alias of LANCZOS that Pillow 10 removed
+    img = img.resize((BUFFER_SIZE, BUFFER_SIZE), Image.LANCZOS)
+    return np.asarray(img, dtype=np.float64)
+
+
+def phash(buffers):
+    """Computes the pHash of a batch of buffers with a 2D DCT.
+
+    Parameters
+    ----------
+    buffers : np.ndarray
+        (n x 32 x 32) grayscale buffers, as returned by load.
+
+    Returns
+    -------
+    np.ndarray
+        The hashes as signed 64 bit integers.
+    """
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(buffers, axis=1), axis=2)
+    low = dct[:, :HASH_SIZE, :HASH_SIZE]
+    med = np.median(low.reshape(len(low), -1), axis=1)
+    return _pack(low > med[:, None, None])
+
+
+def dhash(buffers):
+    """Computes the horizontal difference hash of a batch of buffers.
+
+    Parameters
+    ----------
+    buffers : np.ndarray
+        (n x 32 x 32) grayscale buffers, as returned by load.
+
+    Returns
+    -------
+    np.ndarray
+        The hashes as signed 64 bit integers.
+    """
+    rows = _area_matrix(BUFFER_SIZE, HASH_SIZE)
+    cols = _area_matrix(BUFFER_SIZE, HASH_SIZE + 1)
+    pixels = np.matmul(np.matmul(rows, buffers), cols.T)
+    return _pack(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+
+def ahash(buffers):
+    """Computes the average hash of a batch of buffers.
+
+    Parameters
+    ----------
+    buffers : np.ndarray
+        (n x 32 x 32) grayscale buffers, as returned by load.
+
+    Returns
+    -------
+    np.ndarray
+        The hashes as signed 64 bit integers.
+    """
+    pixels = _haar_ll(buffers, HASH_SIZE)
+    avg = pixels.reshape(len(pixels), -1).mean(axis=1)
+    return _pack(pixels > avg[:, None, None])
+
+
+def whash(buffers):
+    """Computes the Haar wavelet hash of a batch of buffers. The lowest
+    frequency (LL of the highest level) is removed.
+
+    Parameters
+    ----------
+    buffers : np.ndarray
+        (n x 32 x 32) grayscale buffers, as returned by load.
+
+    Returns
+    -------
+    np.ndarray
+        The hashes as signed 64 bit integers.
+    """
+    low = _haar_ll(buffers, HASH_SIZE)
+    # remove LL(max), which is the mean of each buffer
+    low = low - _haar_ll(low, 1)
+    med = np.median(low.reshape(len(low), -1), axis=1)
+    return _pack(low > med[:, None, None])
+
+
+def _haar_ll(buffers, size):
+    """Returns the Haar LL subband of a batch of buffers at the given size.
+    The coefficients are normalized to the pixel range.
+
+    Parameters
+    ----------
+    buffers : np.ndarray
+        (n x s x s) buffers, s is a power of 2.
+    size : int
+        The edge length of the subband, a power of 2 not larger than s.
+
+    Returns
+    -------
+    np.ndarray
+        (n x size x size) LL coefficients.
+    """
+    n, height, width = buffers.shape
+    factor = height // size
+    return buffers.reshape(n, size, factor, size, factor).mean(axis=(2, 4))
+
+
+def variants(images, buffers):
+    """Computes the pHash of the transformed variants of a batch of images.
+
+    Parameters
+    ----------
+    images : List
+        Paths to images, or PIL Image objects. Only used for the crops.
+    buffers : np.ndarray
+        (n x 32 x 32) grayscale buffers of the images, as returned by load.
+
+    Returns
+    -------
+    dict
+        Maps each name in VARIANTS to an array with the pHashes of the
+        variants of all images as signed 64 bit integers.
+    """
+    result = {'flip_lr': phash(buffers[:, :, ::-1]),
+              'flip_tb': phash(buffers[:, ::-1, :]),
+              'rot90': phash(np.rot90(buffers, 1, axes=(1, 2))),
+              'rot180': phash(np.rot90(buffers, 2, axes=(1, 2))),
+              'rot270': phash(np.rot90(buffers, 3, axes=(1, 2)))}
+    for name, crop in CROPS.items():
+        result[name] = phash(np.stack([load(img, crop) for img in images]))
+    return result
+
+
+def extract(images, with_variants=False):
+    """Computes all hashes of a batch of images. Each image is decoded and
+    resized once.
+
+    Parameters
+    ----------
+    images : List
+        Paths to images, or PIL Image objects.
+    with_variants : bool, optional
+        If True, the pHashes of the transformed variants are computed as well.
+
+    Returns
+    -------
+    dict
+        Maps each name in HASHES to an array with the hashes of all images as
+        signed 64 bit integers. If with_variants is True, 'variants' maps to
+        the result of variants.
+    """
+    if len(images) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        result = dict((name, empty) for name in HASHES)
+        if with_variants:
+            result['variants'] = dict((name, empty) for name in VARIANTS)
+        return result
+    images = [img_util.open_if(img) for img in images]
+    buffers = np.stack([load(img) for img in images])
+    result = {'phash': phash(buffers),
+              'dhash': dhash(buffers),
+              'ahash': ahash(buffers),
+              'whash': whash(buffers)}
+    if with_variants:
+        result['variants'] = variants(images, buffers)
+    return result
+
+
+def check():
+    """Extracts the hashes of a generated image with all variants, to fail
+    early if the installed NumPy, SciPy or Pillow are incompatible. Raises
+    an exception if the extraction fails or returns malformed hashes."""
+    gradient = np.add.outer(np.arange(48), np.arange(64) * 2).astype(np.uint8)
+    result = extract([Image.fromarray(gradient)], with_variants=True)
+    for name, values in [(name, result[name]) for name in HASHES] + \
+            [(name, result['variants'][name]) for name in VARIANTS]:
+        if values.shape != (1,) or values.dtype != np.int64:
+            raise ValueError('%s: expected one int64 hash, got %r' % (name, values))
+    return result
+
+
+if __name__ == '__main__':
+    hashes = check()
+    for name in HASHES:
+        print('%s: %s' % (name, img_util.int_to_hash(hashes[name][0])))
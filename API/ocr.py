@@ -1,6 +1,7 @@
 """This module wraps around pytesser. It allows simple usage of the OCR,
 and provides a function to compare images base on the ocr results."""
 
+import hashlib
 from PIL import Image
 from pytesser.pytesser import *
 import cv2
@@ -9,7 +10,22 @@ import img_util
 import textwrap
 
 
-def ocr(img, limit=3):
+# Versions of the whole-image and the text-region OCR, stored with each text.
+# Bump them when the text of an image changes, backfill.py extracts the stored
+# texts again
+VERSION = 1
+REGIONS_VERSION = 1
+
+# height in pixels that text lines are scaled to before OCR
+LINE_HEIGHT = 40
+# bounds of the scale factor of a text region
+MIN_SCALE = 0.5
+MAX_SCALE = 4.0
+# longest edge of the image that text regions are detected on
+DETECT_SIZE = 1600
+
+
+def ocr(img, limit=3, regions=False):
     """Extracts words longer than specified from the image and returns them as
     a single string.
     
@@ -20,6 +36,9 @@ def ocr(img, limit=3):
         Alternativly PIL Image object.
     limit : int, optional
         Specifies the minimum length of the words to be considered.
+    regions : bool, optional
+        If True, only the text regions of the image are recognized, see
+        region_image. The whole image is used if no region is found.
         
     Returns
     -------
@@ -28,6 +47,10 @@ def ocr(img, limit=3):
     """
     # load image as grayscale
     img = img_util.to_cv2(img)
+    if regions:
+        rects = text_regions(img)
+        if rects:
+            return _words(image_to_string(region_image(img, rects)), limit)
     # get resize factor
     height, width = img.shape[:2]
     factor = float(800) / height
@@ -36,13 +59,268 @@ def ocr(img, limit=3):
                      interpolation=cv2.INTER_CUBIC)
     # convert image to PIL image    
     img = Image.fromarray(img)
-    text = image_to_string(img)
+    return _words(image_to_string(img), limit)
+
+
+def version(regions=False):
+    """Returns the version of the text returned by ocr(img, regions=regions).
+    The text-region versions are offset by 1000."""
+    if regions:
+        return 1000 + REGIONS_VERSION
+    return VERSION
+
+
+def _words(text, limit):
+    """Returns the words of an OCR result with at least limit characters,
+    seperated by a space."""
     text = text.split()
     text = [t for t in text if len(t) >= int(limit)]
     text = " ".join(text)
     return text
 
 
+def text_regions(img, min_height=6, max_height=0.2):
+    """Finds likely text lines in an image. Characters have strong edges, the
+    morphological gradient is thresholded and joined horizontally into lines.
+
+    Parameters
+    ----------
+    img : cv2 image
+        Grayscale image.
+    min_height : int, optional
+        The minimum height of a line in pixels of the image.
+    max_height : float, optional
+        The maximum height of a line in ratio to the image height.
+
+    Returns
+    -------
+    list
+        Bounding rectangles (x, y, w, h) of the text lines, sorted from top
+        to bottom.
+    """
+    height, width = img.shape[:2]
+    # large scans are searched at a lower resolution
+    factor = min(1.0, float(DETECT_SIZE) / max(height, width))
+    small = img
+    if factor < 1.0:
+        small = cv2.resize(img, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    gradient = cv2.morphologyEx(small, cv2.MORPH_GRADIENT, kernel)
+    bw = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    # join the characters of a word, but not neighbouring lines
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 3))
+    lines = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, kernel)
+    contours = cv2.findContours(lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+    rects = []
+    for x, y, w, h in _merge_lines([cv2.boundingRect(cnt) for cnt in contours]):
+        # text lines are wider than high, and the joined characters fill a
+        # large part of their bounding rectangle, unlike axes and frames
+        if h < min_height * factor or h > max_height * small.shape[0] or w < h:
+            continue
+        if cv2.countNonZero(lines[y:y + h, x:x + w]) < 0.35 * w * h:
+            continue
+        rects.append((int(x / factor), int(y / factor),
+                      int(np.ceil(w / factor)), int(np.ceil(h / factor))))
+    rects.sort(key=lambda r: (r[1], r[0]))
+    return rects
+
+
+def _merge_lines(rects):
+    """Merges rectangles that overlap vertically by at least half of the
+    smaller height, and are closer horizontally than their height, e.g. the
+    words of a line."""
+    merged = []
+    for x, y, w, h in sorted(rects):
+        for i, (mx, my, mw, mh) in enumerate(merged):
+            overlap = min(y + h, my + mh) - max(y, my)
+            if overlap >= 0.5 * min(h, mh) and x - (mx + mw) < max(h, mh):
+                x1, y1 = max(x + w, mx + mw), max(y + h, my + mh)
+                mx, my = min(x, mx), min(y, my)
+                merged[i] = (mx, my, x1 - mx, y1 - my)
+                break
+        else:
+            merged.append((x, y, w, h))
+    return merged
+
+
+def region_image(img, rects, margin=4):
+    """Stacks the text regions of an image into one image for OCR. Each
+    region is scaled so that its height is LINE_HEIGHT, within MIN_SCALE and
+    MAX_SCALE, small text is upscaled and large text is downscaled.
+
+    Parameters
+    ----------
+    img : cv2 image
+        Grayscale image.
+    rects : list
+        Bounding rectangles of the text regions, see text_regions.
+    margin : int, optional
+        The margin in pixels around each region.
+
+    Returns
+    -------
+    PIL Image
+        The regions below each other on a white background.
+    """
+    height, width = img.shape[:2]
+    lines = []
+    for x, y, w, h in rects:
+        x0, y0 = max(x - margin, 0), max(y - margin, 0)
+        x1, y1 = min(x + w + margin, width), min(y + h + margin, height)
+        scale = min(max(float(LINE_HEIGHT) / h, MIN_SCALE), MAX_SCALE)
+        interpolation = cv2.INTER_CUBIC if scale > 1 else cv2.INTER_AREA
+        lines.append(cv2.resize(img[y0:y1, x0:x1], None, fx=scale, fy=scale,
+                                interpolation=interpolation))
+
+    gap = LINE_HEIGHT // 2
+    canvas = np.full((sum(line.shape[0] + gap for line in lines) + gap,
+                      max(line.shape[1] for line in lines) + 2 * gap), 255, np.uint8)
+    top = gap
+    for line in lines:
+        canvas[top:top + line.shape[0], gap:gap + line.shape[1]] = line
+        top += line.shape[0] + gap
+    return Image.fromarray(canvas)
+
+
+def trigrams(s, max_wordlength=3):
+    """Splits the words of a string into their n-grams.
+
+    Parameters
+    ----------
+    s : str
+        Contains words of an image, sperated by a space.
+    max_wordlength : int, optional
+        The n in n-grams. 3 is highly recommended.
+
+    Returns
+    -------
+    set
+        The unique n-grams of the string, or None if the text is 'NA'.
+    """
+    if s is None or s == 'NA':
+        return None
+    grams = set()
+    for x in set(s.split()):
+        for tri in textwrap.wrap(x, max_wordlength):
+            if len(tri) > 2:
+                grams.add(tri)
+    return grams
+
+
+def trigram_distance(u1, u2, min_words=10):
+    """Returns the distance between two n-gram sets, as returned by trigrams.
+
+    Parameters
+    ----------
+    u1 : set
+        The n-grams of image 1.
+    u2 : set
+        The n-grams of image 2.
+    min_words : int, optional
+        The minumum number of n-grams in each set required
+
+    Returns
+    -------
+    float
+        The distance between both sets.
+    """
+    if u1 is None or u2 is None:
+        return 10000.0
+    # skip short sets
+    if len(u1) < min_words or len(u2) < min_words:
+        return 10000.0
+    # similarity is the number of same unique elements
+    length = len(u1 & u2)
+    if length == 0:
+        return np.inf
+    sd = len(u1) + len(u2) - 2 * length
+    return float(sd) / length
+
+
+def trigram_distances(ids, n, flat, offsets, rows, min_words=10, size=None):
+    """Returns the distances between one n-gram set and many, same as
+    trigram_distance. The sets are given as sorted arrays of interned n-gram
+    ids, the corpus sets are stored in one flat array.
+
+    Parameters
+    ----------
+    ids : np.ndarray
+        The ids of the n-grams of the query that occur in the corpus, or None
+        if the query has no text.
+    n : int
+        The number of n-grams of the query, including those without id.
+    flat : np.ndarray
+        The ids of all corpus sets.
+    offsets : np.ndarray
+        The corpus set i is flat[offsets[i]:offsets[i + 1]].
+    rows : np.ndarray
+        The corpus sets to compare with.
+    min_words : int, optional
+        The minumum number of n-grams in each set required
+    size : int, optional
+        Larger than every id in flat, computed if None.
+
+    Returns
+    -------
+    np.ndarray
+        The distance to each corpus set in rows.
+    """
+    dist = np.full(len(rows), 10000.0)
+    if ids is None or n < min_words:
+        return dist
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    pos = np.flatnonzero(lengths >= min_words)
+    if len(pos) == 0:
+        return dist
+    # membership of every corpus n-gram in the query, by lookup table
+    if size is None:
+        size = int(flat.max()) + 1 if len(flat) else 0
+    member = np.zeros(max(size, int(ids.max()) + 1 if len(ids) else 0), dtype=bool)
+    member[ids] = True
+    if 2 * len(pos) > len(offsets) - 1:
+        # most sets are compared, count over the whole corpus without a copy
+        nonempty = np.flatnonzero(np.diff(offsets) > 0)
+        counts = np.zeros(len(offsets) - 1, dtype=np.int64)
+        counts[nonempty] = np.add.reduceat(member[flat], offsets[nonempty], dtype=np.int64)
+        length = counts[rows[pos]]
+    else:
+        ends = np.cumsum(lengths[pos])
+        begins = ends - lengths[pos]
+        index = np.arange(ends[-1]) + np.repeat(starts[pos] - begins, lengths[pos])
+        length = np.add.reduceat(member[flat[index]], begins, dtype=np.int64)
+    sd = n + lengths[pos] - 2 * length
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist[pos] = np.where(length > 0, sd / length.astype(float), np.inf)
+    return dist
+
+
+def simhash(grams):
+    """Returns the 64 bit SimHash of an n-gram set. Similar sets have hashes
+    with a small hamming distance.
+
+    Parameters
+    ----------
+    grams : set
+        The n-grams, as returned by trigrams.
+
+    Returns
+    -------
+    int
+        The SimHash as signed 64 bit integer, 0 for an empty set.
+    """
+    if not grams:
+        return 0
+    # the first 8 bytes of the md5 digest are the 64 bit hash of an n-gram
+    digests = b''.join(hashlib.md5(g if isinstance(g, bytes) else g.encode('utf-8')).digest()[:8]
+                       for g in grams)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(-1, 64)
+    packed = np.packbits(2 * bits.sum(axis=0) > len(bits))
+    return int(packed.view('>i8')[0])
+
+
 def distance(s1, s2, min_words=10, max_wordlength=3):
     """Compares two strings that each contain words seperated by a space,
     and returns the distance that the two strings have.
@@ -63,32 +341,6 @@ def distance(s1, s2, min_words=10, max_wordlength=3):
     float
         The distance between both input strings.      
     """
-    
-    if s1 == 'NA' or s2 == 'NA':
-        return 10000.0
-    
-    # split strings to lists on whitespaces
-    s1 = set(s1.split())
-    s2 = set(s2.split())
-    
-    # split word into trigrams
-    u1 = set()
-    for x in s1:
-        for tri in textwrap.wrap(x, max_wordlength):
-            if len(tri) > 2:
-                u1.add(tri) 
-    u2 = set()
-    for x in s2:
-        for tri in textwrap.wrap(x, max_wordlength):
-            if len(tri) > 2:
-                u2.add(tri)
-    
-    # skip short sets
-    if len(u1) < min_words or len(u2) < min_words:
-        return 10000.0
-    # similarity is the number of same unique elements
-    length = len(set.intersection(u1, u2))
-    if length == 0:
-        return np.inf
-    sd = len(set.symmetric_difference(u1, u2))
-    return np.float(sd) / length
\ No newline at end of file
+    return trigram_distance(trigrams(s1, max_wordlength),
+                            trigrams(s2, max_wordlength),
+                            min_words)
@@ -0,0 +1,117 @@
+"""This module decodes the pages of multi-page documents, PDFs and multi-page
+TIFFs, one at a time. Each page is written as an image file and processed
+like an uploaded image before the next page is decoded, so the memory of an
+upload does not grow with its number of pages.
+
+PDFs are rasterized with pdfinfo and pdftoppm of poppler-utils, which must be
+installed on the path. TIFFs are read frame by frame with PIL.
+"""
+
+import os
+import re
+import subprocess
+
+from PIL import Image
+
+
+# resolution of rasterized PDF pages in dots per inch
+DPI = 150
+
+PDF_MAGIC = b'%PDF'
+TIFF_MAGICS = (b'II*\x00', b'MM\x00*')
+
+
+def kind(path):
+    """Returns 'pdf' or 'tiff' if the file at path is a PDF or a TIFF, else
+    None."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic == PDF_MAGIC:
+        return 'pdf'
+    if magic in TIFF_MAGICS:
+        return 'tiff'
+    return None
+
+
+def page_count(path):
+    """Returns the number of pages of a document, 1 for single images.
+
+    Parameters
+    ----------
+    path : str
+        Path to the uploaded file.
+
+    Returns
+    -------
+    int
+        The number of pages.
+    """
+    doc_kind = kind(path)
+    if doc_kind == 'pdf':
+        with open(os.devnull, 'w') as devnull:
+            info = subprocess.check_output(['pdfinfo', path], stderr=devnull)
+        match = re.search(r'^Pages:\s+(\d+)', info.decode('utf-8', 'replace'), re.MULTILINE)
+        if match is None:
+            raise ValueError('Not a valid PDF: ' + path)
+        return int(match.group(1))
+    if doc_kind == 'tiff':
+        img = Image.open(path)
+        try:
+            return getattr(img, 'n_frames', 1)
+        finally:
+            img.close()
+    return 1
+
+
+def _pdf_page(path, number, page_path, dpi):
+    """Rasterizes one page of a PDF to a PNG file."""
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['pdftoppm', '-f', str(number), '-l', str(number), '-r', str(dpi),
+                               '-png', '-singlefile', path, page_path], stderr=devnull)
+    # pdftoppm appends the extension
+    os.rename(page_path + '.png', page_path)
+
+
+def _tiff_page(img, number, page_path):
+    """Writes one frame of an opened TIFF to a PNG file."""
+    img.seek(number - 1)
+    frame = img
+    if img.mode not in ('L', 'RGB'):
+        frame = img.convert('RGB')
+    frame.save(page_path, format='PNG')
+
+
+def pages(path, base_path, dpi=DPI):
+    """Decodes the pages of a multi-page document lazily.
+
+    Parameters
+    ----------
+    path : str
+        Path to the uploaded file, a PDF or a TIFF.
+    base_path : str
+        The directory the page images are written to.
+    dpi : int, optional
+        The resolution of rasterized PDF pages.
+
+    Returns
+    -------
+    generator
+        Yields (number, page_path) for each page, numbered from 1. The page
+        image is decoded when the page is requested; the caller may remove
+        the file afterwards.
+    """
+    doc_kind = kind(path)
+    count = page_count(path)
+    name = os.path.basename(path)
+    img = Image.open(path) if doc_kind == 'tiff' else None
+    try:
+        for number in range(1, count + 1):
+            page_path = os.path.join(base_path, '%s.page%d' % (name, number))
+            if doc_kind == 'pdf':
+                _pdf_page(path, number, page_path, dpi)
+            else:
+                _tiff_page(img, number, page_path)
+            yield number, page_path
+    finally:
+        if img is not None:
+            img.close()
@@ -0,0 +1,121 @@
+"""This module profiles single requests on demand. If an admin token is
+configured, a request with the header X-Profile or the parameter profile set
+to the token runs its handler under cProfile. The profile is written to the
+profile directory, named by the time and the request id, e.g.:
+
+    $ curl -H 'X-Profile: <token>' 'localhost:5000/images?id=<document>'
+    $ python -m pstats <profile_path>/<time>-<request id>.prof
+
+The response carries the request id in X-Request-ID and the top functions by
+cumulative time in X-Profile-Summary. Only the thread of the handler is
+profiled, not the analysis threads, and a streamed response only until the
+stream is returned.
+"""
+
+import cProfile
+import hmac
+import os
+import pstats
+import re
+import time
+import uuid
+
+import metrics
+
+
+# number of functions in the summary header
+SUMMARY_SIZE = 5
+
+# characters of a request id that are not allowed in a file name
+REQUEST_ID_UNSAFE = re.compile(r'[^A-Za-z0-9_-]')
+
+
+def same_token(given, token):
+    """Compares a token sent by a client with the admin token in constant
+    time. Both are compared as UTF-8 bytes, values that are no strings, e.g.
+    a repeated parameter, never match."""
+    def encoded(value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, type(u'')):
+            return value.encode('utf-8')
+        return None
+
+    given, token = encoded(given), encoded(token)
+    if given is None or token is None:
+        return False
+    return hmac.compare_digest(given, token)
+
+
+def summary(stats, n=SUMMARY_SIZE):
+    """Returns the top functions by cumulative time as one header line.
+
+    Parameters
+    ----------
+    stats : pstats.Stats
+        The profile.
+    n : int, optional
+        The number of functions.
+
+    Returns
+    -------
+    str
+        Entries of the form '0.123s module.py:42(function)', separated by
+        ', '.
+    """
+    stats.sort_stats('cumulative')
+    entries = []
+    for key in stats.fcn_list[:n]:
+        filename, line, name = key
+        cumulative = stats.stats[key][3]
+        entries.append('%.3fs %s:%d(%s)' % (cumulative, os.path.basename(filename), line, name))
+    return ', '.join(entries)
+
+
+class Profiler(object):
+    """Falcon middleware that profiles the requests that carry the admin
+    token.
+
+    Parameters
+    ----------
+    token : str
+        The admin token, None disables profiling.
+    path : str
+        The directory of the written profiles.
+    """
+
+    def __init__(self, token, path):
+        self.token = token
+        self.path = path
+        if token is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def requested(self, req):
+        """Returns True if the request carries the admin token."""
+        if self.token is None:
+            return False
+        given = req.get_header('X-Profile') or req.params.get('profile')
+        if not given:
+            return False
+        return same_token(given, self.token)
+
+    def process_resource(self, req, resp, resource, params):
+        if resource is None or not self.requested(req):
+            return
+        req.context['profile'] = cProfile.Profile()
+        req.context['profile'].enable()
+
+    def process_response(self, req, resp, resource, req_succeeded=True):
+        profile = req.context.get('profile')
+        if profile is None:
+            return
+        profile.disable()
+        # the request id becomes part of a file name
+        request_id = REQUEST_ID_UNSAFE.sub('', req.get_header('X-Request-ID') or '')[:64] or uuid.uuid4().hex
+        filename = os.path.join(self.path, '%s-%s.prof' % (time.strftime('%Y%m%d-%H%M%S'), request_id))
+        profile.dump_stats(filename)
+        metrics.registry.incr('profiled_requests')
+        print('Profile written to ' + filename)
+
+        resp.set_header('X-Request-ID', request_id)
+        resp.set_header('X-Profile-Summary', summary(pstats.Stats(profile)))
@@ -7,9 +7,9 @@ class Tesser_Invalid_Filetype(Tesser_General_Exception):
 	pass
 
 def check_for_errors(logfile = "tesseract.log"):
-	inf = file(logfile)
+	inf = open(logfile)
 	text = inf.read()
 	inf.close()
 	# All error conditions result in "Error" somewhere in logfile
 	if text.find("Error") != -1:
-		raise Tesser_General_Exception, text
\ No newline at end of file
+		raise Tesser_General_Exception(text)
\ No newline at end of file
@@ -4,17 +4,21 @@ by Michael J.T. O'Kelly
 V 0.0.1, 3/10/07"""
 
 import os
+import shutil
+import tempfile
 
 from PIL import Image
 import subprocess
 
-import util
-import errors
+from . import util
+from . import errors
 
 tesseract_exe_name = 'tesseract' # Name of executable to be called at command line
 scratch_image_name = "temp.bmp" # This file must be .bmp or other Tesseract-compatible format
 scratch_text_name_root = "temp" # Leave out the .txt extension
 cleanup_scratch_flag = True  # Temporary files cleaned up after OCR operation
+# The scratch files are written to a new temporary directory per call, so
+# concurrent calls from threads or processes do not overwrite each other
 
 
 def call_tesseract(input_filename, output_filename):
@@ -31,13 +35,16 @@ def call_tesseract(input_filename, output_filename):
 def image_to_string(im, cleanup = cleanup_scratch_flag):
     """Converts im to file, applies tesseract, and fetches resulting text.
     If cleanup=True, delete scratch files after operation."""
+    scratch_dir = tempfile.mkdtemp(prefix='pytesser-')
+    image_name = os.path.join(scratch_dir, scratch_image_name)
+    text_name_root = os.path.join(scratch_dir, scratch_text_name_root)
     try:
-        util.image_to_scratch(im, scratch_image_name)
-        call_tesseract(scratch_image_name, scratch_text_name_root)
-        text = util.retrieve_text(scratch_text_name_root)
+        util.image_to_scratch(im, image_name)
+        call_tesseract(image_name, text_name_root)
+        text = util.retrieve_text(text_name_root)
     finally:
         if cleanup:
-            util.perform_cleanup(scratch_image_name, scratch_text_name_root)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
     return text
 
 
@@ -45,10 +52,12 @@ def image_file_to_string(filename, cleanup = cleanup_scratch_flag, graceful_erro
     """Applies tesseract to filename; or, if image is incompatible and graceful_errors=True,
     converts to compatible format and then applies tesseract.  Fetches resulting text.
     If cleanup=True, delete scratch files after operation."""
+    scratch_dir = tempfile.mkdtemp(prefix='pytesser-')
+    text_name_root = os.path.join(scratch_dir, scratch_text_name_root)
     try:
         try:
-            call_tesseract(filename, scratch_text_name_root)
-            text = util.retrieve_text(scratch_text_name_root)
+            call_tesseract(filename, text_name_root)
+            text = util.retrieve_text(text_name_root)
         except errors.Tesser_General_Exception:
             if graceful_errors:
                 im = Image.open(filename)
@@ -57,22 +66,22 @@ def image_file_to_string(filename, cleanup = cleanup_scratch_flag, graceful_erro
                 raise
     finally:
         if cleanup:
-            util.perform_cleanup(scratch_image_name, scratch_text_name_root)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
     return text
 
 
 if __name__=='__main__':
     im = Image.open('phototest.tif')
     text = image_to_string(im)
-    print text
+    print(text)
     try:
         text = image_file_to_string('fnord.tif', graceful_errors=False)
-    except errors.Tesser_General_Exception, value:
-        print "fnord.tif is incompatible filetype.  Try graceful_errors=True"
-        print value
+    except errors.Tesser_General_Exception as value:
+        print("fnord.tif is incompatible filetype.  Try graceful_errors=True")
+        print(value)
     text = image_file_to_string('fnord.tif', graceful_errors=True)
-    print "fnord.tif contents:", text
+    print("fnord.tif contents: " + text)
     text = image_file_to_string('fonts_test.png', graceful_errors=True)
-    print text
+    print(text)
 
 
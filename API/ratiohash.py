@@ -7,6 +7,11 @@ import numpy as np
 import img_util
 
 
+# Version of get_hash, stored with each rhash. Bump it when the hash of an
+# image changes, backfill.py recomputes the stored hashes
+VERSION = 1
+
+
 def to_hash(bars):
     """Converts a list to a hash, each 3 digits represent one bar height.
     
@@ -231,6 +236,119 @@ def get_hash(img):
     return to_hash(bars)
 
 
+def pack(h):
+    """Packs a ratio hash into a binary string of little endian uint16 values,
+    one value per bar.
+
+    Parameters
+    ----------
+    h : {str, np.ndarray}
+        Hash in three digits hex representation, or 'NA', or bar heights as
+        returned by unpack.
+
+    Returns
+    -------
+    str
+        The packed hash, or None for 'NA'.
+    """
+    if isinstance(h, np.ndarray):
+        return h.astype('<u2').tobytes()
+    if h is None or h == 'NA':
+        return None
+    return np.array([int(x, base=16) for x in tw.wrap(h, 3)], dtype='<u2').tobytes()
+
+
+def unpack(blob):
+    """Unpacks a binary ratio hash into an array of bar heights.
+
+    Parameters
+    ----------
+    blob : str
+        The packed hash as returned by pack, or None.
+
+    Returns
+    -------
+    np.ndarray
+        The bar heights as uint16 values, or None.
+    """
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype='<u2')
+
+
+def to_hex(bars):
+    """Converts unpacked bar heights back to the hex representation.
+
+    Parameters
+    ----------
+    bars : np.ndarray
+        The bar heights as returned by unpack, or None.
+
+    Returns
+    -------
+    str
+        Hash in three digits hex representation, or 'NA'.
+    """
+    if bars is None:
+        return 'NA'
+    return ''.join([format(int(x), 'x').zfill(3) for x in bars])
+
+
+def distances(bars, hashes):
+    """Vectorized version of distance. Takes unpacked bar heights and returns
+    the distances to a sequence of unpacked hashes.
+
+    Parameters
+    ----------
+    bars : np.ndarray
+        Bar heights as returned by unpack, or None.
+    hashes : np.ndarray
+        Object array of bar heights as returned by unpack, or None.
+
+    Returns
+    -------
+    np.ndarray
+        The distances between the barcharts, same as distance.
+    """
+    lengths = np.array([-1 if h is None else len(h) for h in hashes], dtype=np.int64)
+    flat = np.concatenate([h for h in hashes if h is not None] or [np.zeros(0, dtype=np.uint16)])
+    starts = np.concatenate([[0], np.cumsum(np.maximum(lengths, 0))[:-1]]).astype(np.int64)
+    return packed_distances(bars, flat, starts, lengths)
+
+
+def packed_distances(bars, flat, starts, lengths):
+    """Version of distances for hashes stored in one flat array.
+
+    Parameters
+    ----------
+    bars : np.ndarray
+        Bar heights as returned by unpack, or None.
+    flat : np.ndarray
+        The bar heights of all hashes.
+    starts : np.ndarray
+        The position of each hash in flat.
+    lengths : np.ndarray
+        The number of bars of each hash, -1 for missing hashes.
+
+    Returns
+    -------
+    np.ndarray
+        The distances between the barcharts, same as distance.
+    """
+    result = np.full(len(lengths), 10000, dtype=np.int64)
+    # if the hash has less than 4 bars, return max distance
+    if bars is None or len(bars) < 4:
+        return result
+    # only hashes with the same number of bars are compared
+    mask = lengths == len(bars)
+    if mask.any():
+        others = flat[starts[mask][:, None] + np.arange(len(bars))]
+        others = np.sort(others.astype(np.int64), axis=1)
+        bars = np.sort(np.asarray(bars, dtype=np.int64))
+        result[mask] = np.abs(others - bars).sum(axis=1)
+    return result
+
+
 def distance(hash1, hash2):
     """Takes two ratio hashes and returns the distance between them.
     
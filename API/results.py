@@ -0,0 +1,235 @@
+"""This module contains the result model of the analysis and ingest responses.
+Responses are assembled as plain dictionaries and lists and serialized to JSON
+once, instead of being concatenated as strings."""
+
+try:
+    import ujson as _json
+except ImportError:
+    import json as _json
+
+
+def dumps(obj):
+    """Serializes a result to a JSON string. Uses ujson if available.
+
+    Parameters
+    ----------
+    obj : dict
+        The result to serialize.
+
+    Returns
+    -------
+    str
+        The JSON representation of the result.
+    """
+    return _json.dumps(obj)
+
+
+def match_list(df, with_parent=True):
+    """Converts the matches returned by the DBHandler eval functions to a list
+    of match records.
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        Matches with the columns id, parent and score. May be empty. The
+        column variant is included, if present.
+    with_parent : bool, optional
+        If True, the parent of each match is included in the records.
+
+    Returns
+    -------
+    list
+        A list of dictionaries, one for each match.
+    """
+    if df is None or df.empty:
+        return []
+    ids = df['id'].values
+    scores = df['score'].values
+    if with_parent:
+        parents = df['parent'].values
+        records = [{'id': str(i), 'parent': str(p), 'score': str(s)}
+                   for i, p, s in zip(ids, parents, scores)]
+    else:
+        records = [{'id': str(i), 'score': str(s)} for i, s in zip(ids, scores)]
+    if 'variant' in df:
+        for record, variant in zip(records, df['variant'].values):
+            record['variant'] = str(variant)
+    return records
+
+
+def analysis(id, subimages):
+    """Returns the result of an analyse request.
+
+    Parameters
+    ----------
+    id : str
+        The id of the analysed document.
+    subimages : list
+        The results of the subimages, as returned by analysis_subimage.
+
+    Returns
+    -------
+    dict
+        The analysis result.
+    """
+    return {'analyse': 'True',
+            'store': 'False',
+            'id': str(id),
+            'subimages': subimages}
+
+
+def analysis_subimage(id, parent, is_pure, is_bar, matches_phash,
+                      matches_rhash, matches_text, matches_mhash=None,
+                      matches_variant=None):
+    """Returns the analysis result of a single subimage.
+
+    Parameters
+    ----------
+    id : str
+        The id of the subimage.
+    parent : str
+        The id of the document the subimage belongs to.
+    is_pure : bool
+        True if the subimage was classified as pure image.
+    is_bar : bool
+        True if the subimage was classified as bar chart.
+    matches_phash, matches_rhash, matches_text : list
+        The match records of each modality, as returned by match_list.
+    matches_mhash : list, optional
+        The match records of the combined multihash evaluation.
+    matches_variant : list, optional
+        The match records of the evaluation against the transformed variants.
+
+    Returns
+    -------
+    dict
+        The subimage result.
+    """
+    result = {'id': str(id),
+              'parent': str(parent),
+              'is_pure': str(is_pure),
+              'is_bar': str(is_bar),
+              'matches_phash': matches_phash,
+              'matches_rhash': matches_rhash,
+              'matches_text': matches_text}
+    if matches_mhash is not None:
+        result['matches_mhash'] = matches_mhash
+    if matches_variant is not None:
+        result['matches_variant'] = matches_variant
+    return result
+
+
+def search(queries):
+    """Returns the result of a search request.
+
+    Parameters
+    ----------
+    queries : list
+        The results of the queries, as returned by search_query.
+
+    Returns
+    -------
+    dict
+        The search result.
+    """
+    return {'queries': queries}
+
+
+def search_query(id, matches):
+    """Returns the search result of a single query.
+
+    Parameters
+    ----------
+    id : str or int
+        The id of the query as given by the client, or its index.
+    matches : dict
+        Maps the evaluated modalities (phash, mhash, rhash, text) to their
+        match records, as returned by match_list.
+
+    Returns
+    -------
+    dict
+        The query result, with the matches of each evaluated modality.
+    """
+    result = {'id': id}
+    for name, records in matches.items():
+        result['matches_' + name] = records
+    return result
+
+
+def ingest(id, analyse, store, subimages, dedup=None):
+    """Returns the result of an upload request.
+
+    Parameters
+    ----------
+    id : str
+        The id of the uploaded document.
+    analyse : bool
+        True if the subimages were analysed.
+    store : bool
+        True if the subimages were stored in the database.
+    subimages : list
+        The results of the subimages, as returned by ingest_subimage.
+    dedup : dict, optional
+        The dropped crops, reused features and saved stage invocations, if
+        the crops were deduplicated.
+
+    Returns
+    -------
+    dict
+        The upload result.
+    """
+    result = {'analyse': str(analyse),
+              'store': str(store),
+              'id': str(id),
+              'subimages': subimages}
+    if dedup is not None:
+        result['dedup'] = dedup
+    return result
+
+
+def ingest_subimage(id, location, is_bar, is_pure, phash, rhash, text,
+                    db_response=None, matches=None, hashes=None):
+    """Returns the upload result of a single subimage.
+
+    Parameters
+    ----------
+    id : str
+        The id of the subimage.
+    location : str
+        The storage location of the subimage, None if it was not stored.
+        Like db_response, it is only included if the subimage was stored.
+    is_bar, is_pure : list
+        The classification results as returned by classify.classify. The two
+        top labels are included with their confidence.
+    phash, rhash, text : str
+        The extracted features.
+    db_response : str, optional
+        The response of the DBHandler, if the subimage was stored.
+    matches : dict, optional
+        Maps the match keys (matches_phash, matches_rhash, ...) to the match
+        records, if the subimage was analysed.
+    hashes : dict, optional
+        Additional hashes as hex strings, e.g. the hashes of multihash.
+
+    Returns
+    -------
+    dict
+        The subimage result.
+    """
+    result = {}
+    if matches is not None:
+        result.update(matches)
+    if db_response is not None:
+        result['db_response'] = db_response
+    result['id'] = id
+    if location is not None:
+        result['location'] = location
+    for label, confidence in (is_bar[1], is_bar[2], is_pure[1], is_pure[2]):
+        result[str(label)] = str(confidence)
+    result['phash'] = phash
+    if hashes is not None:
+        result.update(hashes)
+    result['rhash'] = rhash
+    result['text'] = text
+    return result
@@ -0,0 +1,174 @@
+"""This module searches the corpus for features that clients extracted
+themselves, see features.py, without uploading the images. A request posts a
+batch of queries as JSON:
+
+    {"queries": [{"id": "figure-1", "phash": "c3d0...", "dhash": "...",
+                  "ahash": "...", "whash": "...", "rhash": "0a1...",
+                  "text": "words of the figure", "versions": {...}}]}
+
+The id, a string or an integer, is returned with the result of the query,
+by default it is the index of the query. Each feature of a query is optional.
+The pHash is evaluated alone and, with the dHash, aHash and wHash, as
+multihash; the ratio hash and the text are evaluated if given. The thresholds
+are the parameters of an analysis, e.g. phash_thresh. If a query carries the
+versions of its features, they must match the versions of the server.
+"""
+
+import json
+import numbers
+import string
+
+import falcon
+
+import images
+import multihash
+import results
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+# maximum number of queries in one request
+MAX_QUERIES = 100
+
+
+def parse(body):
+    """Returns the validated queries of a request body.
+
+    Parameters
+    ----------
+    body : bytes
+        The JSON request body.
+
+    Returns
+    -------
+    list
+        The queries as dictionaries.
+
+    Raises
+    ------
+    falcon.HTTPBadRequest
+        If the body or a query is invalid.
+    """
+    try:
+        queries = json.loads(body.decode('utf-8'))['queries']
+    except (ValueError, KeyError, TypeError):
+        raise falcon.HTTPBadRequest(title='Invalid body', description='Expected {"queries": [...]}')
+    if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+        raise falcon.HTTPBadRequest(title='Invalid body', description='queries must be a list of objects')
+    if len(queries) > MAX_QUERIES:
+        raise falcon.HTTPBadRequest(title='Too many queries', description='At most %d queries' % MAX_QUERIES)
+    for i, query in enumerate(queries):
+        id = query.get('id')
+        if id is not None and (isinstance(id, bool) or not isinstance(id, (basestring, numbers.Integral))):
+            raise falcon.HTTPBadRequest(title='Invalid query',
+                                        description='id of query %d is no string or integer' % i)
+        for name in multihash.HASHES:
+            value = query.get(name)
+            if value is not None and not _is_hash(value):
+                raise falcon.HTTPBadRequest(title='Invalid query',
+                                            description='%s of query %d is no 64 bit hex hash' % (name, i))
+        rhash = query.get('rhash')
+        if rhash not in (None, 'NA') and not _is_rhash(rhash):
+            raise falcon.HTTPBadRequest(title='Invalid query',
+                                        description='rhash of query %d is no ratio hash' % i)
+        text = query.get('text')
+        if text is not None and not isinstance(text, basestring):
+            raise falcon.HTTPBadRequest(title='Invalid query', description='text of query %d is no string' % i)
+        if text is not None and not isinstance(text, str):
+            # the stored texts are UTF-8 byte strings in Python 2
+            query['text'] = text.encode('utf-8')
+    return queries
+
+
+def _is_hex(value):
+    """Returns True if value is a non-empty string of hex digits."""
+    return isinstance(value, basestring) and len(value) > 0 and all(c in string.hexdigits for c in value)
+
+
+def _is_hash(value):
+    """Returns True if value is a 64 bit hash as hex string."""
+    return _is_hex(value) and len(value) == 16
+
+
+def _is_rhash(value):
+    """Returns True if value is a ratio hash, three hex digits per bar."""
+    return _is_hex(value) and len(value) % 3 == 0
+
+
+class Search(object):
+    """Falcon resource that evaluates precomputed features.
+
+    Parameters
+    ----------
+    collection : images.Collection
+        The collection with the corpus, the evaluator and the versions of the
+        server features.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def _check_versions(self, i, query):
+        """Raises falcon.HTTPBadRequest if a feature of the i-th query was
+        extracted with another version than the stored features."""
+        versions = query.get('versions') or {}
+        for feature, given in (('mhash', 'phash'), ('rhash', 'rhash'), ('text', 'text')):
+            if feature in versions and query.get(given) is not None \
+                    and versions[feature] != self.collection.versions[feature]:
+                raise falcon.HTTPBadRequest(title='Incompatible features',
+                                            description='%s of query %d has version %s, the server uses %s'
+                                                        % (feature, i, versions[feature],
+                                                           self.collection.versions[feature]))
+
+    def _jobs(self, queries, thresholds, cancelled=None):
+        """Yields (query, jobs) for each query, the evaluations as expected by
+        evaluation.Evaluator.run."""
+        db_handler = self.collection.db_handler
+        for query in queries:
+            if cancelled is not None and cancelled.is_set():
+                raise images.Cancelled('search')
+            jobs = []
+            if query.get('phash') is not None:
+                jobs.append(('phash', db_handler.eval_phash, (query['phash'],), thresholds['phash']))
+                if all(query.get(name) is not None for name in multihash.HASHES):
+                    hashes = dict((name, query[name]) for name in multihash.HASHES)
+                    jobs.append(('mhash', db_handler.eval_mhash, (hashes,), thresholds['mhash']))
+            if query.get('rhash') not in (None, 'NA'):
+                jobs.append(('rhash', db_handler.eval_rhash, (query['rhash'],), thresholds['rhash']))
+            if query.get('text'):
+                jobs.append(('text', db_handler.eval_text, (query['text'],), thresholds['text']))
+            yield query, jobs
+
+    def search(self, queries, params, cancelled=None):
+        """Evaluates a batch of queries.
+
+        Parameters
+        ----------
+        queries : list
+            The queries, as returned by parse.
+        params : dict
+            The request parameters, the thresholds as for an analysis.
+        cancelled : threading.Event, optional
+            If set, Cancelled is raised before the next query is evaluated.
+
+        Returns
+        -------
+        list
+            The result of each query, see results.search_query.
+        """
+        for i, query in enumerate(queries):
+            self._check_versions(i, query)
+        jobs = self._jobs(queries, images.thresholds(params), cancelled)
+        records = []
+        for i, (query, found) in enumerate(self.collection.evaluator.run(jobs)):
+            matches = dict((name, results.match_list(df)) for name, df in found.items())
+            records.append(results.search_query(query.get('id', i), matches))
+        return records
+
+    def on_post(self, req, resp):
+        queries = parse(req.bounded_stream.read())
+        resp.body = results.dumps(results.search(self.search(queries, req.params)))
+        resp.status = falcon.HTTP_200
@@ -0,0 +1,365 @@
+"""This module contains the storage backends of the uploaded images and their
+subimages. FileStorage keeps one file per image in a flat directory.
+PackStorage appends the images to large segment files and keeps their
+position in a SQLite index, reads are served through mmap. CropStorage adds
+virtual subimages, which are cropped from their stored parent on demand.
+
+Segments with dead space, left by replaced images, can be compacted:
+
+    $ python storage.py compact <pack directory>
+"""
+
+import argparse
+import collections
+import fcntl
+import io
+import mmap
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import cv2
+import numpy as np
+import blobcrop
+
+
+class FileRange(object):
+    """File-like object that reads a byte range of a file. fileno is passed
+    through, so WSGI servers can still use sendfile from the current offset."""
+
+    def __init__(self, f, start, length):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+class FileStorage(object):
+    """Stores each image as a file named by its id in one directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def location(self, name):
+        """Returns the location of an image, as reported in responses."""
+        return os.path.join(self.path, name)
+
+    def put(self, name, data):
+        """Stores an image.
+
+        Parameters
+        ----------
+        name : str
+            The id of the image.
+        data : bytes
+            The encoded image.
+        """
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.write(data)
+
+    def put_file(self, name, src):
+        """Moves a file into the storage.
+
+        Parameters
+        ----------
+        name : str
+            The id of the image.
+        src : str
+            Path to the file, it is removed.
+        """
+        shutil.move(src, os.path.join(self.path, name))
+
+    def stat(self, name):
+        """Returns (size, mtime) of an image. Raises KeyError if it does not
+        exist."""
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            raise KeyError(name)
+        return st.st_size, st.st_mtime
+
+    def read(self, name, start=0, length=None):
+        """Returns the bytes of an image, or of a range of it."""
+        with open(os.path.join(self.path, name), 'rb') as f:
+            f.seek(start)
+            return f.read() if length is None else f.read(length)
+
+    def open_range(self, name, start, length):
+        """Returns a file-like object of a byte range of an image."""
+        return FileRange(open(os.path.join(self.path, name), 'rb'), start, length)
+
+
+class PackStorage(object):
+    """Appends images to segment files of up to segment_bytes. The segment,
+    offset and length of each image are stored in index.sqlite. Writers of
+    several processes are serialized by a lock file."""
+
+    def __init__(self, path, segment_bytes=1024 ** 3):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.lock = threading.RLock()
+        self.lock_path = os.path.join(path, 'lock')
+        self.maps = {}
+
+        self.index = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.execute('PRAGMA synchronous=NORMAL')
+        self.index.execute('''CREATE TABLE IF NOT EXISTS blobs(name TEXT PRIMARY KEY,
+        segment INTEGER, offset INTEGER, length INTEGER, mtime REAL)''')
+        self.index.commit()
+
+    def segment_path(self, segment):
+        """Returns the path of a segment file."""
+        return os.path.join(self.path, 'segment-%06d.pack' % segment)
+
+    def location(self, name):
+        """Returns the location of an image, as reported in responses."""
+        segment, offset, length, _ = self.locate(name)
+        return '%s@%d+%d' % (self.segment_path(segment), offset, length)
+
+    def _exclusive(self):
+        """Returns an open lock file, locked exclusively for this process."""
+        f = open(self.lock_path, 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def put(self, name, data):
+        """Appends an image to the active segment. An image with the same id is
+        replaced, its old bytes become dead space.
+
+        Parameters
+        ----------
+        name : str
+            The id of the image.
+        data : bytes
+            The encoded image.
+        """
+        with self.lock:
+            lock_file = self._exclusive()
+            try:
+                self._append(name, data, time.time())
+            finally:
+                lock_file.close()
+
+    def _append(self, name, data, mtime):
+        """Appends an image to the active segment and indexes it. The caller
+        must hold both locks."""
+        segment = self.index.execute('SELECT MAX(segment) FROM blobs').fetchone()[0] or 1
+        path = self.segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) + len(data) > self.segment_bytes:
+            segment += 1
+            path = self.segment_path(segment)
+        with open(path, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.index:
+            self.index.execute('INSERT OR REPLACE INTO blobs VALUES(?,?,?,?,?)',
+                               (name, segment, offset, len(data), mtime))
+
+    def put_file(self, name, src):
+        """Appends a file to the storage.
+
+        Parameters
+        ----------
+        name : str
+            The id of the image.
+        src : str
+            Path to the file, it is removed.
+        """
+        with open(src, 'rb') as f:
+            self.put(name, f.read())
+        os.remove(src)
+
+    def locate(self, name):
+        """Returns (segment, offset, length, mtime) of an image. Raises
+        KeyError if it does not exist."""
+        with self.lock:
+            row = self.index.execute('SELECT segment, offset, length, mtime FROM blobs WHERE name=?',
+                                     (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row
+
+    def stat(self, name):
+        """Returns (size, mtime) of an image. Raises KeyError if it does not
+        exist."""
+        _, _, length, mtime = self.locate(name)
+        return length, mtime
+
+    def _map(self, segment, end):
+        """Returns a read-only mmap of a segment that covers at least end
+        bytes. The active segment grows, its map is renewed if necessary."""
+        with self.lock:
+            mm = self.maps.get(segment)
+            if mm is None or len(mm) < end:
+                with open(self.segment_path(segment), 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment] = mm
+            return mm
+
+    def read(self, name, start=0, length=None):
+        """Returns the bytes of an image, or of a range of it."""
+        segment, offset, size, _ = self.locate(name)
+        if length is None:
+            length = size - start
+        mm = self._map(segment, offset + size)
+        return mm[offset + start:offset + start + length]
+
+    def open_range(self, name, start, length):
+        """Returns a file-like object of a byte range of an image."""
+        return io.BytesIO(self.read(name, start, length))
+
+    def compact(self, min_dead=0.25):
+        """Rewrites the live images of segments with a large share of dead
+        space to new segments, and removes the old segments.
+
+        Parameters
+        ----------
+        min_dead : float, optional
+            The minimum share of dead bytes of a segment to be compacted.
+
+        Returns
+        -------
+        int
+            The number of bytes reclaimed.
+        """
+        reclaimed = 0
+        with self.lock:
+            lock_file = self._exclusive()
+            try:
+                active = self.index.execute('SELECT MAX(segment) FROM blobs').fetchone()[0]
+                live = dict(self.index.execute('SELECT segment, SUM(length) FROM blobs GROUP BY segment'))
+                for name in sorted(os.listdir(self.path)):
+                    if not (name.startswith('segment-') and name.endswith('.pack')):
+                        continue
+                    segment = int(name[len('segment-'):-len('.pack')])
+                    size = os.path.getsize(self.segment_path(segment))
+                    # the active segment is still written to
+                    if segment == active or size == 0:
+                        continue
+                    if (size - live.get(segment, 0)) / float(size) < min_dead:
+                        continue
+                    rows = self.index.execute('SELECT name, mtime FROM blobs WHERE segment=? ORDER BY offset',
+                                              (segment,)).fetchall()
+                    # the modification time is kept, so ETags stay valid
+                    for blob, mtime in rows:
+                        self._append(blob, self.read(blob), mtime)
+                    self.maps.pop(segment, None)
+                    os.remove(self.segment_path(segment))
+                    reclaimed += size - live.get(segment, 0)
+                    print('Compacted segment %d, %d images moved' % (segment, len(rows)))
+            finally:
+                lock_file.close()
+        return reclaimed
+
+
+class CropStorage(object):
+    """Wraps another storage. Images that are not stored in it are looked up
+    as virtual subimages, cropped from their parent and encoded as PNG. The
+    most recently requested crops are cached in memory."""
+
+    def __init__(self, images, lookup, maxsize=64):
+        self.images = images
+        # callable, returns (parent, rect) of a virtual subimage or None
+        self.lookup = lookup
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.crops = collections.OrderedDict()
+
+    def location(self, name):
+        return self.images.location(name)
+
+    def put(self, name, data):
+        self.images.put(name, data)
+
+    def put_file(self, name, src):
+        self.images.put_file(name, src)
+
+    def _crop(self, name):
+        """Returns (data, mtime) of a virtual subimage, or None if the image
+        is stored. Raises KeyError if it does not exist."""
+        try:
+            self.images.stat(name)
+            return None
+        except KeyError:
+            pass
+        found = self.lookup(name)
+        if found is None:
+            raise KeyError(name)
+        parent, rect = found
+        # the crop changes if the parent is replaced
+        _, mtime = self.images.stat(parent)
+        with self.lock:
+            crop = self.crops.pop(name, None)
+            if crop is not None and crop[1] == mtime:
+                self.crops[name] = crop
+                return crop
+
+        # decoded the same way as by blobcrop.crop_to_blob at upload
+        img = cv2.imdecode(np.frombuffer(self.images.read(parent), np.uint8), cv2.IMREAD_GRAYSCALE)
+        buf = io.BytesIO()
+        blobcrop.crop(img, rect).save(buf, format='PNG')
+        crop = (buf.getvalue(), mtime)
+        with self.lock:
+            self.crops[name] = crop
+            while len(self.crops) > self.maxsize:
+                self.crops.popitem(last=False)
+        return crop
+
+    def stat(self, name):
+        """Returns (size, mtime) of an image. The mtime of a virtual subimage
+        is the one of its parent."""
+        crop = self._crop(name)
+        if crop is None:
+            return self.images.stat(name)
+        return len(crop[0]), crop[1]
+
+    def read(self, name, start=0, length=None):
+        crop = self._crop(name)
+        if crop is None:
+            return self.images.read(name, start, length)
+        if length is None:
+            return crop[0][start:]
+        return crop[0][start:start + length]
+
+    def open_range(self, name, start, length):
+        crop = self._crop(name)
+        if crop is None:
+            return self.images.open_range(name, start, length)
+        return io.BytesIO(crop[0][start:start + length])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance of pack storage.')
+    subparsers = parser.add_subparsers(dest='command')
+    compact = subparsers.add_parser('compact', help='remove dead space from segments')
+    compact.add_argument('path', help='directory of the pack storage')
+    compact.add_argument('--min-dead', type=float, default=0.25,
+                         help='minimum share of dead bytes of a segment')
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        reclaimed = PackStorage(args.path).compact(args.min_dead)
+        print('Reclaimed %d bytes' % reclaimed)
+
+
+if __name__ == '__main__':
+    main()
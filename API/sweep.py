@@ -0,0 +1,227 @@
+"""Compares every subimage of the corpus with the subimages of all other
+documents, as an analysis of each document would, and groups the suspicious
+pairs into clusters. Run from the API folder, e.g.:
+
+    $ python sweep.py --database database.sqlite --workers 8
+    $ python sweep.py --database database.sqlite --resume
+
+The corpus is written to a snapshot file that the worker processes attach,
+see corpus.attach. The documents are swept in chunks, in the order of their
+ids. The matches of each chunk are written to the table sweep_pairs together
+with the number of swept documents, so an interrupted sweep continues with
+the next chunk when it is started with --resume. A sweep can only be resumed
+while the database is unchanged.
+
+When all documents are swept, the subimages connected by suspicious pairs are
+merged into clusters with union-find and written to the table
+sweep_clusters, the clusters are numbered by decreasing size.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import corpus
+import database
+
+
+MODALITIES = ('phash', 'rhash', 'text')
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(snapshot_path, params):
+    """Attaches the snapshot of the corpus in a worker process."""
+    _worker['corpus'] = corpus.attach(snapshot_path)
+    _worker['params'] = params
+    # the eval functions report every subimage
+    sys.stdout = open(os.devnull, 'w')
+
+
+def _sweep(task):
+    """Evaluates the subimages of a range of documents against the subimages
+    of all other documents.
+
+    Parameters
+    ----------
+    task : tuple
+        (start, stop), the range of parents as indices of Corpus.parents.
+
+    Returns
+    -------
+    tuple
+        (stop, pairs), pairs are tuples (id, parent, match, match_parent,
+        modality, score).
+    """
+    start, stop = task
+    snapshot = _worker['corpus']
+    params = _worker['params']
+    thresholds = params['thresholds']
+    pairs = []
+    for code in range(start, stop):
+        parent = snapshot.parents[code]
+        first, last = snapshot.parent_starts[code], snapshot.parent_starts[code + 1]
+        others = np.concatenate([np.arange(first), np.arange(last, len(snapshot))])
+        # no match can be told apart from fewer rows, see Corpus._matches
+        if len(others) < 2:
+            continue
+        for i in range(first, last):
+            row = snapshot.record(i)
+            found = []
+            if 'phash' in params['modalities']:
+                found.append(('phash', snapshot.eval_phash(row['phash'], others, thresh=thresholds['phash'])))
+            if 'rhash' in params['modalities'] and row['is_bar'] == 1 and row['rhash'] is not None:
+                found.append(('rhash', snapshot.eval_rhash(row['rhash'], others, thresh=thresholds['rhash'])))
+            if 'text' in params['modalities'] and row['is_pure'] != 1:
+                fingerprint = (row['trigram_ids'], row['n_trigrams'], row['simhash'])
+                found.append(('text', snapshot.eval_text(fingerprint, others, thresh=thresholds['text'],
+                                                         prefilter=params['text_prefilter'])))
+            for modality, df in found:
+                if df.empty:
+                    continue
+                for match, match_parent, score in zip(df['id'].values, df['parent'].values,
+                                                      df['score'].values):
+                    pairs.append((row['id'], parent, match, match_parent, modality, float(score)))
+    return stop, pairs
+
+
+def clusters(pairs):
+    """Merges the subimages connected by pairs with union-find.
+
+    Parameters
+    ----------
+    pairs : iterable
+        (id, match) for each suspicious pair.
+
+    Returns
+    -------
+    list
+        The clusters as lists of ids, by decreasing size.
+    """
+    roots = {}
+
+    def find(id):
+        root = id
+        while roots[root] != root:
+            root = roots[root]
+        # path compression
+        while roots[id] != root:
+            roots[id], id = root, roots[id]
+        return root
+
+    for id, match in pairs:
+        roots.setdefault(id, id)
+        roots.setdefault(match, match)
+        a, b = find(id), find(match)
+        if a != b:
+            roots[max(a, b)] = min(a, b)
+
+    members = {}
+    for id in roots:
+        members.setdefault(find(id), []).append(id)
+    return sorted((sorted(ids) for ids in members.values()), key=lambda ids: (-len(ids), ids[0]))
+
+
+def _start(db_handler, source, params, n_parents, resume):
+    """Returns (sweep, done) of the sweep to run, the unfinished sweep with
+    the same source and parameters if resume is True, else a new sweep."""
+    params_json = json.dumps(params, sort_keys=True)
+    with db_handler.lock:
+        if resume:
+            row = db_handler.cursor.execute('''SELECT id, done FROM sweeps WHERE finished IS NULL
+            AND source=? AND params=? ORDER BY id DESC LIMIT 1''', (source, params_json)).fetchone()
+            if row is not None:
+                return row
+            print('No unfinished sweep of the current database with these parameters, starting a new one')
+        with db_handler.db:
+            db_handler.cursor.execute('''INSERT INTO sweeps(source, params, started, parents, done)
+            VALUES(?,?,?,?,0)''', (source, params_json, time.time(), n_parents))
+        return db_handler.cursor.lastrowid, 0
+
+
+def _finish(db_handler, sweep):
+    """Writes the clusters of a completed sweep and marks it finished.
+    Returns the number of clusters."""
+    with db_handler.lock:
+        rows = db_handler.cursor.execute('''SELECT id, parent, match, match_parent FROM sweep_pairs
+        WHERE sweep=?''', (sweep,)).fetchall()
+        parents = {}
+        for id, parent, match, match_parent in rows:
+            parents[id] = parent
+            parents[match] = match_parent
+        found = clusters((row[0], row[2]) for row in rows)
+        with db_handler.db:
+            db_handler.cursor.execute('DELETE FROM sweep_clusters WHERE sweep=?', (sweep,))
+            db_handler.cursor.executemany('INSERT INTO sweep_clusters(sweep, cluster, id, parent) VALUES(?,?,?,?)',
+                                          [(sweep, n + 1, id, parents[id])
+                                           for n, ids in enumerate(found) for id in ids])
+            db_handler.cursor.execute('UPDATE sweeps SET finished=? WHERE id=?', (time.time(), sweep))
+    return len(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='database.sqlite')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk', type=int, default=100, help='documents per checkpoint')
+    parser.add_argument('--modalities', default=','.join(MODALITIES),
+                        help='comma separated modalities, default: all')
+    parser.add_argument('--phash-thresh', type=float, default=0.01)
+    parser.add_argument('--rhash-thresh', type=float, default=0.01)
+    parser.add_argument('--text-thresh', type=float, default=0.01)
+    parser.add_argument('--text-prefilter', type=int, help='see text_prefilter in app.py')
+    parser.add_argument('--resume', action='store_true', help='continue the last unfinished sweep')
+    args = parser.parse_args()
+    modalities = [name for name in args.modalities.split(',') if name]
+    for name in modalities:
+        if name not in MODALITIES:
+            parser.error('unknown modality: ' + name)
+    params = {'modalities': modalities, 'text_prefilter': args.text_prefilter,
+              'thresholds': {'phash': args.phash_thresh, 'rhash': args.rhash_thresh,
+                             'text': args.text_thresh}}
+
+    db_handler = database.DBHandler(args.database, load=False)
+    source = db_handler.source()
+    snapshot = db_handler.build_corpus()
+    n_parents = len(snapshot.parents)
+    sweep, done = _start(db_handler, source, params, n_parents, args.resume)
+    print('Sweep %d: %d of %d documents done' % (sweep, done, n_parents))
+
+    tmp_dir = tempfile.mkdtemp(prefix='imageplag-sweep-')
+    try:
+        snapshot_path = os.path.join(tmp_dir, 'corpus.snapshot')
+        corpus.save(snapshot, snapshot_path)
+        del snapshot
+        pool = multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(snapshot_path, params))
+        try:
+            tasks = [(start, min(start + args.chunk, n_parents)) for start in range(done, n_parents, args.chunk)]
+            start_time = time.time()
+            # in order, so the number of swept documents is a checkpoint
+            for stop, pairs in pool.imap(_sweep, tasks):
+                with db_handler.lock, db_handler.db:
+                    db_handler.cursor.executemany('''INSERT OR IGNORE INTO sweep_pairs(sweep, id, parent,
+                    match, match_parent, modality, score) VALUES(?,?,?,?,?,?,?)''',
+                                                  [(sweep,) + pair for pair in pairs])
+                    db_handler.cursor.execute('UPDATE sweeps SET done=? WHERE id=?', (stop, sweep))
+                print('%d of %d documents, %d pairs, %.1f documents/s'
+                      % (stop, n_parents, len(pairs), (stop - done) / (time.time() - start_time)))
+        finally:
+            pool.terminate()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if db_handler.source() != source:
+        print('The database changed during the sweep, the results describe the state at its start')
+    print('Sweep %d finished, %d clusters' % (sweep, _finish(db_handler, sweep)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""This module creates downscaled copies of stored images on demand, and keeps
+them in a size-bounded cache directory. The least recently used thumbnails are
+removed first."""
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from PIL import Image
+import metrics
+import storage
+
+
+# bounds of the requested edge length in pixels
+MIN_SIZE = 16
+MAX_SIZE = 1024
+DEFAULT_SIZE = 256
+
+
+class ThumbnailCache(object):
+    """Directory of thumbnails with a maximum total size in bytes. The access
+    time is tracked by the modification time of each file."""
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.storage = storage.FileStorage(cache_dir)
+        self.total = sum(os.path.getsize(os.path.join(cache_dir, name))
+                         for name in os.listdir(cache_dir))
+
+    def get(self, source, name, size):
+        """Returns the name of the thumbnail of an image in self.storage,
+        creates it if it is not cached.
+
+        Parameters
+        ----------
+        source : storage.FileStorage or storage.PackStorage
+            The storage of the original image.
+        name : str
+            The id of the original image. KeyError is raised if it does not
+            exist.
+        size : int
+            Maximum width and height of the thumbnail.
+
+        Returns
+        -------
+        str
+            Name of the thumbnail.
+        """
+        length, mtime = source.stat(name)
+        key = '%s:%d:%d:%d' % (name, mtime, length, size)
+        thumb_name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        thumb_path = os.path.join(self.cache_dir, thumb_name)
+        try:
+            # mark as recently used
+            os.utime(thumb_path, None)
+            metrics.registry.incr('thumbnail_cache_hits')
+            return thumb_name
+        except OSError:
+            metrics.registry.incr('thumbnail_cache_misses')
+
+        img = Image.open(io.BytesIO(source.read(name)))
+        img.thumbnail((size, size), Image.LANCZOS)
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('RGB')
+        # write to a temporary file first, readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, format='JPEG', quality=85)
+        os.rename(tmp_path, thumb_path)
+
+        with self.lock:
+            self.total += os.path.getsize(thumb_path)
+            if self.total > self.max_bytes:
+                self.evict()
+        return thumb_name
+
+    def evict(self):
+        """Removes the least recently used thumbnails until the cache is below
+        90% of its maximum size. The caller must hold the lock."""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        files.sort()
+        self.total = sum(size for _, size, _ in files)
+        for _, size, name in files:
+            if self.total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                self.total -= size
+                metrics.registry.incr('thumbnail_cache_evictions')
+            except OSError:
+                pass